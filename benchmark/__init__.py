@@ -0,0 +1,5 @@
+__all__ = ['common', 'dataloader_bench', 'encoder_memory_bench', 'checkpoint_bench', 
+           'load_bench', 'sequence_parallel_bench', 'ensemble_bench', 'serve_bench', 
+           'concurrency_bench', 'pairwise_bench', 'fused_dual_bench', 
+           'import_bench', 'attention_bench', 'lsh_bench', 
+           'performer_bench']
\ No newline at end of file
@@ -0,0 +1,93 @@
+# Exact attention: materialized scores (einsum) vs. torch's fused kernel (sdpa) vs. blockwise online softmax.
+#
+#   python -m benchmark.attention_bench --seq_lens 1024 4096 16384 --impls einsum sdpa blockwise
+#
+# Every row is one forward and backward of softmax(QK^T / sqrt(d)) V on random
+# (batch, head, seq, head_dim) tensors, with the peak memory above the inputs.
+# Before timing, outputs and gradients of every implementation are compared
+# to einsum in float64 on a short sequence.
+
+import time
+import argparse
+import torch
+
+from benchmark import common
+from utils import attention, memory
+
+
+def get_parameters():
+    parser = argparse.ArgumentParser(description='Exact attention benchmark')
+    parser.add_argument('--seq_lens', type=int, nargs='+', default=[1024, 4096, 16384], help='Sequence lengths to measure')
+    parser.add_argument('--impls', type=str, nargs='+', default=['einsum', 'sdpa', 'blockwise'], help='Attention implementations to compare')
+    parser.add_argument('--batch_size', type=int, default=1, help='Batch size')
+    parser.add_argument('--num_head', type=int, default=2, help='Number of heads')
+    parser.add_argument('--head_dim', type=int, default=64, help='Dimension per head')
+    parser.add_argument('--block_size', type=int, default=512, help='Queries and keys per tile of the blockwise attention')
+    parser.add_argument('--steps', type=int, default=3, help='Number of timed forward and backward passes')
+    parser.add_argument('--cpu', action='store_true', help='Run on CPU even if CUDA is available')
+
+    return parser.parse_args()
+
+
+def random_qkv(cli, seq_len, device, dtype=torch.float32):
+    shape = (cli.batch_size, cli.num_head, seq_len, cli.head_dim)
+    return [torch.randn(shape, device=device, dtype=dtype, requires_grad=True) for _ in range(3)]
+
+
+def max_errors(cli, impl, device):
+    """Largest absolute difference of the output and the gradients of q, k, v to einsum."""
+    qkv = random_qkv(cli, 3 * cli.block_size // 2 + 7, device, torch.float64)
+    grad = torch.randn_like(qkv[0])
+    scale = cli.head_dim ** -0.5
+
+    results = []
+    for name in ['einsum', impl]:
+        output = attention.attention(*qkv, scale, name, cli.block_size)
+        grads = torch.autograd.grad(output, qkv, grad)
+        results.append([output] + list(grads))
+
+    return [(a - b).abs().max().item() for a, b in zip(*results)]
+
+
+def measure(cli, impl, seq_len, device):
+    qkv = random_qkv(cli, seq_len, device)
+    scale = cli.head_dim ** -0.5
+
+    def step_fn():
+        attention.attention(*qkv, scale, impl, cli.block_size).sum().backward()
+        for tensor in qkv:
+            tensor.grad = None
+
+    step_fn()
+    tracker = memory.MemoryTracker(device)
+    baseline = torch.cuda.memory_allocated(device) if device.type == 'cuda' else memory.process_rss()
+    start = time.perf_counter()
+    with tracker.phase('step'):
+        for _ in range(cli.steps):
+            step_fn()
+    elapsed = (time.perf_counter() - start) / cli.steps
+
+    return elapsed, tracker.peak('step') - baseline
+
+
+if __name__ == '__main__':
+    cli = get_parameters()
+    device = torch.device('cuda' if torch.cuda.is_available() and not cli.cpu else 'cpu')
+    if ('sdpa' in cli.impls) and not attention.sdpa_available():
+        print('scaled_dot_product_attention is not available in this torch, skipping sdpa')
+        cli.impls = [impl for impl in cli.impls if impl != 'sdpa']
+
+    print(f'batch {cli.batch_size}, {cli.num_head} heads of {cli.head_dim}, block {cli.block_size} ({device.type})')
+    for impl in cli.impls:
+        errors = max_errors(cli, impl, device)
+        print(f'  {impl:>9s} vs einsum (float64): out {errors[0]:.1e}, dq {errors[1]:.1e}, dk {errors[2]:.1e}, dv {errors[3]:.1e}')
+
+    print(f'  {"seq_len":>7s} {"impl":>9s} {"fwd+bwd (ms)":>13s} {"peak":>14s}')
+    for seq_len in cli.seq_lens:
+        for impl in cli.impls:
+            try:
+                elapsed, peak = measure(cli, impl, seq_len, device)
+            except (RuntimeError, MemoryError) as error:
+                print(f'  {seq_len:7d} {impl:>9s} {"failed: " + str(error).splitlines()[0][:40]:>28s}')
+                continue
+            print(f'  {seq_len:7d} {impl:>9s} {elapsed * 1e3:13.1f} {common.format_bytes(max(peak, 0))}')
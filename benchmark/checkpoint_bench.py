@@ -0,0 +1,73 @@
+# Memory-vs-time trade-off of the activation checkpointing policies.
+#
+#   python -m benchmark.checkpoint_bench --config ld_config.yaml --datasets longdoc16k longdoc32k \
+#       --policies none embedding kernelution gffn embedding,kernelution,gffn
+
+import time
+import argparse
+import torch
+import torch.nn as nn
+
+from pathlib import Path
+from benchmark import common
+from model import wrapper
+from utils import memory, microbatch, recompute
+
+
+def get_parameters():
+    parser = argparse.ArgumentParser(description='Activation checkpointing benchmark')
+    parser.add_argument('--config', type=Path, default="ld_config.yaml", help='Path to the yaml configuration file')
+    parser.add_argument('--datasets', type=str, nargs='+', default=['longdoc16k', 'longdoc32k'], help='Task sections of the config')
+    parser.add_argument('--xformer', type=str, default='converter', help='Type of transformer to use')
+    parser.add_argument('--policies', type=str, nargs='+', default=['none', 'embedding', 'kernelution', 'gffn', 'embedding,kernelution,gffn'],
+                        help='Comma-separated checkpointing targets per policy')
+    parser.add_argument('--every', type=int, default=1, help='Checkpoint every Nth encoder block')
+    parser.add_argument('--batch_size', type=int, default=None, help='Override the batch size of the task')
+    parser.add_argument('--steps', type=int, default=3, help='Number of timed training steps')
+    parser.add_argument('--cpu', action='store_true', help='Run on CPU even if CUDA is available')
+
+    return parser.parse_args()
+
+
+def bench_policy(namespace, args, policy, every, steps, device):
+    torch.manual_seed(3407)
+    model = wrapper.LRASingle(namespace, args).to(device)
+    recompute.apply_policy(model, recompute.parse_policy(policy), every)
+    model.train()
+    loss_cel = nn.CrossEntropyLoss()
+    samples, targets = common.synthetic_batch(args, device)
+
+    def step_fn():
+        model.zero_grad(set_to_none=True)
+        loss_cel(model(*samples), targets).backward()
+
+    saved_bytes = microbatch.saved_activation_bytes(lambda: model(*samples))
+    step_fn()
+
+    tracker = memory.MemoryTracker(device)
+    with tracker.phase('step'):
+        start = time.perf_counter()
+        for _ in range(steps):
+            step_fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        step_time = (time.perf_counter() - start) / steps
+
+    return saved_bytes, tracker.peak('step'), step_time
+
+
+if __name__ == '__main__':
+    cli = get_parameters()
+    device = torch.device('cuda' if torch.cuda.is_available() and not cli.cpu else 'cpu')
+
+    for dataset in cli.datasets:
+        namespace, args = common.load_args(cli.config, dataset, cli.xformer, batch_size=cli.batch_size)
+        print(f'{cli.xformer} on {dataset}: batch {args.batch_size} x {args.max_seq_len} tokens ({device.type})')
+        print(f'  {"policy":32s} {"saved activations":>18s} {"peak memory":>14s} {"step time":>10s} {"slowdown":>9s}')
+        baseline_time = None
+        for policy in cli.policies:
+            saved_bytes, peak, step_time = bench_policy(namespace, args, policy, cli.every, cli.steps, device)
+            if baseline_time is None:
+                baseline_time = step_time
+            print(f'  {policy:32s} {common.format_bytes(saved_bytes):>18s} {common.format_bytes(peak):>14s} '
+                  f'{step_time:9.3f}s {step_time / baseline_time:8.2f}x')
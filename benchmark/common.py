@@ -0,0 +1,31 @@
+import yaml
+import torch
+
+from types import SimpleNamespace
+from utils.entry import dict_to_namespace
+
+
+def load_args(config, dataset, xformer='converter', **overrides):
+    """Namespace and per-task args as the entry points build them, with optional overrides."""
+    with open(config) as f:
+        config = yaml.safe_load(f)
+
+    section = dict(config[dataset])
+    section.update({key: value for key, value in overrides.items() if value is not None})
+    namespace = SimpleNamespace(config=config, dataset=dataset, xformer=xformer)
+
+    return namespace, dict_to_namespace(section)
+
+
+def synthetic_batch(args, device, dual=False):
+    """Random tokens and labels shaped like one loader batch of the task."""
+    shape = (args.batch_size, args.max_seq_len)
+    # the last vocabulary entries are reserved for padding / CLS
+    samples = [torch.randint(0, args.vocab_size - 2, shape, device=device) for _ in range(2 if dual else 1)]
+    targets = torch.randint(0, args.num_class, (args.batch_size,), device=device)
+
+    return samples, targets
+
+
+def format_bytes(num_bytes):
+    return f'{num_bytes / (1024 ** 2):10.1f} MiB'
@@ -0,0 +1,75 @@
+# Concurrency stress test: many threads sharing one model instance at inference.
+#
+#   python -m benchmark.concurrency_bench --config lra_config.yaml --dataset listops --threads 1 2 4 8
+#
+# Every thread runs its own stream of batches through one shared Predictor,
+# with one intra-op thread each, so the scaling comes from running forwards
+# concurrently rather than from splitting a single op. The outputs must match
+# a single-threaded reference (the reformer's LSH draws from a generator
+# seeded per call) and no parameter, buffer or tensor attribute may change.
+
+import time
+import argparse
+import torch
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from benchmark import common
+from model import wrapper
+from utils import inference
+
+XFORMERS = ['converter', 'cosformer', 'fnet', 'linformer', 'nystromformer',
+            'performer', 'reformer', 'synthesizer', 'transformer']
+
+
+def get_parameters():
+    parser = argparse.ArgumentParser(description='Shared-model inference concurrency benchmark')
+    parser.add_argument('--config', type=Path, default="lra_config.yaml", help='Path to the yaml configuration file')
+    parser.add_argument('--dataset', type=str, default="listops", help='Name of the task section in the config')
+    parser.add_argument('--xformers', type=str, nargs='+', default=XFORMERS, help='Encoders to stress')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8], help='Numbers of threads sharing the model')
+    parser.add_argument('--batch_size', type=int, default=4, help='Samples per call')
+    parser.add_argument('--calls', type=int, default=8, help='Calls per thread')
+
+    return parser.parse_args()
+
+
+def run_threads(predictor, batches, threads, calls):
+    """Every thread makes `calls` calls; call j of a thread uses batch j and seed j."""
+    def worker(_):
+        return [predictor(*batches[j], seed=j) for j in range(calls)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        outputs = list(pool.map(worker, range(threads)))
+    elapsed = time.perf_counter() - start
+
+    return outputs, elapsed
+
+
+if __name__ == '__main__':
+    cli = get_parameters()
+    torch.set_num_threads(1)
+    device = torch.device('cpu')
+
+    print(f'{cli.dataset}: {cli.calls} calls of {cli.batch_size} samples per thread, 1 intra-op thread each')
+    print(f'  {"xformer":>14s} {"threads":>7s} {"samples/s":>10s} {"scaling":>8s} {"outputs":>8s} {"state":>8s}')
+    for xformer in cli.xformers:
+        namespace, args = common.load_args(cli.config, cli.dataset, xformer)
+        model = wrapper.LRADual(namespace, args) if args.dataset == 'retrieval' else wrapper.LRASingle(namespace, args)
+        predictor = inference.Predictor(model.eval(), args.batch_size, device)
+        batch_args = common.load_args(cli.config, cli.dataset, xformer, batch_size=cli.batch_size)[1]
+        batches = [common.synthetic_batch(batch_args, device, args.dataset == 'retrieval')[0] for _ in range(cli.calls)]
+
+        reference = [predictor(*batches[j], seed=j) for j in range(cli.calls)]
+        baseline = None
+        for threads in cli.threads:
+            before = inference.version_counters(model)
+            outputs, elapsed = run_threads(predictor, batches, threads, cli.calls)
+            unchanged = inference.version_counters(model) == before
+            matches = all(torch.equal(output, expected) for thread in outputs for output, expected in zip(thread, reference))
+
+            rate = threads * cli.calls * cli.batch_size / elapsed
+            baseline = baseline or rate
+            print(f'  {xformer:>14s} {threads:7d} {rate:10.1f} {rate / baseline:7.2f}x '
+                  f'{"equal" if matches else "DIFFER":>8s} {"clean" if unchanged else "MUTATED":>8s}')
@@ -0,0 +1,77 @@
+# Loader throughput: per-sample __getitem__ + default collation vs. batch-indexed gather.
+#
+#   python -m benchmark.dataloader_bench --num_samples 20000 --seq_len 4096 --batch_size 128 --num_workers 2
+
+import time
+import argparse
+import torch
+
+from torch.utils.data import DataLoader
+from utils import dataloader, memory
+
+
+def get_parameters():
+    parser = argparse.ArgumentParser(description='Data loader throughput benchmark')
+    parser.add_argument('--num_samples', type=int, default=20000, help='Number of synthetic samples')
+    parser.add_argument('--seq_len', type=int, default=4096, help='Sequence length of each sample')
+    parser.add_argument('--vocab_size', type=int, default=96, help='Vocabulary size of the synthetic tokens')
+    parser.add_argument('--batch_size', type=int, default=128, help='Batch size')
+    parser.add_argument('--num_workers', type=int, default=2, help='Number of loader worker processes')
+    parser.add_argument('--epochs', type=int, default=3, help='Number of timed passes over the data')
+
+    return parser.parse_args()
+
+
+def time_loader(loader, epochs):
+    # The first pass also pays for worker start-up, so it is reported separately.
+    timings = []
+    tracker = memory.MemoryTracker()
+    tracker.start('loader')
+    for _ in range(epochs):
+        start = time.perf_counter()
+        num_samples = 0
+        for batch in loader:
+            num_samples += batch[-1].size(0)
+        timings.append((time.perf_counter() - start, num_samples))
+    tracker.stop('loader')
+
+    return timings, tracker.peak('loader')
+
+
+def report(name, result):
+    timings, peak_memory = result
+    first_time, first_samples = timings[0]
+    print(f'{name}')
+    print(f'  first epoch: {first_samples / first_time:12.1f} samples/s')
+    if len(timings) > 1:
+        steady_time = sum(t for t, _ in timings[1:])
+        steady_samples = sum(n for _, n in timings[1:])
+        print(f'  steady:      {steady_samples / steady_time:12.1f} samples/s')
+    print(f'  peak RSS:    {peak_memory / (1024 ** 2):12.1f} MiB')
+
+
+if __name__ == '__main__':
+    args = get_parameters()
+
+    data = torch.randint(0, args.vocab_size, (args.num_samples, args.seq_len), dtype=torch.int32)
+    labels = torch.randint(0, 2, (args.num_samples,), dtype=torch.int32)
+
+    per_sample_loader = DataLoader(
+        dataset = dataloader.SingleDatasetCreator(data = data, labels = labels),
+        batch_size = args.batch_size,
+        shuffle = True,
+        drop_last = True,
+        num_workers = args.num_workers
+    )
+
+    batch_loader = dataloader.create_dataloader(
+        dataset = dataloader.BatchSingleDatasetCreator(data = data.clone(), labels = labels.clone()),
+        batch_size = args.batch_size,
+        shuffle = True,
+        drop_last = True,
+        num_workers = args.num_workers
+    )
+
+    print(f'{args.num_samples} samples x {args.seq_len} tokens, batch size {args.batch_size}, {args.num_workers} workers')
+    report('per-sample __getitem__ + collate', time_loader(per_sample_loader, args.epochs))
+    report('batch-indexed gather', time_loader(batch_loader, args.epochs))
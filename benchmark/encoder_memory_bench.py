@@ -0,0 +1,67 @@
+# Peak memory of one training step per phase, and net allocations per submodule.
+#
+#   python -m benchmark.encoder_memory_bench --config genome_config.yaml --dataset mm --xformer converter
+
+import argparse
+import torch
+import torch.nn as nn
+
+from pathlib import Path
+from benchmark import common
+from model import wrapper
+from utils import memory
+
+
+def get_parameters():
+    parser = argparse.ArgumentParser(description='Encoder memory benchmark')
+    parser.add_argument('--config', type=Path, default="lra_config.yaml", help='Path to the yaml configuration file')
+    parser.add_argument('--dataset', type=str, default="text", help='Name of the task section in the config')
+    parser.add_argument('--xformer', type=str, default='converter', help='Type of transformer to use')
+    parser.add_argument('--batch_size', type=int, default=None, help='Override the batch size of the task')
+    parser.add_argument('--max_seq_len', type=int, default=None, help='Override the sequence length of the task')
+    parser.add_argument('--top', type=int, default=15, help='Number of submodules to list')
+    parser.add_argument('--cpu', action='store_true', help='Run on CPU even if CUDA is available')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    cli = get_parameters()
+    namespace, args = common.load_args(cli.config, cli.dataset, cli.xformer, batch_size=cli.batch_size, max_seq_len=cli.max_seq_len)
+    device = torch.device('cuda' if torch.cuda.is_available() and not cli.cpu else 'cpu')
+
+    dual = args.dataset == 'retrieval'
+    if dual:
+        model = wrapper.LRADual(namespace, args).to(device)
+    else:
+        model = wrapper.LRASingle(namespace, args).to(device)
+    model.train()
+    loss_cel = nn.CrossEntropyLoss()
+    samples, targets = common.synthetic_batch(args, device, dual)
+
+    def step_fn():
+        model.zero_grad(set_to_none=True)
+        loss = loss_cel(model(*samples), targets)
+        loss.backward()
+
+    # warm up the allocator so the phases below do not include one-off allocations
+    step_fn()
+    model.zero_grad(set_to_none=True)
+
+    tracker = memory.MemoryTracker(device)
+    baseline = torch.cuda.memory_allocated(device) if device.type == 'cuda' else memory.process_rss()
+    with tracker.phase('forward'):
+        loss = loss_cel(model(*samples), targets)
+    with tracker.phase('backward'):
+        loss.backward()
+    del loss
+
+    print(f'{cli.xformer} on {args.dataset}: batch {args.batch_size} x {args.max_seq_len} tokens ({device.type})')
+    print(f'  baseline:          {common.format_bytes(baseline)}')
+    for phase in ['forward', 'backward']:
+        print(f'  peak in {phase:9s} {common.format_bytes(tracker.peak(phase))} (+{common.format_bytes(tracker.peak(phase) - baseline).strip()})')
+
+    usage = memory.module_memory(model, step_fn, device)
+    print(f'  net forward allocations of the top {cli.top} submodules:')
+    for name, num_bytes in sorted(usage.items(), key=lambda item: -item[1])[:cli.top]:
+        print(f'    {common.format_bytes(num_bytes)}  {name}')
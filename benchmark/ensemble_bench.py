@@ -0,0 +1,97 @@
+# Training throughput of the vmap seed ensemble against one model per process.
+#
+#   python -m benchmark.ensemble_bench --config lra_config.yaml --dataset listops --copies 1 2 4 8
+#
+# N separate processes split the cores of the machine, so the baseline runs a
+# single model with 1/N of the intra-op threads and counts N times its samples.
+
+import time
+import argparse
+import torch
+import torch.nn as nn
+
+from pathlib import Path
+from types import SimpleNamespace
+from benchmark import common
+from model import wrapper
+from utils import ensemble, los
+
+
+def get_parameters():
+    parser = argparse.ArgumentParser(description='Seed ensemble benchmark')
+    parser.add_argument('--config', type=Path, default="lra_config.yaml", help='Path to the yaml configuration file')
+    parser.add_argument('--dataset', type=str, default="listops", help='Name of the task section in the config')
+    parser.add_argument('--xformer', type=str, default='converter', help='Type of transformer to use')
+    parser.add_argument('--copies', type=int, nargs='+', default=[1, 2, 4, 8], help='Ensemble sizes to measure')
+    parser.add_argument('--batch_size', type=int, default=None, help='Override the batch size of the task')
+    parser.add_argument('--steps', type=int, default=5, help='Number of timed training steps')
+
+    return parser.parse_args()
+
+
+def build(namespace, args, seed):
+    torch.manual_seed(seed)
+    if args.dataset == 'retrieval':
+        return wrapper.LRADual(namespace, args)
+    return wrapper.LRASingle(namespace, args)
+
+
+def time_steps(step_fn, steps):
+    step_fn()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step_fn()
+    return (time.perf_counter() - start) / steps
+
+
+def single_throughput(namespace, args, samples, targets, steps, threads):
+    model = build(namespace, args, 0)
+    model.train()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr)
+    loss_cel = nn.CrossEntropyLoss()
+
+    def step_fn():
+        loss_cel(model(*samples), targets).backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(threads)
+    try:
+        return args.batch_size / time_steps(step_fn, steps)
+    finally:
+        torch.set_num_threads(num_threads)
+
+
+def ensemble_throughput(namespace, args, samples, targets, steps, copies):
+    models = [build(namespace, args, seed) for seed in range(copies)]
+    optimizers = [torch.optim.AdamW(model.parameters(), lr=args.lr) for model in models]
+    namespace = SimpleNamespace(**vars(namespace), seeds=list(range(copies)), resume=False)
+    loss_seq_kp = los.KernelPolynomialLoss(max_order=args.xformer.converter.max_order)
+    trainer = ensemble.EnsembleTrainer(namespace, args, models, optimizers, [], None, nn.CrossEntropyLoss(), loss_seq_kp, torch.device('cpu'))
+    for model in models:
+        model.train()
+
+    def step_fn():
+        params, buffers = trainer.stack(range(copies))
+        losses, _ = trainer.compute(params, buffers, samples, targets)
+        losses.sum().backward()
+        for optimizer in optimizers:
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+
+    return copies * args.batch_size / time_steps(step_fn, steps)
+
+
+if __name__ == '__main__':
+    cli = get_parameters()
+    namespace, args = common.load_args(cli.config, cli.dataset, cli.xformer, batch_size=cli.batch_size)
+    samples, targets = common.synthetic_batch(args, torch.device('cpu'), args.dataset == 'retrieval')
+    threads = torch.get_num_threads()
+
+    print(f'{cli.xformer} on {cli.dataset}: batch {args.batch_size} x {args.max_seq_len} tokens, {threads} threads')
+    print(f'  {"copies":>6s} {"separate (samples/s)":>22s} {"ensemble (samples/s)":>22s} {"speedup":>8s}')
+    for copies in cli.copies:
+        separate = copies * single_throughput(namespace, args, samples, targets, cli.steps, max(1, threads // copies))
+        together = ensemble_throughput(namespace, args, samples, targets, cli.steps, copies)
+        print(f'  {copies:6d} {separate:22.1f} {together:22.1f} {together / separate:7.2f}x')
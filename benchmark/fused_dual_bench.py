@@ -0,0 +1,70 @@
+# Training step time of LRADual with two encoder passes vs. one fused pass of batch 2B.
+#
+#   python -m benchmark.fused_dual_bench --config lra_config.yaml --dataset retrieval --xformers converter transformer
+#
+# Both models start from the same weights. The fused model concatenates
+# [input1; input2] along the batch and reuses row b of the batch-shaped
+# parameters for both halves, so in eval mode its logits match the two-pass
+# model up to floating-point reordering (the reformer's LSH draws differ);
+# the max difference is reported.
+
+import time
+import argparse
+import torch
+import torch.nn as nn
+
+from pathlib import Path
+from benchmark import common
+from model import wrapper
+
+
+def get_parameters():
+    parser = argparse.ArgumentParser(description='Fused dual encoder benchmark')
+    parser.add_argument('--config', type=Path, default="lra_config.yaml", help='Path to the yaml configuration file')
+    parser.add_argument('--dataset', type=str, default="retrieval", help='Name of the dual task section in the config')
+    parser.add_argument('--xformers', type=str, nargs='+', default=['converter'], help='Encoders to measure')
+    parser.add_argument('--batch_size', type=int, default=None, help='Override the batch size of the task')
+    parser.add_argument('--steps', type=int, default=5, help='Number of timed training steps')
+    parser.add_argument('--cpu', action='store_true', help='Run on CPU even if CUDA is available')
+
+    return parser.parse_args()
+
+
+def step_time(model, samples, targets, steps, device):
+    model.train()
+    loss_cel = nn.CrossEntropyLoss()
+
+    def step_fn():
+        model.zero_grad(set_to_none=True)
+        loss_cel(model(*samples), targets).backward()
+
+    step_fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(steps):
+        step_fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+    return (time.perf_counter() - start) / steps
+
+
+if __name__ == '__main__':
+    cli = get_parameters()
+    device = torch.device('cuda' if torch.cuda.is_available() and not cli.cpu else 'cpu')
+
+    print(f'  {"xformer":>14s} {"two passes (ms)":>16s} {"fused (ms)":>11s} {"speedup":>8s} {"max |diff|":>11s}')
+    for xformer in cli.xformers:
+        namespace, args = common.load_args(cli.config, cli.dataset, xformer, batch_size=cli.batch_size, fused_dual=False)
+        two_pass = wrapper.LRADual(namespace, args).to(device)
+        args.fused_dual = True
+        fused = wrapper.LRADual(namespace, args).to(device)
+        fused.load_state_dict(two_pass.state_dict())
+        samples, targets = common.synthetic_batch(args, device, dual=True)
+
+        with torch.no_grad():
+            diff = (two_pass.eval()(*samples) - fused.eval()(*samples)).abs().max().item()
+        separate = step_time(two_pass, samples, targets, cli.steps, device)
+        together = step_time(fused, samples, targets, cli.steps, device)
+        print(f'  {xformer:>14s} {separate * 1e3:16.1f} {together * 1e3:11.1f} {separate / together:7.2f}x {diff:11.2e}')
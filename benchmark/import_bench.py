@@ -0,0 +1,52 @@
+# Startup cost of the lazy encoder registry, measured with python -X importtime.
+#
+#   python -m benchmark.import_bench --xformer converter --runs 5
+#
+# "lazy" imports lra_main and the selected encoder, as lra_main.py --xformer
+# converter now does; "eager" also imports the other eight encoder modules
+# (and einops with them), as model/wrapper.py used to at import time. Every
+# run is a fresh interpreter; the medians are reported.
+
+import sys
+import argparse
+import statistics
+import subprocess
+
+from model import wrapper
+
+
+def get_parameters():
+    parser = argparse.ArgumentParser(description='Encoder import time benchmark')
+    parser.add_argument('--xformer', type=str, default='converter', choices=list(wrapper.ENCODERS), help='Encoder selected with --xformer')
+    parser.add_argument('--runs', type=int, default=5, help='Number of fresh interpreters per variant')
+
+    return parser.parse_args()
+
+
+def import_time(code):
+    """Total self time (s) and number of modules of one interpreter running `code`."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(self_us)
+
+    return sum(times.values()) / 1e6, times
+
+
+if __name__ == '__main__':
+    cli = get_parameters()
+    lazy = f"import lra_main; from model import wrapper; wrapper.encoder_module('{cli.xformer}')"
+    eager = lazy + ''.join(f"; wrapper.encoder_module('{xformer}')" for xformer in wrapper.ENCODERS)
+
+    print(f'lra_main.py --xformer {cli.xformer}, median of {cli.runs} fresh interpreters')
+    print(f'  {"variant":>8s} {"imports (s)":>12s} {"modules":>8s} {"einops":>7s}')
+    medians = {}
+    for variant, code in [('eager', eager), ('lazy', lazy)]:
+        runs = [import_time(code) for _ in range(cli.runs)]
+        medians[variant] = statistics.median(total for total, _ in runs)
+        modules = runs[-1][1]
+        print(f'  {variant:>8s} {medians[variant]:12.3f} {len(modules):8d} {"yes" if "einops" in modules else "no":>7s}')
+    print(f'  startup reduction: {medians["eager"] - medians["lazy"]:.3f} s ({100 * (1 - medians["lazy"] / medians["eager"]):.0f}%)')
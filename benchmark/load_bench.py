@@ -0,0 +1,94 @@
+# Cold-start weight loading: torch.load of a pickle checkpoint vs. the memory-mapped flat format.
+#
+#   python -m benchmark.load_bench --config lra_config.yaml --dataset image --xformer synthesizer
+#
+# Every load runs in a fresh interpreter. The page cache stays warm between
+# runs, so the numbers isolate deserialization and copying from disk reads.
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import tempfile
+import torch
+
+from pathlib import Path
+from benchmark import common
+from model import wrapper
+from utils import memory, weights
+
+
+def get_parameters():
+    parser = argparse.ArgumentParser(description='Weight loading benchmark')
+    parser.add_argument('--config', type=Path, default="lra_config.yaml", help='Path to the yaml configuration file')
+    parser.add_argument('--dataset', type=str, default="image", help='Name of the task section in the config')
+    parser.add_argument('--xformer', type=str, default='converter', help='Type of transformer to use')
+    parser.add_argument('--runs', type=int, default=3, help='Number of fresh processes per format')
+    parser.add_argument('--child', type=str, nargs=2, default=None, metavar=('FORMAT', 'PATH'), help=argparse.SUPPRESS)
+
+    return parser.parse_args()
+
+
+def build_model(cli):
+    namespace, args = common.load_args(cli.config, cli.dataset, cli.xformer)
+    if args.dataset == 'retrieval':
+        return wrapper.LRADual(namespace, args)
+    return wrapper.LRASingle(namespace, args)
+
+
+def child(cli):
+    weights_format, path = cli.child
+    model = build_model(cli)
+    rss_before = memory.process_rss()
+
+    start = time.perf_counter()
+    if weights_format == 'torch':
+        model.load_state_dict(torch.load(path))
+    else:
+        weights.load_into(model, path)
+    load_time = time.perf_counter() - start
+    rss_after = memory.process_rss()
+
+    # reading every weight once pays for the page faults the mapping deferred
+    start = time.perf_counter()
+    checksum = sum(float(tensor.float().sum()) for tensor in model.state_dict().values())
+    touch_time = time.perf_counter() - start
+
+    print(json.dumps({'load_time': load_time, 'touch_time': touch_time,
+                      'rss_delta': rss_after - rss_before, 'checksum': checksum}))
+
+
+if __name__ == '__main__':
+    cli = get_parameters()
+    if cli.child is not None:
+        child(cli)
+        sys.exit(0)
+
+    model = build_model(cli)
+    state_dict = model.state_dict()
+    num_bytes = sum(tensor.numel() * tensor.element_size() for tensor in state_dict.values())
+    print(f'{cli.xformer} on {cli.dataset}: {len(state_dict)} tensors, {common.format_bytes(num_bytes).strip()}')
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = {'torch': os.path.join(directory, 'weights.pt'), 'flat': os.path.join(directory, 'weights.flat')}
+        torch.save(state_dict, paths['torch'])
+        weights.save_flat(state_dict, paths['flat'])
+        del model, state_dict
+
+        print(f'  {"format":8s} {"load":>10s} {"first read":>11s} {"RSS delta":>14s}')
+        checksums = set()
+        for weights_format in ['torch', 'flat']:
+            results = []
+            for _ in range(cli.runs):
+                command = [sys.executable, '-m', 'benchmark.load_bench', '--config', str(cli.config),
+                           '--dataset', cli.dataset, '--xformer', cli.xformer, '--child', weights_format, paths[weights_format]]
+                output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+                results.append(json.loads(output.strip().splitlines()[-1]))
+            best = min(results, key=lambda result: result['load_time'])
+            checksums.add(round(best['checksum'], 3))
+            print(f'  {weights_format:8s} {best["load_time"] * 1e3:8.1f}ms {best["touch_time"] * 1e3:9.1f}ms '
+                  f'{common.format_bytes(best["rss_delta"]):>14s}')
+        if len(checksums) != 1:
+            print('  WARNING: the two formats loaded different weights')
@@ -0,0 +1,87 @@
+# Reformer encoder with the reference LSH attention vs. the fused one, with and without shared buckets.
+#
+#   python -m benchmark.lsh_bench --config ld_config.yaml --dataset longdoc16k --seq_lens 4096 8192 16384
+#
+# All variants start from the same weights and draw the same rotations (the
+# generator is seeded per call), so the fused output matches the reference up
+# to floating-point reordering; the max difference is reported. Shared
+# buckets hash only in the first layer, so their output differs by design.
+
+import time
+import argparse
+import torch
+import torch.nn as nn
+
+from pathlib import Path
+from benchmark import common
+from model import wrapper
+
+VARIANTS = [('reference', 'reference', False), ('fused', 'fused', False), ('fused+shared', 'fused', True)]
+
+
+def get_parameters():
+    parser = argparse.ArgumentParser(description='LSH attention benchmark')
+    parser.add_argument('--config', type=Path, default="ld_config.yaml", help='Path to the yaml configuration file')
+    parser.add_argument('--dataset', type=str, default="longdoc16k", help='Name of the task section in the config')
+    parser.add_argument('--seq_lens', type=int, nargs='+', default=[4096, 8192, 16384], help='Sequence lengths to measure')
+    parser.add_argument('--batch_size', type=int, default=2, help='Override the batch size of the task')
+    parser.add_argument('--steps', type=int, default=3, help='Number of timed passes')
+    parser.add_argument('--cpu', action='store_true', help='Run on CPU even if CUDA is available')
+
+    return parser.parse_args()
+
+
+def timed(fn, steps, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+    return (time.perf_counter() - start) / steps
+
+
+def seeded(device, seed=0):
+    generator = torch.Generator(device=device)
+    generator.manual_seed(seed)
+    return generator
+
+
+if __name__ == '__main__':
+    cli = get_parameters()
+    device = torch.device('cuda' if torch.cuda.is_available() and not cli.cpu else 'cpu')
+    loss_cel = nn.CrossEntropyLoss()
+
+    print(f'{cli.dataset}: batch {cli.batch_size} ({device.type})')
+    print(f'  {"seq_len":>7s} {"variant":>13s} {"forward (ms)":>13s} {"train step (ms)":>16s} {"speedup":>8s} {"max |diff|":>11s}')
+    for seq_len in cli.seq_lens:
+        namespace, args = common.load_args(cli.config, cli.dataset, 'reformer', batch_size=cli.batch_size, max_seq_len=seq_len)
+        samples, targets = common.synthetic_batch(args, device)
+        reference, baseline = None, None
+        for name, lsh_impl, share_buckets in VARIANTS:
+            args.xformer.reformer.lsh_impl = lsh_impl
+            args.xformer.reformer.share_buckets = share_buckets
+            model = wrapper.LRASingle(namespace, args).to(device)
+            if reference is None:
+                state_dict = model.state_dict()
+            else:
+                model.load_state_dict(state_dict)
+
+            def forward_fn():
+                with torch.inference_mode():
+                    return model.eval()(*samples, generator=seeded(device))
+
+            def step_fn():
+                model.train().zero_grad(set_to_none=True)
+                loss_cel(model(*samples, generator=seeded(device)), targets).backward()
+
+            output = forward_fn()
+            reference = output if reference is None else reference
+            forward = timed(forward_fn, cli.steps, device)
+            step = timed(step_fn, cli.steps, device)
+            baseline = baseline or forward
+            diff = (output - reference).abs().max().item()
+            print(f'  {seq_len:7d} {name:>13s} {forward * 1e3:13.1f} {step * 1e3:16.1f} {baseline / forward:7.2f}x {diff:11.2e}')
@@ -0,0 +1,59 @@
+# All-pairs retrieval scoring: LRADual on every pair vs. encoding every document once.
+#
+#   python -m benchmark.pairwise_bench --config lra_config.yaml --dataset retrieval --documents 16 32 64
+#
+# The pair-by-pair baseline runs 2 * N * (N - 1) encoder passes over the
+# ordered pairs; PairwiseScorer runs N, plus the classifier head per pair.
+# The warm run repeats the scoring with every encoding in the LRU cache.
+
+import time
+import argparse
+import itertools
+import torch
+
+from pathlib import Path
+from benchmark import common
+from model import wrapper
+from utils import inference
+
+
+def get_parameters():
+    parser = argparse.ArgumentParser(description='Pairwise scoring benchmark')
+    parser.add_argument('--config', type=Path, default="lra_config.yaml", help='Path to the yaml configuration file')
+    parser.add_argument('--dataset', type=str, default="retrieval", help='Name of the dual task section in the config')
+    parser.add_argument('--xformer', type=str, default='converter', help='Type of transformer to use')
+    parser.add_argument('--documents', type=int, nargs='+', default=[16, 32, 64], help='Document set sizes to score all pairs of')
+
+    return parser.parse_args()
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    cli = get_parameters()
+    namespace, args = common.load_args(cli.config, cli.dataset, cli.xformer)
+    device = torch.device('cpu')
+    model = wrapper.LRADual(namespace, args).eval()
+    predictor = inference.Predictor(model, args.batch_size, device)
+
+    print(f'{cli.xformer} on {cli.dataset}: {args.max_seq_len} tokens per document, batch {args.batch_size}')
+    print(f'  {"docs":>5s} {"pairs":>7s} {"per pair (s)":>13s} {"encode once (s)":>16s} {"warm cache (s)":>15s} {"speedup":>8s}')
+    for num_documents in cli.documents:
+        documents = torch.randint(0, args.vocab_size - 2, (num_documents, args.max_seq_len), dtype=torch.int32)
+        pairs = list(itertools.permutations(range(num_documents), 2))
+        index = torch.tensor(pairs)
+
+        def per_pair():
+            for start in range(0, len(pairs), args.batch_size):
+                part = index[start:start + args.batch_size]
+                predictor(documents[part[:, 0]], documents[part[:, 1]])
+
+        scorer = inference.PairwiseScorer(model, args.batch_size, args.max_seq_len, device, cache_size=num_documents)
+        baseline = timed(per_pair)
+        cold = timed(lambda: scorer.score(documents, pairs))
+        warm = timed(lambda: scorer.score(documents, pairs))
+        print(f'  {num_documents:5d} {len(pairs):7d} {baseline:13.2f} {cold:16.2f} {warm:15.3f} {baseline / cold:7.1f}x')
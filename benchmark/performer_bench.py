@@ -0,0 +1,106 @@
+# Performer encoder with FAVOR+ over the whole sequence vs. streamed over chunks, and the cost of a feature redraw.
+#
+#   python -m benchmark.performer_bench --config ld_config.yaml --dataset longdoc32k --seq_lens 8192 16384 32768 --chunk_size 4096
+#
+# Both variants share the weights and the random features, and the chunked
+# keys subtract the max of the whole sequence, so the outputs match up to
+# floating-point reordering; the max difference is reported. The redraw
+# line compares one QR per orthogonal block with one batched QR for all layers.
+
+import time
+import argparse
+import torch
+import torch.nn as nn
+
+from pathlib import Path
+from benchmark import common
+from model import wrapper
+from model.encoder import performer
+from utils import memory
+
+
+def get_parameters():
+    parser = argparse.ArgumentParser(description='Chunked FAVOR+ benchmark')
+    parser.add_argument('--config', type=Path, default="ld_config.yaml", help='Path to the yaml configuration file')
+    parser.add_argument('--dataset', type=str, default="longdoc32k", help='Name of the task section in the config')
+    parser.add_argument('--seq_lens', type=int, nargs='+', default=[8192, 16384, 32768], help='Sequence lengths to measure')
+    parser.add_argument('--chunk_size', type=int, default=4096, help='Positions per chunk of the streamed variant')
+    parser.add_argument('--batch_size', type=int, default=2, help='Override the batch size of the task')
+    parser.add_argument('--steps', type=int, default=3, help='Number of timed passes')
+    parser.add_argument('--cpu', action='store_true', help='Run on CPU even if CUDA is available')
+
+    return parser.parse_args()
+
+
+def timed(fn, steps, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+    return (time.perf_counter() - start) / steps
+
+
+def step_peak(step_fn, device):
+    tracker = memory.MemoryTracker(device)
+    baseline = torch.cuda.memory_allocated(device) if device.type == 'cuda' else memory.process_rss()
+    with tracker.phase('step'):
+        step_fn()
+
+    return max(tracker.peak('step') - baseline, 0)
+
+
+def redraw_times(model, steps, device):
+    attentions = performer.find_modules(model, performer.PerformerMultiHeadAttention)
+
+    def per_block():
+        for attention in attentions:
+            blocks = torch.stack([performer.orthogonal_matrix_chunk(attention.dim_heads, device=device)
+                                  for _ in range(attention.num_projection_blocks)])
+            attention.redraw_projection_matrix(device, blocks=blocks)
+
+    return timed(per_block, steps, device), timed(lambda: model.xformer.redraw_projection_matrices(device), steps, device)
+
+
+if __name__ == '__main__':
+    cli = get_parameters()
+    device = torch.device('cuda' if torch.cuda.is_available() and not cli.cpu else 'cpu')
+    loss_cel = nn.CrossEntropyLoss()
+
+    print(f'{cli.dataset}: batch {cli.batch_size}, random features fixed while timing ({device.type})')
+    print(f'  {"seq_len":>7s} {"chunk":>6s} {"forward (ms)":>13s} {"train step (ms)":>16s} {"step peak":>14s} {"max |diff|":>11s}')
+    for seq_len in cli.seq_lens:
+        namespace, args = common.load_args(cli.config, cli.dataset, 'performer', batch_size=cli.batch_size, max_seq_len=seq_len)
+        samples, targets = common.synthetic_batch(args, device)
+        reference, state_dict = None, None
+        for chunk_size in [None, cli.chunk_size]:
+            args.xformer.performer.chunk_size = chunk_size
+            model = wrapper.LRASingle(namespace, args).to(device)
+            if state_dict is None:
+                state_dict = model.state_dict()
+            else:
+                model.load_state_dict(state_dict)
+
+            def forward_fn():
+                with torch.inference_mode():
+                    return model.eval()(*samples)
+
+            def step_fn():
+                model.train().zero_grad(set_to_none=True)
+                loss_cel(model(*samples), targets).backward()
+
+            output = forward_fn()
+            reference = output if reference is None else reference
+            forward = timed(forward_fn, cli.steps, device)
+            step = timed(step_fn, cli.steps, device)
+            peak = step_peak(step_fn, device)
+            diff = (output - reference).abs().max().item()
+            print(f'  {seq_len:7d} {str(chunk_size or "-"):>6s} {forward * 1e3:13.1f} {step * 1e3:16.1f} '
+                  f'{common.format_bytes(peak)} {diff:11.2e}')
+
+    looped, batched = redraw_times(model, cli.steps, device)
+    print(f'  redraw of {args.num_block} layers: {looped * 1e3:.2f} ms one QR per block, {batched * 1e3:.2f} ms batched')
@@ -0,0 +1,89 @@
+# Sequence-parallel Kernelution: one training step over a sequence sharded across processes.
+#
+#   torchrun --standalone --nproc_per_node 4 -m benchmark.sequence_parallel_bench \
+#       --config genome_config.yaml --dataset mm --max_seq_len 131072 --check
+#
+# Dropout is off, so with --check every rank also runs the single-process
+# Kernelution on the whole sequence and compares its shard of the output and
+# the summed parameter gradients against it.
+
+import copy
+import time
+import argparse
+import torch
+import torch.distributed as dist
+
+from pathlib import Path
+from benchmark import common
+from model.encoder import converter
+from utils import distributed, memory, sequence_parallel
+
+
+def get_parameters():
+    parser = argparse.ArgumentParser(description='Sequence-parallel Kernelution benchmark')
+    parser.add_argument('--config', type=Path, default="genome_config.yaml", help='Path to the yaml configuration file')
+    parser.add_argument('--dataset', type=str, default="mm", help='Name of the task section in the config')
+    parser.add_argument('--batch_size', type=int, default=None, help='Override the batch size of the task')
+    parser.add_argument('--max_seq_len', type=int, default=None, help='Override the sequence length of the task')
+    parser.add_argument('--steps', type=int, default=3, help='Number of timed training steps')
+    parser.add_argument('--check', action='store_true', help='Compare against the single-process Kernelution')
+
+    return parser.parse_args()
+
+
+def step(module, input, num_elements):
+    module.zero_grad(set_to_none=True)
+    output = module(input)
+    # the local losses add up to the loss of the whole sequence
+    loss = output.abs().pow(2).sum() / num_elements
+    loss.backward()
+
+    return output
+
+
+if __name__ == '__main__':
+    cli = get_parameters()
+    distributed.setup(torch.device('cpu'))
+    if not distributed.is_enabled():
+        raise ValueError('ERROR: Launch the sequence-parallel benchmark with torchrun.')
+
+    namespace, args = common.load_args(cli.config, cli.dataset, batch_size=cli.batch_size, max_seq_len=cli.max_seq_len)
+    # same weights and input on every rank
+    torch.manual_seed(3407)
+    kernelution = converter.ConverterEncoder(args).kernelution
+    kernelution.eval()
+    input = torch.randn(args.batch_size, args.max_seq_len, args.embed_dim)
+    num_elements = args.batch_size * args.max_seq_len * args.embed_dim
+
+    reference = copy.deepcopy(kernelution) if cli.check else None
+    sequence_parallel.apply(kernelution)
+    local_input = sequence_parallel.shard(input)
+
+    step(kernelution, local_input, num_elements)
+    tracker = memory.MemoryTracker(torch.device('cpu'))
+    with tracker.phase('step'):
+        start = time.perf_counter()
+        for _ in range(cli.steps):
+            output = step(kernelution, local_input, num_elements)
+            sequence_parallel.all_reduce_gradients(kernelution)
+        step_time = (time.perf_counter() - start) / cli.steps
+
+    stats = torch.tensor([step_time, float(tracker.peak('step'))], dtype=torch.float64)
+    dist.all_reduce(stats, op=dist.ReduceOp.MAX)
+
+    if reference is not None:
+        full_output = step(reference, input, num_elements)
+        output_error = (output - sequence_parallel.shard(full_output)).abs().max()
+        grad_error = max(float((p.grad - q.grad).abs().max()) for p, q in zip(kernelution.parameters(), reference.parameters())
+                         if p.grad is not None)
+        errors = torch.tensor([float(output_error), grad_error], dtype=torch.float64)
+        dist.all_reduce(errors, op=dist.ReduceOp.MAX)
+
+    if distributed.is_main():
+        print(f'Kernelution on {cli.dataset}: batch {args.batch_size} x {args.max_seq_len} tokens, '
+              f'{distributed.world_size()} ranks x {local_input.size(1)} tokens')
+        print(f'  step time {stats[0].item():9.3f}s   peak memory per rank {common.format_bytes(stats[1].item())}')
+        if reference is not None:
+            print(f'  max abs error: output {errors[0].item():.3e}   gradients {errors[1].item():.3e}')
+
+    distributed.cleanup()
@@ -0,0 +1,107 @@
+# Load generator for serve_main.py: concurrent clients against a local inference server.
+#
+#   python serve_main.py --config genome_config.yaml --dataset mm &
+#   python -m benchmark.serve_bench --config genome_config.yaml --dataset mm --concurrency 1 8 32
+#
+# Every client keeps one HTTP/1.1 connection open and sends its next request
+# as soon as the previous answer arrives (closed loop), so the concurrency is
+# the number of requests the server can batch together.
+
+import json
+import time
+import random
+import asyncio
+import argparse
+
+from pathlib import Path
+from benchmark import common
+from utils import inference
+
+
+def get_parameters():
+    parser = argparse.ArgumentParser(description='Inference server load generator')
+    parser.add_argument('--config', type=Path, default="genome_config.yaml", help='Path to the yaml configuration file of the served model')
+    parser.add_argument('--dataset', type=str, default="mm", help='Name of the task section in the config')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address of the server')
+    parser.add_argument('--port', type=int, default=8000, help='Port of the server')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32], help='Numbers of concurrent clients to measure')
+    parser.add_argument('--requests', type=int, default=256, help='Requests per concurrency level')
+
+    return parser.parse_args()
+
+
+async def call(reader, writer, method, path, payload=None):
+    body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+    writer.write((f'{method} {path} HTTP/1.1\r\nHost: localhost\r\n'
+                  f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n').encode('latin-1') + body)
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    response = json.loads(await reader.readexactly(length))
+    if status != 200:
+        raise RuntimeError(f'ERROR: {method} {path} returned {status}: {response.get("error")}')
+
+    return response
+
+
+def random_request(args, rng):
+    payload = {'tokens': [rng.randrange(args.vocab_size - 2) for _ in range(args.max_seq_len)]}
+    if args.dataset == 'retrieval':
+        payload['tokens_2'] = [rng.randrange(args.vocab_size - 2) for _ in range(args.max_seq_len)]
+    return payload
+
+
+async def client(cli, payloads, latencies):
+    reader, writer = await asyncio.open_connection(cli.host, cli.port)
+    try:
+        while len(payloads) > 0:
+            payload = payloads.pop()
+            start = time.perf_counter()
+            await call(reader, writer, 'POST', '/predict', payload)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+
+async def run_level(cli, args, concurrency):
+    rng = random.Random(concurrency)
+    # a few distinct payloads reused, so generating them does not compete with the clients
+    distinct = [random_request(args, rng) for _ in range(8)]
+    payloads = [distinct[i % len(distinct)] for i in range(cli.requests)]
+    latencies = []
+
+    reader, writer = await asyncio.open_connection(cli.host, cli.port)
+    before = await call(reader, writer, 'GET', '/metrics')
+    start = time.perf_counter()
+    await asyncio.gather(*[client(cli, payloads, latencies) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    after = await call(reader, writer, 'GET', '/metrics')
+    writer.close()
+
+    # the server counters are cumulative, so the level's batches are the difference
+    batch_size = (after['requests'] - before['requests']) / max(1, after['batches'] - before['batches'])
+
+    return len(latencies) / elapsed, latencies, batch_size
+
+
+async def main(cli, args):
+    print(f'{cli.requests} requests per level against http://{cli.host}:{cli.port}')
+    print(f'  {"clients":>7s} {"requests/s":>11s} {"p50 (ms)":>9s} {"p99 (ms)":>9s} {"server batch":>13s}')
+    for concurrency in cli.concurrency:
+        rate, latencies, batch_size = await run_level(cli, args, concurrency)
+        print(f'  {concurrency:7d} {rate:11.1f} {inference.percentile(latencies, 50) * 1e3:9.1f} '
+              f'{inference.percentile(latencies, 99) * 1e3:9.1f} {batch_size:13.1f}')
+
+
+if __name__ == '__main__':
+    cli = get_parameters()
+    _, args = common.load_args(cli.config, cli.dataset)
+    asyncio.run(main(cli, args))
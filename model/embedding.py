@@ -1,9 +1,11 @@
 import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.nn.init as init
 from .norm import ScaleNorm
 from torch import Tensor
+from typing import Optional
 
 
 class SinusoidalPositionEmbedding(nn.Module):
@@ -20,20 +22,48 @@ class SinusoidalPositionEmbedding(nn.Module):
         pe = pe.unsqueeze(0)
         self.register_buffer('pe', pe)
 
-    def forward(self, input: Tensor) -> Tensor:
-        return self.pe[:, :input.size(1)].to(input.device)
+    def forward(self, input: Tensor, start: int = 0) -> Tensor:
+        return self.pe[:, start:start + input.size(1)].to(input.device)
     
 
 class RecurrentPositionEmbedding(nn.Module):
     def __init__(self, embed_dim: int, num_layers: int = 2, drop_rate: float = 0.1) -> None:
         super(RecurrentPositionEmbedding, self).__init__()
         self.gru = nn.GRU(input_size=embed_dim, hidden_size=embed_dim, num_layers=num_layers, batch_first=True, dropout=drop_rate)
+        # set by utils.ensemble: vmap has no batching rule for the fused GRU
+        self.unrolled = False
     
     def forward(self, input: Tensor) -> Tensor:
+        if self.unrolled is True:
+            return self.forward_unrolled(input)
+
         output, _ = self.gru(input)
 
         return output
 
+    def forward_unrolled(self, input: Tensor) -> Tensor:
+        # the nn.GRU recurrence one time step at a time, with the same weights
+        output = input
+        for layer in range(self.gru.num_layers):
+            if layer > 0:
+                output = F.dropout(output, self.gru.dropout, self.training)
+            weight_hh = getattr(self.gru, f'weight_hh_l{layer}')
+            bias_hh = getattr(self.gru, f'bias_hh_l{layer}')
+            gates_input = F.linear(output, getattr(self.gru, f'weight_ih_l{layer}'), getattr(self.gru, f'bias_ih_l{layer}'))
+            hidden = output.new_zeros(output.size(0), self.gru.hidden_size)
+            hiddens = []
+            for t in range(output.size(1)):
+                r_input, z_input, n_input = gates_input[:, t].chunk(3, dim=-1)
+                r_hidden, z_hidden, n_hidden = F.linear(hidden, weight_hh, bias_hh).chunk(3, dim=-1)
+                r = torch.sigmoid(r_input + r_hidden)
+                z = torch.sigmoid(z_input + z_hidden)
+                n = torch.tanh(n_input + r * n_hidden)
+                hidden = (1 - z) * n + z * hidden
+                hiddens.append(hidden)
+            output = torch.stack(hiddens, dim=1)
+
+        return output
+
 
 class Embedding(nn.Module):
     def __init__(self, pe_type, pooling_type, vocab_size, max_seq_len, 
@@ -66,7 +96,10 @@ class Embedding(nn.Module):
         if self.pe_type == 'ape':
             init.normal_(self.pos_embed.weight, mean=0, std=math.sqrt(1 / self.max_seq_len))
 
-    def forward(self, input: Tensor) -> Tensor:
+    def forward(self, input: Tensor, start: int = 0, stop: Optional[int] = None) -> Tensor:
+        # positions [start, stop) of the sequence; the recurrence of rpe also reads the positions before start
+        stop = input.size(1) if stop is None else stop
+        input = input[:, :stop] if self.pe_type == 'rpe' else input[:, start:stop]
         token_embed = self.token_embed(input)
         
         if self.pe_type == 'nope':
@@ -74,18 +107,18 @@ class Embedding(nn.Module):
             embed = token_embed
         elif self.pe_type == 'spe':
             # Sinusoidal Positional Encoding
-            pos_embed = self.pos_embed(token_embed)
+            pos_embed = self.pos_embed(token_embed, start)
             embed = token_embed + pos_embed
         elif self.pe_type == 'ape':
             # Absolute Learnable Position Embedding
-            pos_ids = torch.arange(self.max_seq_len, dtype=torch.long, device=input.device)
-            pos_ids = pos_ids.expand(input.size(0), self.max_seq_len)
+            pos_ids = torch.arange(start, start + input.size(1), dtype=torch.long, device=input.device)
+            pos_ids = pos_ids.expand(input.size(0), input.size(1))
             pos_embed = self.pos_embed(pos_ids)
             embed = token_embed + pos_embed
         elif self.pe_type == 'rpe':
             # Recurrent Position Embedding
             pos_embed = self.pos_embed(token_embed)
-            embed = token_embed + pos_embed
+            embed = (token_embed + pos_embed)[:, start:]
         else:
             raise ValueError(f'ERROR: The Position Embedding {self.pe_type} is not implemented yet.')
 
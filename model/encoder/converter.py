@@ -6,6 +6,7 @@ import torch.nn.init as init
 from torch import Tensor
 from typing import Optional, Union
 from .. import embedding, norm
+from utils import sequence_parallel
 from utils.pscan import pscan
 
 
@@ -117,9 +118,16 @@ class GenerateParameters(nn.Module):
         init.zeros_(self.siren[4].bias)
     
     def forward(self, input: Tensor) -> tuple[Tensor, Tensor, Tensor, Tensor, Tensor, Tensor]:
-        b, n, _ = input.size()
         parameters = self.siren(input)
-        Alpha_l, Beta_l, Gamma_l, Alpha_u, Beta_u, Gamma_u, Theta = self.pool(parameters).view(b, 7 * n).chunk(7, dim=1)
+
+        return self.arrange(self.pool(parameters))
+
+    @staticmethod
+    def arrange(pooled: Tensor) -> tuple[Tensor, Tensor, Tensor, Tensor, Tensor, Tensor]:
+        # the 7 pooled values of every token are laid out over the whole sequence,
+        # so a sequence-parallel caller has to gather them before arranging
+        b, n, _ = pooled.size()
+        Alpha_l, Beta_l, Gamma_l, Alpha_u, Beta_u, Gamma_u, Theta = pooled.view(b, 7 * n).chunk(7, dim=1)
         
         return Alpha_l[:,0:-1], Beta_l[:,0:-1], Gamma_l[:,0:-1], Alpha_u[:,1:n], Beta_u[:,1:n], Gamma_u[:,1:n], Theta
     
@@ -189,6 +197,46 @@ class DHHPTransform(nn.Module):
         return Z
     
 
+def _pad(G: Tensor, left: bool, value: float) -> Tensor:
+    # coefficients of the N-1 neighbouring pairs as one value per position
+    fill = torch.full_like(G[:, :1], value)
+    return torch.cat([fill, G], dim=1) if left else torch.cat([G, fill], dim=1)
+
+
+def sharded_dhhp_transform(X: Tensor, G_l_ii: Tensor, G_l_ij: Tensor, G_l_ji: Tensor, G_l_jj: Tensor, \
+                           G_u_ii: Tensor, G_u_ij: Tensor, G_u_ji: Tensor, G_u_jj: Tensor, \
+                           Diag: Tensor, transform: bool, group=None) -> Tensor:
+    """DHHPTransform (without permutation) of the local shard X of a sequence-parallel input.
+
+    The Givens coefficients cover the whole sequence, Diag only the local
+    positions. Same recurrences as DHHPTransform, written per position:
+        H_u[j] = G_u_ii[j] X[j] + G_u_ij[j] H_u[j+1]          (from the end)
+        Y[j]   = G_u_ji[j-1] X[j-1] + G_u_jj[j-1] H_u[j]
+        H_l[j] = G_l_ji[j-1] H_l[j-1] + G_l_jj[j-1] Y[j]      (from the start)
+        Z[j]   = G_l_ii[j] H_l[j] + G_l_ij[j] Y[j+1]
+    with the out-of-range coefficients chosen so that the boundary rows match.
+    """
+    start, stop = sequence_parallel.bounds(X.size(1), group)
+
+    if transform is False:
+        X = torch.einsum('bn,bnd->bnd', Diag, X)
+
+    H_u = sequence_parallel.scan(_pad(G_u_ij, False, 0.0)[:, start:stop], \
+                                 _pad(G_u_ii, False, 0.0)[:, start:stop].unsqueeze(-1) * X, group, reverse=True)
+    X_prev = torch.cat([sequence_parallel.halo(X[:, -1], -1, group).unsqueeze(1), X[:, :-1]], dim=1)
+    Y = _pad(G_u_ji, True, 0.0)[:, start:stop].unsqueeze(-1) * X_prev + _pad(G_u_jj, True, 1.0)[:, start:stop].unsqueeze(-1) * H_u
+
+    H_l = sequence_parallel.scan(_pad(G_l_ji, True, 0.0)[:, start:stop], \
+                                 _pad(G_l_jj, True, 0.0)[:, start:stop].unsqueeze(-1) * Y, group)
+    Y_next = torch.cat([Y[:, 1:], sequence_parallel.halo(Y[:, 0], 1, group).unsqueeze(1)], dim=1)
+    Z = _pad(G_l_ii, False, 1.0)[:, start:stop].unsqueeze(-1) * H_l + _pad(G_l_ij, False, 0.0)[:, start:stop].unsqueeze(-1) * Y_next
+
+    if transform is True:
+        Z = torch.einsum('bn,bnd->bnd', Diag, Z)
+
+    return Z
+
+
 class InverseDHHPTransform(nn.Module):
     def __init__(self, transform: bool = False, permutation_dim: Optional[int] = None) -> None:
         super(InverseDHHPTransform, self).__init__()
@@ -201,6 +249,11 @@ class InverseDHHPTransform(nn.Module):
 
 
 class KernelPolynomial(nn.Module):
+    # One row per sample; micro-batches and smaller inference batches use a slice of the rows.
+    _batch_shaped_parameters = ('cheb_coef',)
+    # times the rows repeat along the input batch; 2 in LRADual's fused pass over [input1; input2]
+    batch_repeats = 1
+
     def __init__(self, batch_size: int, kernel_type: str = 'none', max_order: int = 2, 
                  mu: int = 3, xi: float = 4.0, 
                  stigma: float = 0.5, heta: int = 2) -> None:
@@ -218,7 +271,8 @@ class KernelPolynomial(nn.Module):
         self.stigma = stigma
         self.heta = heta
         self.cheb_coef = nn.Parameter(torch.empty(batch_size, max_order + 1))
-        self.gibbs_damp = torch.empty(batch_size, max_order + 1)
+        # a constant of the kernel, moved with the module instead of on every forward
+        self.register_buffer('gibbs_damp', torch.empty(batch_size, max_order + 1), persistent=False)
         self.reset_parameters()
 
     def reset_parameters(self) -> None:
@@ -273,17 +327,24 @@ class KernelPolynomial(nn.Module):
             self.gibbs_damp = torch.exp(self.gibbs_damp)
 
     def forward(self, seq: Tensor) -> Tensor:
-        gibbs_damp = self.gibbs_damp.to(seq.device)
+        # all rows of gibbs_damp are identical, so any batch can use the leading ones;
+        # a smaller batch (e.g. at inference) uses the leading rows of cheb_coef
+        rows = seq.size(0) // self.batch_repeats
+        gibbs_damp = self.gibbs_damp[:rows]
+        cheb_coef = self.cheb_coef[:rows]
+        if self.batch_repeats > 1:
+            gibbs_damp = gibbs_damp.repeat(self.batch_repeats, 1)
+            cheb_coef = cheb_coef.repeat(self.batch_repeats, 1)
 
         # Tx_0 = 1
         Tx_0 = torch.ones_like(seq)
-        ChebGibbs = Tx_0 * self.cheb_coef[:, 0].unsqueeze(1)
+        ChebGibbs = Tx_0 * cheb_coef[:, 0].unsqueeze(1)
         if self.max_order == 0:
             return ChebGibbs
 
         # Tx_1 = x
         Tx_1 = seq
-        ChebGibbs = ChebGibbs + Tx_1 * self.cheb_coef[:, 1].unsqueeze(1) * gibbs_damp[:, 1].unsqueeze(1)
+        ChebGibbs = ChebGibbs + Tx_1 * cheb_coef[:, 1].unsqueeze(1) * gibbs_damp[:, 1].unsqueeze(1)
         if self.max_order == 1:
             return ChebGibbs
 
@@ -291,7 +352,7 @@ class KernelPolynomial(nn.Module):
             for k in range(2, self.max_order + 1):
                 # Tx_2 = 2 * x * Tx_1 - Tx_0 
                 Tx_2 = 2.0 * seq * Tx_1 - Tx_0
-                ChebGibbs = ChebGibbs + Tx_2 * self.cheb_coef[:, k].unsqueeze(1) * gibbs_damp[:, k].unsqueeze(1)
+                ChebGibbs = ChebGibbs + Tx_2 * cheb_coef[:, k].unsqueeze(1) * gibbs_damp[:, k].unsqueeze(1)
                 Tx_0, Tx_1 = Tx_1, Tx_2
 
         return ChebGibbs
@@ -321,6 +382,9 @@ class Kernelution(nn.Module):
             permutation_dim = None
         self.dhhp_transform = DHHPTransform(True, permutation_dim)
         self.inverse_dhhp_transform = InverseDHHPTransform(False, permutation_dim)
+        # set by utils.sequence_parallel.apply; the input is then the local shard
+        self.sequence_parallel = False
+        self.sequence_group = None
 
         self.reset_parameters()
 
@@ -329,6 +393,9 @@ class Kernelution(nn.Module):
         init.normal_(self.value_linear_imag.weight, mean=0.0, std=math.sqrt(0.5))
 
     def forward(self, input: Tensor) -> Tensor:
+        if self.sequence_parallel is True:
+            return self.forward_sharded(input)
+
         # Hyperparameters for 1-DHHP
         Alpha_l, Beta_l, Gamma_l, Alpha_u, Beta_u, Gamma_u, Theta = self.givens_parameters(input)
         G_l_ii, G_l_ij, G_l_ji, G_l_jj, G_l_ii_conj_trs, G_l_ij_conj_trs, G_l_ji_conj_trs, G_l_jj_conj_trs = gengerate_dhhp_parameters(Alpha_l, Beta_l, Gamma_l)
@@ -357,6 +424,42 @@ class Kernelution(nn.Module):
                                                             G_l_ii_conj_trs, G_l_ij_conj_trs, G_l_ji_conj_trs, G_l_jj_conj_trs, Diag_conj_trs)
         
         return unitary_conv_1d_inverse
+
+    def forward_sharded(self, input: Tensor) -> Tensor:
+        group = self.sequence_group
+        start, stop = sequence_parallel.bounds(input.size(1), group)
+
+        # Hyperparameters for 1-DHHP, over the whole sequence (7 values per token)
+        pooled = self.givens_parameters.pool(self.givens_parameters.siren(input))
+        Alpha_l, Beta_l, Gamma_l, Alpha_u, Beta_u, Gamma_u, Theta = GenerateParameters.arrange(sequence_parallel.unshard(pooled, group))
+        G_l_ii, G_l_ij, G_l_ji, G_l_jj, G_l_ii_conj_trs, G_l_ij_conj_trs, G_l_ji_conj_trs, G_l_jj_conj_trs = gengerate_dhhp_parameters(Alpha_l, Beta_l, Gamma_l)
+        G_u_ii, G_u_ij, G_u_ji, G_u_jj, G_u_ii_conj_trs, G_u_ij_conj_trs, G_u_ji_conj_trs, G_u_jj_conj_trs = gengerate_dhhp_parameters(Alpha_u, Beta_u, Gamma_u)
+        Diag = torch.exp(2j * math.pi * Theta[:, start:stop])
+        Diag_conj_trs = Diag.conj()
+
+        # Eigenvalues
+        seq_eigenvalue = self.seq_eigenvalue(input)
+        if self.enable_kpm is True:
+            seq_cheb_eigenvalue = self.seq_kernel_poly(seq_eigenvalue)
+        else:
+            seq_cheb_eigenvalue = seq_eigenvalue
+        digraph_conv_eigenvalue = torch.exp(1j * seq_cheb_eigenvalue)
+
+        # Value
+        value_real = self.value_linear_real(input)
+        value_imag = self.value_linear_imag(input)
+        value = torch.complex(value_real, value_imag)
+        value = self.value_dropout(value)
+
+        # Kernerlution
+        unitary_conv_1d_forward = sharded_dhhp_transform(value, G_l_ii, G_l_ij, G_l_ji, G_l_jj, G_u_ii, G_u_ij, G_u_ji, G_u_jj, \
+                                                         Diag, True, group)
+        unitary_conv_1d = torch.einsum('bn,bnd->bnd', digraph_conv_eigenvalue, unitary_conv_1d_forward)
+        unitary_conv_1d_inverse = sharded_dhhp_transform(unitary_conv_1d, G_l_ii_conj_trs, G_l_ij_conj_trs, G_l_ji_conj_trs, G_l_jj_conj_trs, \
+                                                         G_u_ii_conj_trs, G_u_ij_conj_trs, G_u_ji_conj_trs, G_u_jj_conj_trs, \
+                                                         Diag_conj_trs, False, group)
+
+        return unitary_conv_1d_inverse
     
 
 class GatedFeedForward(nn.Module):
@@ -425,7 +528,12 @@ class ConverterEncoder(nn.Module):
     def forward(self, input: Tensor) -> Tensor:
         alpha = torch.clamp(self.alpha, min=0.0, max=1.0).to(input.device)
         
-        embed = self.embedding(input)
+        if self.kernelution.sequence_parallel is True:
+            # only the positions of the local shard are embedded, and everything after runs on them
+            start, stop = sequence_parallel.shard_bounds(input.size(1), self.kernelution.sequence_group)
+            embed = self.embedding(input, start, stop)
+        else:
+            embed = self.embedding(input)
 
         kernelution = self.kernelution(embed) + embed
         kernelution_normed = self.kernelution_norm(kernelution)
@@ -4,15 +4,12 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.nn.init as init
 from contextlib import contextmanager
-from distutils.version import LooseVersion
-from einops import repeat
 from functools import partial
 from torch import Tensor
+from torch.utils.checkpoint import checkpoint
 from .. import embedding
 
 
-TORCH_GE_1_8_0 = LooseVersion(torch.__version__) >= LooseVersion('1.8.0')
-
 # helper functions
 
 def exists(val):
@@ -75,17 +72,15 @@ class PreShiftTokens(nn.Module):
     
 # kernel functions
 
-def softmax_kernel(data, *, projection_matrix, is_query, normalize_data=True, eps=1e-4, device = None):
-    b, h, *_ = data.shape
-
+def softmax_kernel(data, *, projection_matrix, is_query, normalize_data=True, eps=1e-4, device = None, stabilizer = None):
     data_normalizer = (data.shape[-1] ** -0.25) if normalize_data else 1.
 
     ratio = (projection_matrix.shape[0] ** -0.5)
 
-    projection = repeat(projection_matrix, 'j d -> b h j d', b = b, h = h)
-    projection = projection.type_as(data)
+    # the normalizer is folded into the (nb_features x dim_heads) projection instead of the data
+    projection = (data_normalizer * projection_matrix).type_as(data)
 
-    data_dash = torch.einsum('...id,...jd->...ij', (data_normalizer * data), projection)
+    data_dash = torch.matmul(data, projection.t())
 
     diag_data = data ** 2
     diag_data = torch.sum(diag_data, dim=-1)
@@ -97,54 +92,53 @@ def softmax_kernel(data, *, projection_matrix, is_query, normalize_data=True, ep
             torch.exp(data_dash - diag_data -
                     torch.amax(data_dash, dim=-1, keepdim=True).detach()) + eps)
     else:
+        if stabilizer is None:
+            stabilizer = torch.amax(data_dash, dim=(-1, -2), keepdim=True).detach()
         data_dash = ratio * (
-            torch.exp(data_dash - diag_data - torch.amax(data_dash, dim=(-1, -2), keepdim=True).detach()) + eps)
+            torch.exp(data_dash - diag_data - stabilizer) + eps)
 
     return data_dash.type_as(data)
 
-def generalized_kernel(data, *, projection_matrix, kernel_fn = nn.ReLU(), kernel_epsilon = 0.001, normalize_data = True, device = None):
-    b, h, *_ = data.shape
+@torch.no_grad()
+def softmax_kernel_stabilizer(data, *, projection_matrix, chunk_size, normalize_data=True):
+    # the max softmax_kernel subtracts from the key features, taken chunk by chunk
+    data_normalizer = (data.shape[-1] ** -0.25) if normalize_data else 1.
+    projection = (data_normalizer * projection_matrix).type_as(data).t()
+
+    chunk_max = [torch.matmul(chunk, projection).amax(dim=(-1, -2)) for chunk in data.split(chunk_size, dim=-2)]
+    return torch.stack(chunk_max).amax(dim=0)[..., None, None]
 
+def generalized_kernel(data, *, projection_matrix, kernel_fn = nn.ReLU(), kernel_epsilon = 0.001, normalize_data = True, device = None):
     data_normalizer = (data.shape[-1] ** -0.25) if normalize_data else 1.
 
     if projection_matrix is None:
         return kernel_fn(data_normalizer * data) + kernel_epsilon
 
-    projection = repeat(projection_matrix, 'j d -> b h j d', b = b, h = h)
-    projection = projection.type_as(data)
+    projection = (data_normalizer * projection_matrix).type_as(data)
 
-    data_dash = torch.einsum('...id,...jd->...ij', (data_normalizer * data), projection)
+    data_dash = torch.matmul(data, projection.t())
 
     data_prime = kernel_fn(data_dash) + kernel_epsilon
     return data_prime.type_as(data)
 
-def orthogonal_matrix_chunk(cols, device = None):
-    unstructured_block = torch.randn((cols, cols), device = device)
-    if TORCH_GE_1_8_0:
-        q, r = torch.linalg.qr(unstructured_block.cpu(), mode = 'reduced')
-    else:
-        q, r = torch.qr(unstructured_block.cpu(), some = True)
-    q, r = map(lambda t: t.to(device), (q, r))
-    return q.t()
-
-def gaussian_orthogonal_random_matrix(nb_rows, nb_columns, scaling = 0, device = None):
-    nb_full_blocks = int(nb_rows / nb_columns)
+def orthogonal_matrix_blocks(num_blocks, cols, device = None, generator = None):
+    # one batched QR for all blocks instead of one factorization (and transfer) per block
+    unstructured_block = torch.randn((num_blocks, cols, cols), generator = generator)
+    q, r = torch.linalg.qr(unstructured_block, mode = 'reduced')
+    return q.transpose(-2, -1).to(device)
 
-    block_list = []
-
-    for _ in range(nb_full_blocks):
-        q = orthogonal_matrix_chunk(nb_columns, device = device)
-        block_list.append(q)
+def orthogonal_matrix_chunk(cols, device = None):
+    return orthogonal_matrix_blocks(1, cols, device = device)[0]
 
-    remaining_rows = nb_rows - nb_full_blocks * nb_columns
-    if remaining_rows > 0:
-        q = orthogonal_matrix_chunk(nb_columns, device = device)
-        block_list.append(q[:remaining_rows])
+def gaussian_orthogonal_random_matrix(nb_rows, nb_columns, scaling = 0, device = None, blocks = None, generator = None):
+    if blocks is None:
+        blocks = orthogonal_matrix_blocks(math.ceil(nb_rows / nb_columns), nb_columns, device = device, generator = generator)
 
-    final_matrix = torch.cat(block_list)
+    # the full blocks, then the first rows of the last one
+    final_matrix = blocks.flatten(0, 1)[:nb_rows]
 
     if scaling == 0:
-        multiplier = torch.randn((nb_rows, nb_columns), device = device).norm(dim = 1)
+        multiplier = torch.randn((nb_rows, nb_columns), generator = generator).norm(dim = 1).to(device)
     elif scaling == 1:
         multiplier = math.sqrt((float(nb_columns))) * torch.ones((nb_rows,), device = device)
     else:
@@ -159,6 +153,31 @@ def linear_attention(q, k, v):
     out = torch.einsum('...de,...nd,...n->...ne', context, q, D_inv)
     return out
 
+def chunked_linear_attention(q, k, v, query_kernel, key_kernel, chunk_size):
+    # linear_attention(query_kernel(q), key_kernel(k), v), with the k^T v context and the
+    # normalizer accumulated over chunks of the sequence, so no (length x nb_features)
+    # map exists at once; with gradients every chunk recomputes its features in backward
+    if torch.is_grad_enabled():
+        run = partial(checkpoint, use_reentrant = False)
+    else:
+        run = lambda fn, *args: fn(*args)
+
+    def key_context(k, v):
+        k = key_kernel(k)
+        return torch.einsum('...nd,...ne->...de', k, v), k.sum(dim = -2)
+
+    def query_output(q, context, k_cumsum):
+        q = query_kernel(q)
+        D_inv = 1. / torch.einsum('...nd,...d->...n', q, k_cumsum.type_as(q))
+        return torch.einsum('...de,...nd,...n->...ne', context, q, D_inv)
+
+    context, k_cumsum = 0, 0
+    for k_chunk, v_chunk in zip(k.split(chunk_size, dim = -2), v.split(chunk_size, dim = -2)):
+        context_chunk, k_cumsum_chunk = run(key_context, k_chunk, v_chunk)
+        context, k_cumsum = context + context_chunk, k_cumsum + k_cumsum_chunk
+
+    return torch.cat([run(query_output, q_chunk, context, k_cumsum) for q_chunk in q.split(chunk_size, dim = -2)], dim = -2)
+
 class PerformerMultiHeadAttention(nn.Module):
     def __init__(self, 
                  feat_dim: int,
@@ -168,12 +187,18 @@ class PerformerMultiHeadAttention(nn.Module):
                  kernel_fn: str = 'relu', 
                  no_projection: bool = False,
                  value_drop_prob: float = 0.1,
+                 chunk_size: int = None,
                  ):
         super(PerformerMultiHeadAttention, self).__init__()
-        dim_heads = feat_dim // num_heads
-        self.nb_features = int(dim_heads * math.log(dim_heads))
-
-        self.create_projection = partial(gaussian_orthogonal_random_matrix, nb_rows = self.nb_features, nb_columns = dim_heads, scaling = ortho_scaling)
+        assert feat_dim % num_heads == 0, 'feat_dim should be divisible by num_heads'
+        self.feat_dim = feat_dim
+        self.num_heads = num_heads
+        self.dim_heads = feat_dim // num_heads
+        self.nb_features = int(self.dim_heads * math.log(self.dim_heads))
+        # positions per chunk of the streamed context, None for the whole sequence at once
+        self.chunk_size = chunk_size
+
+        self.create_projection = partial(gaussian_orthogonal_random_matrix, nb_rows = self.nb_features, nb_columns = self.dim_heads, scaling = ortho_scaling)
         projection_matrix = self.create_projection()
         self.register_buffer('projection_matrix', projection_matrix)
 
@@ -202,30 +227,51 @@ class PerformerMultiHeadAttention(nn.Module):
         init.xavier_uniform_(self.value_linear.weight, gain=1.0)
         init.xavier_uniform_(self.output_linear.weight, gain=1.0)
 
+    @property
+    def num_projection_blocks(self) -> int:
+        return math.ceil(self.nb_features / self.dim_heads)
+
     @torch.no_grad()
-    def redraw_projection_matrix(self, device):
-        projections = self.create_projection(device = device)
+    def redraw_projection_matrix(self, device, blocks = None, generator = None):
+        projections = self.create_projection(device = device, blocks = blocks, generator = generator)
         self.projection_matrix.copy_(projections)
         del projections
 
+    def split_head(self, input: Tensor) -> Tensor:
+        batch_size, seq_len, _ = input.size()
+        return input.contiguous().view(batch_size, seq_len, self.num_heads, self.dim_heads).permute(0, 2, 1, 3)
+
+    def concat_head(self, input: Tensor) -> Tensor:
+        batch_size, _, seq_len, _ = input.size()
+        return input.permute(0, 2, 1, 3).contiguous().view(batch_size, seq_len, self.feat_dim)
+
     def forward(self, input : Tensor) -> Tensor:
         q, k, v = self.query_linear(input), self.key_linear(input), self.value_linear(input)
         v = self.value_dropout(v)
+        q, k, v = map(self.split_head, (q, k, v))
+        # [batch, head, length, dim_heads]
 
+        chunk_size = self.chunk_size or q.size(-2)
         if self.no_projection:
-            q = q.softmax(dim = -1)
-            k = k.softmax(dim = -2)
-        elif self.generalized_attention:
-            create_kernel = partial(generalized_kernel, kernel_fn = self.kernel_fn, projection_matrix = self.projection_matrix, device = input.device)
-            q, k = map(create_kernel, (q, k))
+            # the features are as wide as the heads, so there is nothing to stream
+            out = linear_attention(q.softmax(dim = -1), k.softmax(dim = -2), v)
         else:
-            create_kernel = partial(softmax_kernel, projection_matrix = self.projection_matrix, device = input.device)
-            q = create_kernel(q, is_query = True)
-            k = create_kernel(k, is_query = False)
-
-        attn_fn = linear_attention
-        out = attn_fn(q, k, v)
-        return out
+            if self.generalized_attention:
+                query_kernel = key_kernel = partial(generalized_kernel, kernel_fn = self.kernel_fn, projection_matrix = self.projection_matrix)
+            else:
+                query_kernel = partial(softmax_kernel, projection_matrix = self.projection_matrix, is_query = True)
+                stabilizer = None
+                if chunk_size < k.size(-2):
+                    # every chunk of keys has to subtract the max of the whole sequence
+                    stabilizer = softmax_kernel_stabilizer(k, projection_matrix = self.projection_matrix, chunk_size = chunk_size)
+                key_kernel = partial(softmax_kernel, projection_matrix = self.projection_matrix, is_query = False, stabilizer = stabilizer)
+
+            if chunk_size < q.size(-2):
+                out = chunked_linear_attention(q, k, v, query_kernel, key_kernel, chunk_size)
+            else:
+                out = linear_attention(query_kernel(q), key_kernel(k), v)
+
+        return self.output_linear(self.concat_head(out))
     
 
 class PreLayerNorm(nn.Module):
@@ -273,9 +319,28 @@ class PerformerEncoder(nn.Module):
         self.performer_encoder_block = nn.ModuleList([])
         for _ in range(args.num_block):
             self.performer_encoder_block.append(nn.ModuleList([
-                PreLayerNorm(args.embed_dim, PerformerMultiHeadAttention(args.embed_dim, args.num_head, args.xformer.performer.ortho_scaling, args.xformer.performer.kernel_func, args.xformer.performer.no_projection, args.value_drop_prob)),
+                PreLayerNorm(args.embed_dim, PerformerMultiHeadAttention(args.embed_dim, 
+                                                                         args.num_head, 
+                                                                         ortho_scaling=args.xformer.performer.ortho_scaling, 
+                                                                         generalized_attention=args.xformer.performer.generalized_attention, 
+                                                                         kernel_fn=args.xformer.performer.kernel_func, 
+                                                                         no_projection=args.xformer.performer.no_projection, 
+                                                                         value_drop_prob=args.value_drop_prob, 
+                                                                         chunk_size=args.xformer.performer.chunk_size)),
                 PreLayerNorm(args.embed_dim, FeedForwardNetwork(args.embed_dim, args.hidden_dim, args.ffn_drop_prob))
             ]))
+        # optimizer steps between redraws of the random features, None keeps them; the
+        # Trainer redraws them after the step, so inference never writes to the module
+        self.feature_redraw_interval = args.xformer.performer.feature_redraw_interval
+
+    @torch.no_grad()
+    def redraw_projection_matrices(self, device, generator = None) -> None:
+        # the orthogonal blocks of every layer come from one batched QR
+        attentions = find_modules(self, PerformerMultiHeadAttention)
+        num_blocks = [attention.num_projection_blocks for attention in attentions]
+        blocks = orthogonal_matrix_blocks(sum(num_blocks), attentions[0].dim_heads, device = device, generator = generator)
+        for attention, block in zip(attentions, blocks.split(num_blocks)):
+            attention.redraw_projection_matrix(device, blocks = block, generator = generator)
 
     def forward(self, input: Tensor) -> Tensor:
         input = self.embedding(input)
@@ -9,17 +9,21 @@ from .. import embedding
 
 
 def deterministic_dropout(x: Tensor, seed=0, dropout=0):
-    torch.manual_seed(seed)
-    return F.dropout(x, p=dropout, training=True)
+    # a local generator, so the global RNG state is left untouched
+    generator = torch.Generator(device=x.device)
+    generator.manual_seed(seed)
+    mask = torch.empty_like(x).bernoulli_(1 - dropout, generator=generator)
+    return x * mask / (1 - dropout)
 
 
-def look_back(input_tensor: Tensor) -> Tensor:
+def look_back(input_tensor: Tensor, dim: int = 1) -> Tensor:
     '''
-    Looks back one bucket
+    Looks back one bucket along dim (the bucket positions follow in dim + 1)
     '''
-    shift = torch.cat([input_tensor[:, -1:], input_tensor[:, :-1]], dim=1)
+    n_buckets = input_tensor.size(dim)
+    shift = torch.cat([input_tensor.narrow(dim, n_buckets - 1, 1), input_tensor.narrow(dim, 0, n_buckets - 1)], dim=dim)
     # [batch * head, n_buckets, bucket_length, d_k, rounds]
-    concat = torch.cat([shift, input_tensor], dim=2)
+    concat = torch.cat([shift, input_tensor], dim=dim + 1)
     # [batch * head, n_buckets, bucket_length * 2, d_k, rounds]
     return concat
 
@@ -80,28 +84,27 @@ def top_p_sample(prob: Tensor, perc=0.5) -> np.array:
 class LocalitySensitiveHash(nn.Module):
     '''
     Implements Locality Sensitive Hash
-    class is used to save random matrix used for hashing
+    the random rotations are drawn on every call from `generator` (the
+    global RNG if None) and not kept, so the forward has no side effects
     '''
     def __init__(self, d_model, head, rounds):
         super(LocalitySensitiveHash, self).__init__()
         self.d_k = d_model // head
         self.rounds = rounds
-        self.rand_matrix = None
 
-    def forward(self, inp: Tensor, n_buckets=0, random=True):
-        batch_size = inp.size(0)
+    def rotations(self, batch_size, n_buckets, inp: Tensor, generator=None) -> Tensor:
+        rand_matrix = torch.randn(
+            [batch_size, self.d_k, self.rounds, n_buckets // 2],
+            generator=generator, device=inp.device, dtype=inp.dtype
+        )
+        # [batch * head, d_k, rounds, n_buckets // 2]
+        return rand_matrix / torch.norm(rand_matrix, dim=1, keepdim=True)
+
+    def hash(self, inp: Tensor, rand_matrix: Tensor) -> Tensor:
         length = inp.size(1)
         inp = F.normalize(inp, p=2, dim=-1)
         # [batch * head, length, d_k]
-        if random:
-            self.rand_matrix = torch.randn(
-                [batch_size, self.d_k, self.rounds, n_buckets // 2],
-                device=inp.get_device()
-            )
-            # [batch * head, d_k, rounds, n_buckets // 2]
-            self.rand_matrix /= torch.norm(self.rand_matrix, dim=1, keepdim=True)
-            # [batch * head, d_k, rounds, n_buckets // 2]
-        matmul = torch.einsum('...ij,...jkl->...ikl', inp, self.rand_matrix)
+        matmul = torch.einsum('...ij,...jkl->...ikl', inp, rand_matrix)
         # [batch * head, length, rounds, n_buckets // 2]
         hashes = torch.argmax(torch.cat([matmul, -matmul], dim=-1), dim=-1).int()
         # [batch * head, length, rounds]
@@ -111,6 +114,9 @@ class LocalitySensitiveHash(nn.Module):
         # [batch * head, length, rounds]
         return hashes
 
+    def forward(self, inp: Tensor, n_buckets=0, generator=None):
+        return self.hash(inp, self.rotations(inp.size(0), n_buckets, inp, generator))
+
 class LSHAttention(nn.Module):
     '''
     Implements LSHAttention
@@ -124,11 +130,11 @@ class LSHAttention(nn.Module):
         self.bucket_length = bucket_length
         self.lsh = LocalitySensitiveHash(d_model, head, rounds)
 
-    def forward(self, query, value, seed, random=True):
+    def forward(self, query, value, generator=None):
         length = query.size(1)
         n_buckets = length // self.bucket_length
 
-        sorted_hashes, hash_indice = torch.sort(self.lsh(query, n_buckets, random), dim=1)
+        sorted_hashes, hash_indice = torch.sort(self.lsh(query, n_buckets, generator), dim=1)
         # [batch * head, length, rounds]
         original_indice = reverse_sort(hash_indice, dim=1)
         # [batch * head, length, rounds]
@@ -230,25 +236,157 @@ class LSHAttention(nn.Module):
 
         return attention
 
+class FusedLSHAttention(LSHAttention):
+    '''
+    LSHAttention over all batch * head rows at once, with the rounds as a
+    batch dimension instead of a trailing one: one sort covers every round,
+    rows are reordered with one index_select instead of expanded gathers,
+    and the duplicate keys are counted from the bucket each key falls in
+    per round instead of from a sort of every key list. The bucket scores
+    are computed num_chunk ranges of buckets at a time.
+
+    The rotations are drawn per chunk of rows as MultiRoundLSHAttention
+    draws them for LSHAttention, so for the same generator both give the
+    same output. With a `buckets` dict, the hashing of the first call is
+    kept in it and reused by the following calls (e.g. the other layers).
+    '''
+    def __init__(self, d_model, head, chunk, rounds, droprate, bucket_length):
+        super(FusedLSHAttention, self).__init__(d_model, head, rounds, droprate, bucket_length)
+        self.chunk = chunk
+
+    def bucket_ranges(self, n_buckets):
+        step = math.ceil(n_buckets / self.chunk)
+        return [(start, min(start + step, n_buckets)) for start in range(0, n_buckets, step)]
+
+    def hash_buckets(self, query, generator=None):
+        rows, length = query.size(0), query.size(1)
+        n_buckets = length // self.bucket_length
+        step = math.ceil(rows / self.chunk)
+        rand_matrix = torch.cat([
+            self.lsh.rotations(min(step, rows - start), n_buckets, query, generator) for start in range(0, rows, step)
+        ], dim=0)
+        # [batch * head, d_k, rounds, n_buckets // 2]
+
+        sorted_hashes, hash_indice = torch.sort(self.lsh.hash(query, rand_matrix).transpose(1, 2), dim=-1)
+        # [batch * head, rounds, length]
+        original_indice = reverse_sort(hash_indice, dim=-1)
+        # [batch * head, rounds, length]
+        row_offset = torch.arange(rows, device=query.device).view(-1, 1, 1) * length
+        gather_indice = (hash_indice + row_offset).flatten()
+        # [batch * head * rounds * length], rows of query in bucket order
+        round_offset = torch.arange(rows * self.rounds, device=query.device).view(rows, self.rounds, 1) * length
+        scatter_indice = (original_indice + round_offset).flatten()
+        # [batch * head * rounds * length], rows of the bucket order in the original order
+
+        shape = (rows, self.rounds, n_buckets, self.bucket_length)
+        query_bucket = (sorted_hashes // length).reshape(shape)
+        query_indice = hash_indice.reshape(shape)
+        # [batch * head, rounds, n_buckets, bucket_length]
+
+        # the bucket of every position in every round; key j is in the window of query i
+        # in round r iff its bucket is the one of i, or the one before
+        position_bucket = (original_indice // self.bucket_length).int().transpose(1, 2).flatten(0, 1)
+        # [batch * head * length, rounds]
+        query_position_bucket = position_bucket.index_select(0, gather_indice).reshape(shape + (self.rounds,))
+        # [batch * head, rounds, n_buckets, bucket_length, rounds]
+        key_position_bucket = look_back(query_position_bucket, dim=2)
+        # [batch * head, rounds, n_buckets, bucket_length * 2, rounds]
+        count_key = []
+        for start, end in self.bucket_ranges(n_buckets):
+            count = 0
+            for r in range(self.rounds):
+                offset = (query_position_bucket[:, :, start:end, :, None, r] - key_position_bucket[:, :, start:end, None, :, r]) % n_buckets
+                count = count + (offset == 0).byte() + (offset == 1 % n_buckets).byte()
+            count_key.append(count)
+        # [batch * head, rounds, n_buckets, bucket_length, bucket_length * 2]
+
+        return {
+            'gather_indice': gather_indice,
+            'scatter_indice': scatter_indice,
+            'query_bucket': query_bucket,
+            'key_bucket': look_back(query_bucket, dim=2),
+            'query_indice': query_indice,
+            'key_indice': look_back(query_indice, dim=2),
+            'count_key': torch.cat(count_key, dim=2)
+        }
+
+    def forward(self, query, value, generator=None, buckets=None):
+        rows, length = query.size(0), query.size(1)
+        n_buckets = length // self.bucket_length
+        if buckets is not None and len(buckets) > 0:
+            hashed = buckets
+        else:
+            hashed = self.hash_buckets(query, generator)
+            if buckets is not None:
+                buckets.update(hashed)
+
+        shape = (rows, self.rounds, n_buckets, self.bucket_length, self.d_k)
+        reordered_query = query.flatten(0, 1).index_select(0, hashed['gather_indice']).reshape(shape)
+        # [batch * head, rounds, n_buckets, bucket_length, d_k]
+        lookback_key = F.normalize(look_back(reordered_query, dim=2), p=2, dim=-1)
+        # [batch * head, rounds, n_buckets, bucket_length * 2, d_k]
+        lookback_value = look_back(value.flatten(0, 1).index_select(0, hashed['gather_indice']).reshape(shape), dim=2)
+        # [batch * head, rounds, n_buckets, bucket_length * 2, d_k]
+
+        attention, logsumexp_qk = [], []
+        for start, end in self.bucket_ranges(n_buckets):
+            matmul_qk = torch.matmul(
+                reordered_query[:, :, start:end], lookback_key[:, :, start:end].transpose(-2, -1)
+            ) / math.sqrt(self.d_k)
+            # [batch * head, rounds, chunk_buckets, bucket_length, bucket_length * 2]
+            query_bucket = hashed['query_bucket'][:, :, start:end, :, None]
+            key_bucket = hashed['key_bucket'][:, :, start:end, None, :]
+            query_indice = hashed['query_indice'][:, :, start:end, :, None]
+            key_indice = hashed['key_indice'][:, :, start:end, None, :]
+            matmul_qk.masked_fill_(mask=(query_bucket != key_bucket) | (query_indice < key_indice), value=-1e9)
+            matmul_qk.masked_fill_(mask=(query_indice == key_indice), value=-1e5)
+
+            logsumexp_chunk = torch.logsumexp(matmul_qk, dim=-1)
+            # [batch * head, rounds, chunk_buckets, bucket_length]
+            count_key = hashed['count_key'][:, :, start:end].float().log_()
+            softmax_qk = torch.exp(matmul_qk - count_key - logsumexp_chunk[..., None])
+            # [batch * head, rounds, chunk_buckets, bucket_length, bucket_length * 2]
+
+            if self.training:
+                softmax_qk = self.dropout(softmax_qk)
+
+            attention.append(torch.matmul(softmax_qk, lookback_value[:, :, start:end]))
+            # [batch * head, rounds, chunk_buckets, bucket_length, d_k]
+            logsumexp_qk.append(logsumexp_chunk)
+
+        attention = torch.cat(attention, dim=2).reshape(-1, self.d_k).index_select(0, hashed['scatter_indice'])
+        attention = attention.reshape(rows, self.rounds, length, self.d_k)
+        # [batch * head, rounds, length, d_k]
+        logsumexp_qk = torch.cat(logsumexp_qk, dim=2).flatten().index_select(0, hashed['scatter_indice'])
+        logsumexp_qk = F.softmax(logsumexp_qk.reshape(rows, self.rounds, length), dim=-1)
+        # [batch * head, rounds, length], normalized over the length as in LSHAttention
+
+        attention = torch.einsum('brld,brl->bld', attention, logsumexp_qk)
+        # [batch * head, length, d_k]
+
+        return attention
+
 class MultiRoundLSHAttention(nn.Module):
     '''
     Implements Multi Round LSH Attention
     class is defined to save LSHAttention
     '''
-    def __init__(self, d_model, head, chunk, rounds, droprate, bucket_length):
+    def __init__(self, d_model, head, chunk, rounds, droprate, bucket_length, lsh_impl='reference'):
         super(MultiRoundLSHAttention, self).__init__()
+        assert lsh_impl in ['reference', 'fused']
         self.d_k = d_model // head
         self.head = head
         self.chunk = chunk
+        self.lsh_impl = lsh_impl
         self.linear_query = nn.Linear(d_model, d_model)
         self.linear_value = nn.Linear(d_model, d_model)
         self.linear_out = nn.Linear(d_model, d_model)
-        self.lshattention = LSHAttention(d_model, head, rounds, droprate, bucket_length)
-
-    def forward(self, input):
-        seed = 42
-        random = True
+        if lsh_impl == 'fused':
+            self.lshattention = FusedLSHAttention(d_model, head, chunk, rounds, droprate, bucket_length)
+        else:
+            self.lshattention = LSHAttention(d_model, head, rounds, droprate, bucket_length)
 
+    def forward(self, input, generator=None, buckets=None):
         length = input.size(1)
 
         query = self.linear_query(input).reshape(-1, length, self.head, self.d_k).transpose_(1, 2)
@@ -256,16 +394,21 @@ class MultiRoundLSHAttention(nn.Module):
         value = self.linear_value(input).reshape(-1, length, self.head, self.d_k).transpose_(1, 2)
         # [batch, head, length, d_k]
 
-        chunked_query = torch.chunk(query.flatten(0, 1), chunks=self.chunk, dim=0)
-        # [batch * head // chunk, length, d_k]
-        chunked_value = torch.chunk(value.flatten(0, 1), chunks=self.chunk, dim=0)
-        # [batch * head // chunk, length, d_k]
-
-        attention = torch.cat([
-            self.lshattention(q, v, seed + i, random) for q, v, i\
-                in zip(chunked_query, chunked_value, range(self.chunk))
-        ], dim=0).reshape(-1, self.head, length, self.d_k)
-        # [batch, head, length, d_k]
+        if self.lsh_impl == 'fused':
+            attention = self.lshattention(
+                query.flatten(0, 1), value.flatten(0, 1), generator, buckets
+            ).reshape(-1, self.head, length, self.d_k)
+            # [batch, head, length, d_k]
+        else:
+            chunked_query = torch.chunk(query.flatten(0, 1), chunks=self.chunk, dim=0)
+            # [batch * head // chunk, length, d_k]
+            chunked_value = torch.chunk(value.flatten(0, 1), chunks=self.chunk, dim=0)
+            # [batch * head // chunk, length, d_k]
+
+            attention = torch.cat([
+                self.lshattention(q, v, generator) for q, v in zip(chunked_query, chunked_value)
+            ], dim=0).reshape(-1, self.head, length, self.d_k)
+            # [batch, head, length, d_k]
 
         attention = attention.transpose(1, 2).flatten(-2, -1)
         # [batch, length, d_model]
@@ -318,15 +461,19 @@ class ReformerEncoder(nn.Module):
         self.reformer_encoder_block = nn.ModuleList([])
         for _ in range(args.num_block):
             self.reformer_encoder_block.append(nn.ModuleList([
-                PreLayerNorm(args.embed_dim, MultiRoundLSHAttention(args.embed_dim, args.num_head, args.xformer.reformer.num_chunk, args.xformer.reformer.rounds, args.xformer.reformer.drop_prob, args.xformer.reformer.bucket_length)),
+                PreLayerNorm(args.embed_dim, MultiRoundLSHAttention(args.embed_dim, args.num_head, args.xformer.reformer.num_chunk, args.xformer.reformer.rounds, args.xformer.reformer.drop_prob, args.xformer.reformer.bucket_length, args.xformer.reformer.lsh_impl)),
                 PreLayerNorm(args.embed_dim, FeedForwardNetwork(args.embed_dim, args.hidden_dim, args.ffn_drop_prob))
             ]))
+        # every layer reuses the buckets hashed by the first one (fused LSH only)
+        self.share_buckets = args.xformer.reformer.share_buckets and args.xformer.reformer.lsh_impl == 'fused'
 
-    def forward(self, input: Tensor) -> Tensor:
+    def forward(self, input: Tensor, generator=None) -> Tensor:
         input = self.embedding(input)
+        # per call, so concurrent forwards never see each other's buckets
+        buckets = {} if self.share_buckets else None
 
         for mhra, ffn in self.reformer_encoder_block:
-            input = mhra(input)
+            input = mhra(input, generator=generator, buckets=buckets)
             input = ffn(input)
         
         return input
\ No newline at end of file
@@ -7,6 +7,10 @@ from .. import embedding
 
 
 class MultiHeadRandomAttention(nn.Module):
+    _batch_shaped_parameters = ('multihead_random_attn',)
+    # times the rows repeat along the input batch; 2 in LRADual's fused pass over [input1; input2]
+    batch_repeats = 1
+
     def __init__(self, batch_size: int, max_seq_len: int, feat_dim: int, num_head: int, value_drop_prob: float) -> None:
         super(MultiHeadRandomAttention, self).__init__()
         self.num_head = num_head
@@ -40,8 +44,11 @@ class MultiHeadRandomAttention(nn.Module):
         value = self.value_dropout(value)
         multihead_value = self.split_head(value)
 
-        multihead_random_attn_score = self.softmax(self.multihead_random_attn)
-        multihead_random_attn_score = torch.einsum('bhnm,bhmd->bhnd', multihead_random_attn_score, multihead_value)
+        # a smaller batch (e.g. at inference) uses the leading rows
+        batch_size = input.size(0) // self.batch_repeats
+        multihead_random_attn_score = self.softmax(self.multihead_random_attn[:batch_size])
+        multihead_value = multihead_value.reshape(self.batch_repeats, batch_size, *multihead_value.shape[1:])
+        multihead_random_attn_score = torch.einsum('bhnm,rbhmd->rbhnd', multihead_random_attn_score, multihead_value).flatten(0, 1)
         multihead_random_attn_score_concat = self.concat_head(multihead_random_attn_score)
         multihead_random_attn_output = self.output_linear(multihead_random_attn_score_concat)
         
@@ -49,6 +56,9 @@ class MultiHeadRandomAttention(nn.Module):
     
 
 class MultiHeadFactorizedRandomAttention(nn.Module):
+    _batch_shaped_parameters = ('random_attn_factor_l', 'random_attn_factor_r')
+    batch_repeats = 1
+
     def __init__(self, batch_size: int, max_seq_len: int, feat_dim: int, num_head: int, rank: int, value_drop_prob: float) -> None:
         super(MultiHeadFactorizedRandomAttention, self).__init__()
         self.num_head = num_head
@@ -84,9 +94,11 @@ class MultiHeadFactorizedRandomAttention(nn.Module):
         value = self.value_dropout(value)
         multihead_value = self.split_head(value)
 
-        multihead_random_attn = torch.einsum('bhnk,bhnk->bhnn', self.random_attn_factor_l, self.random_attn_factor_r)
+        batch_size = input.size(0) // self.batch_repeats
+        multihead_random_attn = torch.einsum('bhnk,bhnk->bhnn', self.random_attn_factor_l[:batch_size], self.random_attn_factor_r[:batch_size])
         multihead_random_attn_score = self.softmax(multihead_random_attn)
-        multihead_random_attn_score = torch.einsum('bhnm,bhmd->bhnd', multihead_random_attn_score, multihead_value)
+        multihead_value = multihead_value.reshape(self.batch_repeats, batch_size, *multihead_value.shape[1:])
+        multihead_random_attn_score = torch.einsum('bhnm,rbhmd->rbhnd', multihead_random_attn_score, multihead_value).flatten(0, 1)
         multihead_random_attn_score_concat = self.concat_head(multihead_random_attn_score)
         multihead_random_attn_output = self.output_linear(multihead_random_attn_score_concat)
         
@@ -1,29 +1,31 @@
 import math
-import torch
 import torch.nn as nn
 import torch.nn.init as init
 from typing import Union, List, Optional, Tuple
 from torch import Size, Tensor
 from .. import embedding
+from utils.attention import attention
 
 
 class MultiHeadAttention(nn.Module):
-    def __init__(self, feat_dim, num_head, value_drop_prob) -> None:
+    def __init__(self, feat_dim, num_head, value_drop_prob, attention_impl: str = 'einsum', attention_block_size: int = 512) -> None:
         super(MultiHeadAttention, self).__init__()
         assert num_head >= 1
         assert feat_dim % num_head == 0, 'feat_dim should be divisible by num_head'
+        assert attention_impl in ['auto', 'einsum', 'sdpa', 'blockwise']
 
         self.feat_dim = feat_dim
         self.num_head = num_head
         self.head_dim = feat_dim // num_head
         self.tau = math.sqrt(self.head_dim)
+        self.attention_impl = attention_impl
+        self.attention_block_size = attention_block_size
 
         self.query_linear = nn.Linear(feat_dim, feat_dim, bias=False)
         self.key_linear = nn.Linear(feat_dim, feat_dim, bias=False)
         self.value_linear = nn.Linear(feat_dim, feat_dim, bias=False)
         self.output_linear = nn.Linear(feat_dim, feat_dim, bias=False)
-        
-        self.softmax = nn.Softmax(dim=-1)
+
         self.value_dropout = nn.Dropout(p=value_drop_prob)
     
         self.reset_parameters()
@@ -52,11 +54,8 @@ class MultiHeadAttention(nn.Module):
         multihead_key = self.split_head(key)
         multihead_value = self.split_head(value)
         
-        multihead_attn = torch.einsum('bhnd,bhmd->bhnm', multihead_query, multihead_key)
-        multihead_attn = multihead_attn / self.tau
-        multihead_attn_score = self.softmax(multihead_attn)
-
-        multihead_attn_score = torch.einsum('bhnm,bhmd->bhnd', multihead_attn_score, multihead_value)
+        multihead_attn_score = attention(multihead_query, multihead_key, multihead_value, 1.0 / self.tau, 
+                                         self.attention_impl, self.attention_block_size)
         multihead_attn_score_concat = self.concat_head(multihead_attn_score)
         multihead_attn_output = self.output_linear(multihead_attn_score_concat)
 
@@ -108,7 +107,11 @@ class TransformerEncoder(nn.Module):
         self.transformer_encoder_block = nn.ModuleList([])
         for _ in range(args.num_block):
             self.transformer_encoder_block.append(nn.ModuleList([
-                PostLayerNorm(args.embed_dim, MultiHeadAttention(args.embed_dim, args.num_head, args.value_drop_prob)),
+                PostLayerNorm(args.embed_dim, MultiHeadAttention(args.embed_dim, 
+                                                                 args.num_head, 
+                                                                 args.value_drop_prob, 
+                                                                 args.xformer.transformer.attention, 
+                                                                 args.xformer.transformer.attention_block_size)),
                 PostLayerNorm(args.embed_dim, FeedForward(args.embed_dim, args.hidden_dim, args.ffn_drop_prob))
             ]))
     
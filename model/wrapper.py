@@ -1,10 +1,33 @@
+import importlib
 import torch
 import torch.nn as nn
 import torch.nn.init as init
-from .encoder import converter, cosformer, \
-                    fnet, linformer, nystromformer, \
-                    performer, reformer, synthesizer, transformer
 from torch import Tensor
+from utils import sequence_parallel
+
+
+# --xformer -> (module of model.encoder, encoder class); a module is only imported when selected
+ENCODERS = {
+    'converter': ('converter', 'ConverterEncoder'),
+    'cosformer': ('cosformer', 'CosformerEncoder'),
+    'fnet': ('fnet', 'FNetEncoder'),
+    'linformer': ('linformer', 'LinformerEncoder'),
+    'nystromformer': ('nystromformer', 'NystromformerEncoder'),
+    'performer': ('performer', 'PerformerEncoder'),
+    'reformer': ('reformer', 'ReformerEncoder'),
+    'synthesizer': ('synthesizer', 'SynthesizerEncoder'),
+    'transformer': ('transformer', 'TransformerEncoder')
+}
+
+
+def encoder_module(xformer: str):
+    if xformer not in ENCODERS:
+        raise ValueError(f'ERROR: {xformer} is undefined.')
+    return importlib.import_module('.encoder.' + ENCODERS[xformer][0], __package__)
+
+
+def create_encoder(xformer: str, args) -> nn.Module:
+    return getattr(encoder_module(xformer), ENCODERS[xformer][1])(args)
 
 
 class SingleClassifier(nn.Module):
@@ -22,6 +45,9 @@ class SingleClassifier(nn.Module):
         self.linear2 = nn.Linear(in_features=mlp_dim, out_features=num_class, bias=True)
         self.leaky_relu = nn.LeakyReLU()
         self.dropout = nn.Dropout(p=decoder_drop_prob)
+        # set by utils.sequence_parallel.apply; the encoded input is then the local shard
+        self.sequence_parallel = False
+        self.sequence_group = None
 
         self.reset_parameters()
 
@@ -32,6 +58,8 @@ class SingleClassifier(nn.Module):
         init.zeros_(self.linear2.bias)
     
     def pooling(self, input: Tensor, mode: str) -> Tensor:
+        if self.sequence_parallel is True:
+            return sequence_parallel.pool(input, mode, self.sequence_group)
         if mode == 'CLS':
             pooled = input[:, 0, :]
         elif mode == 'MEAN':
@@ -77,6 +105,9 @@ class DualClassifier(nn.Module):
         self.linear2 = nn.Linear(in_features=mlp_dim, out_features=num_class, bias=True)
         self.leaky_relu = nn.LeakyReLU()
         self.dropout = nn.Dropout(p=decoder_drop_prob)
+        # set by utils.sequence_parallel.apply; the encoded input is then the local shard
+        self.sequence_parallel = False
+        self.sequence_group = None
 
         self.reset_parameters()
 
@@ -87,6 +118,8 @@ class DualClassifier(nn.Module):
         init.zeros_(self.linear2.bias)
 
     def pooling(self, input: Tensor, mode: str) -> Tensor:
+        if self.sequence_parallel is True:
+            return sequence_parallel.pool(input, mode, self.sequence_group)
         if mode == 'CLS':
             pooled = input[:, 0, :]
         elif mode == 'MEAN':
@@ -103,6 +136,11 @@ class DualClassifier(nn.Module):
     def forward(self, encoded_1: Tensor, encoded_2: Tensor) -> Tensor:
         pooled_1 = self.pooling(encoded_1, self.pooling_type)
         pooled_2 = self.pooling(encoded_2, self.pooling_type)
+
+        return self.head(pooled_1, pooled_2)
+
+    def head(self, pooled_1: Tensor, pooled_2: Tensor) -> Tensor:
+        # the pair interaction and the MLP, on already pooled encodings
         if self.interaction == 'NLI':
             # NLI interaction style
             pooled = torch.cat([pooled_1, 
@@ -123,26 +161,7 @@ class DualClassifier(nn.Module):
 class LRASingle(nn.Module):
     def __init__(self, namespace, args) -> None:
         super(LRASingle, self).__init__()
-        if namespace.xformer == 'converter':
-            self.xformer = converter.ConverterEncoder(args)
-        elif namespace.xformer == 'cosformer':
-            self.xformer = cosformer.CosformerEncoder(args)
-        elif namespace.xformer == 'fnet':
-            self.xformer = fnet.FNetEncoder(args)
-        elif namespace.xformer == 'linformer':
-            self.xformer = linformer.LinformerEncoder(args)
-        elif namespace.xformer == 'nystromformer':
-            self.xformer = nystromformer.NystromformerEncoder(args)
-        elif namespace.xformer == 'performer':
-            self.xformer = performer.PerformerEncoder(args)
-        elif namespace.xformer == 'reformer':
-            self.xformer = reformer.ReformerEncoder(args)
-        elif namespace.xformer == 'synthesizer':
-            self.xformer = synthesizer.SynthesizerEncoder(args)
-        elif namespace.xformer == 'transformer':
-            self.xformer = transformer.TransformerEncoder(args)
-        else:
-            raise ValueError(f'ERROR: {namespace.xformer} is undefined.')
+        self.xformer = create_encoder(namespace.xformer, args)
         self.classifier = SingleClassifier(args.pooling_type, 
                                            args.max_seq_len, 
                                            args.encoder_dim, 
@@ -151,8 +170,9 @@ class LRASingle(nn.Module):
                                            args.decoder_drop_prob
                                            )
 
-    def forward(self, input: Tensor) -> Tensor:
-        encoded = self.xformer(input)
+    def forward(self, input: Tensor, **kwargs) -> Tensor:
+        # per-call options of the encoder, e.g. the generator of the reformer's LSH
+        encoded = self.xformer(input, **kwargs)
         classified = self.classifier(encoded)
 
         return classified
@@ -161,26 +181,7 @@ class LRASingle(nn.Module):
 class LRADual(nn.Module):
     def __init__(self, namespace, args) -> None:
         super(LRADual, self).__init__()
-        if namespace.xformer == 'converter':
-            self.xformer = converter.ConverterEncoder(args)
-        elif namespace.xformer == 'cosformer':
-            self.xformer = cosformer.CosformerEncoder(args)
-        elif namespace.xformer == 'fnet':
-            self.xformer = fnet.FNetEncoder(args)
-        elif namespace.xformer == 'linformer':
-            self.xformer = linformer.LinformerEncoder(args)
-        elif namespace.xformer == 'nystromformer':
-            self.xformer = nystromformer.NystromformerEncoder(args)
-        elif namespace.xformer == 'performer':
-            self.xformer = performer.PerformerEncoder(args)
-        elif namespace.xformer == 'reformer':
-            self.xformer = reformer.ReformerEncoder(args)
-        elif namespace.xformer == 'synthesizer':
-            self.xformer = synthesizer.SynthesizerEncoder(args)
-        elif namespace.xformer == 'transformer':
-            self.xformer = transformer.TransformerEncoder(args)
-        else:
-            raise ValueError(f'ERROR: {namespace.xformer} is undefined.')
+        self.xformer = create_encoder(namespace.xformer, args)
         self.classifier = DualClassifier(args.pooling_type, 
                                          args.max_seq_len, 
                                          args.encoder_dim, 
@@ -189,10 +190,32 @@ class LRADual(nn.Module):
                                          args.decoder_drop_prob, 
                                          args.interaction
                                          )
-
-    def forward(self, input1: Tensor, input2: Tensor) -> Tensor:
-        encoded1 = self.xformer(input1)
-        encoded2 = self.xformer(input2)
+        # one encoder pass over the 2B sequences [input1; input2] instead of two over B
+        self.fused_dual = args.fused_dual
+        if self.fused_dual is True:
+            # row b of both halves uses row b of the batch-shaped parameters, as in two passes
+            for module in self.xformer.modules():
+                if hasattr(module, '_batch_shaped_parameters'):
+                    module.batch_repeats = 2
+
+    def forward(self, input1: Tensor, input2: Tensor, **kwargs) -> Tensor:
+        if self.fused_dual is True:
+            # every row draws its own dropout masks, so both halves stay as independent as in two passes
+            encoded = self.xformer(torch.cat([input1, input2], dim=0), **kwargs)
+            encoded1, encoded2 = encoded.split(input1.size(0), dim=0)
+        else:
+            encoded1 = self.xformer(input1, **kwargs)
+            encoded2 = self.xformer(input2, **kwargs)
         classified = self.classifier(encoded1, encoded2)
 
-        return classified
\ No newline at end of file
+        return classified
+
+    def encode(self, input: Tensor, **kwargs) -> Tensor:
+        # pooled encoding of one side; classifier.head scores pairs of them
+        num_samples = input.size(0)
+        if (self.fused_dual is True) and (num_samples % 2 == 1):
+            # the fused encoder takes two equal halves; the padding row is dropped again
+            input = torch.cat([input, input[-1:]], dim=0)
+        encoded = self.xformer(input, **kwargs)[:num_samples]
+
+        return self.classifier.pooling(encoded, self.classifier.pooling_type)
\ No newline at end of file
@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import argparse
+import yaml
+import warnings
+
+import torch
+
+from pathlib import Path
+from types import SimpleNamespace
+from utils.entry import dict_to_namespace
+from model import wrapper
+from utils import distributed, inference, sequence_parallel, weights
+
+
+def get_parameters():
+    parser = argparse.ArgumentParser(description='Batched offline inference with a trained classifier')
+    parser.add_argument('--config', type=Path, default="lra_config.yaml", help='Path to the yaml configuration file the model was trained with')
+    parser.add_argument('--dataset', type=str, default="image", help='Name of the task section in the config')
+    parser.add_argument('--xformer', type=str, default='converter', help='Type of transformer to use')
+    parser.add_argument('--checkpoint', type=str, default=None, help='Trained weights (torch or flat format); defaults to <xformer>_<dataset>.pt')
+    parser.add_argument('--input', type=str, nargs='+', required=True, help='Token file(s), .pt or text with one sequence per line; two paired files for retrieval')
+    parser.add_argument('--targets', type=str, default=None, help='Optional labels (.pt or one per line) to report the accuracy')
+    parser.add_argument('--output', type=Path, default=Path('predictions.jsonl'), help='JSONL file with the label and logits of every sequence')
+    parser.add_argument('--token_budget', type=int, default=None, help='Padded tokens per batch; defaults to batch_size * max_seq_len')
+    parser.add_argument('--pad_id', type=int, default=0, help='Token id that pads sequences shorter than max_seq_len')
+    parser.add_argument('--sequence_parallel', action='store_true', help='Under torchrun, split every sequence over the ranks (converter only)')
+
+    return parser.parse_args()
+
+
+def build_model(namespace, args, path, device):
+    if args.dataset == 'retrieval':
+        model = wrapper.LRADual(namespace, args)
+    else:
+        model = wrapper.LRASingle(namespace, args)
+    weights.load_into(model, path)
+
+    return model.to(device).eval()
+
+
+def prepend_cls(args, sequence):
+    # as the entry points' prepare_data: CLS pooling reads the CLS token prepended to every sequence
+    if args.pooling_type != 'CLS':
+        return sequence
+    CLS_TOKEN_ID = args.vocab_size - 1
+
+    return torch.cat([torch.full((1,), CLS_TOKEN_ID, dtype=sequence.dtype), sequence], dim=-1)
+
+
+def read_targets(path):
+    for target in inference.read_sequences(path):
+        yield from target.tolist()
+
+
+if __name__ == '__main__':
+    warnings.filterwarnings("ignore", category=UserWarning)
+
+    cli = get_parameters()
+    with open(cli.config) as f:
+        args = dict_to_namespace(yaml.safe_load(f)[cli.dataset])
+    namespace = SimpleNamespace(config=cli.config, dataset=cli.dataset, xformer=cli.xformer)
+
+    num_inputs = 2 if args.dataset == 'retrieval' else 1
+    if len(cli.input) != num_inputs:
+        raise ValueError(f'ERROR: The {args.dataset} task takes {num_inputs} input file(s), got {len(cli.input)}.')
+
+    if args.enable_cuda and torch.cuda.is_available():
+        device = torch.device('cuda')
+    else:
+        device = torch.device('cpu')
+    # every rank reads all inputs and encodes its shard of every sequence; rank 0 writes the predictions
+    if (cli.sequence_parallel is True) or (args.sequence_parallel is True):
+        device = distributed.setup(device, pin=args.pin_cores)
+
+    checkpoint = cli.checkpoint or (cli.xformer + "_" + args.dataset + ".pt")
+    model = build_model(namespace, args, checkpoint, device)
+    if distributed.is_enabled():
+        sequence_parallel.apply(model)
+    predictor = inference.Predictor(model, args.batch_size, device)
+    rows = inference.batch_rows(args, cli.token_budget)
+
+    streams = [inference.read_sequences(path) for path in cli.input]
+    if cli.targets is not None:
+        streams.append(read_targets(cli.targets))
+
+    latencies = []
+    num_samples, num_tokens, num_correct = 0, 0, 0
+    start = time.perf_counter()
+    with open(cli.output if distributed.is_main() else os.devnull, 'w') as f:
+        for batch in inference.dynamic_batches(streams, rows):
+            batch_start = time.perf_counter()
+            inputs = [inference.pad([prepend_cls(args, sample[i]) for sample in batch], args.max_seq_len, cli.pad_id) for i in range(num_inputs)]
+            logits = predictor(*inputs).reshape(len(batch), -1)
+            latencies.append(time.perf_counter() - batch_start)
+
+            labels = logits.argmax(dim=-1).tolist()
+            for row, (sample, label) in enumerate(zip(batch, labels)):
+                record = {'index': num_samples + row, 'label': label, 'logits': logits[row].tolist()}
+                if cli.targets is not None:
+                    record['target'] = int(sample[-1])
+                    num_correct += int(label == record['target'])
+                f.write(json.dumps(record) + '\n')
+            # results are on disk as soon as their batch is done
+            f.flush()
+
+            num_samples += len(batch)
+            num_tokens += sum(sequence.numel() for sample in batch for sequence in sample[:num_inputs])
+    elapsed = time.perf_counter() - start
+
+    if distributed.is_main():
+        print(f'{num_samples} sequences in {len(latencies)} batches of up to {rows} ({device.type}), {elapsed:.2f} s')
+        print(f'throughput: {num_samples / elapsed:.1f} sequences/s, {num_tokens / elapsed:.0f} tokens/s')
+        print(f'batch latency: p50 {inference.percentile(latencies, 50) * 1e3:.1f} ms, p99 {inference.percentile(latencies, 99) * 1e3:.1f} ms')
+        if (cli.targets is not None) and (num_samples > 0):
+            print(f'accuracy: {100 * num_correct / num_samples: .2f}%')
+        print(f'predictions: {cli.output}')
+
+    distributed.cleanup()
@@ -0,0 +1,155 @@
+import json
+import asyncio
+import argparse
+import yaml
+import warnings
+
+import torch
+
+from pathlib import Path
+from types import SimpleNamespace
+from utils.entry import dict_to_namespace
+from predict_main import build_model
+from utils import inference
+
+
+def get_parameters():
+    parser = argparse.ArgumentParser(description='Local HTTP inference server with request batching')
+    parser.add_argument('--config', type=Path, default="genome_config.yaml", help='Path to the yaml configuration file the model was trained with')
+    parser.add_argument('--dataset', type=str, default="mm", help='Name of the task section in the config')
+    parser.add_argument('--xformer', type=str, default='converter', help='Type of transformer to use')
+    parser.add_argument('--checkpoint', type=str, default=None, help='Trained weights (torch or flat format); defaults to <xformer>_<dataset>.pt')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('--max_batch', type=int, default=None, help='Requests per micro-batch; defaults to the batch_size of the task')
+    parser.add_argument('--max_wait_ms', type=float, default=5.0, help='How long the oldest queued request waits for others to join its batch')
+    parser.add_argument('--pad_id', type=int, default=0, help='Token id that pads sequences shorter than max_seq_len')
+
+    return parser.parse_args()
+
+
+def parse_request(body, args, num_inputs):
+    """Token tensors of a POST /predict body: {"tokens": [...]} (and "tokens_2" for retrieval)."""
+    request = json.loads(body)
+    if not isinstance(request, dict):
+        raise ValueError('ERROR: The request body must be a JSON object.')
+    keys = ['tokens', 'tokens_2'][:num_inputs]
+    sequences = []
+    for key in keys:
+        tokens = request.get(key)
+        if not isinstance(tokens, list) or len(tokens) == 0:
+            raise ValueError(f'ERROR: The request needs a non-empty list of token ids in "{key}".')
+        if len(tokens) > args.max_seq_len:
+            raise ValueError(f'ERROR: "{key}" has {len(tokens)} tokens, more than max_seq_len {args.max_seq_len}.')
+        if not all(isinstance(token, int) and 0 <= token < args.vocab_size for token in tokens):
+            raise ValueError(f'ERROR: The token ids in "{key}" must be integers in [0, {args.vocab_size}).')
+        sequences.append(torch.tensor(tokens, dtype=torch.int32))
+
+    return sequences
+
+
+async def read_request(reader):
+    """Method, path, headers and body of one HTTP/1.1 request, or None at the end of the connection."""
+    line = await reader.readline()
+    if not line:
+        return None
+    method, path, _ = line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+    return method, path, headers, body
+
+
+def write_response(writer, status, payload, keep_alive):
+    body = json.dumps(payload).encode('utf-8')
+    reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+    head = (f'HTTP/1.1 {status} {reason}\r\n'
+            f'Content-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n')
+    writer.write(head.encode('latin-1') + body)
+
+
+def create_handler(batcher, args, num_inputs):
+    async def handle(reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except (ValueError, asyncio.IncompleteReadError):
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+
+                if (method == 'POST') and (path == '/predict'):
+                    try:
+                        sequences = parse_request(body, args, num_inputs)
+                    except ValueError as error:
+                        write_response(writer, 400, {'error': str(error)}, keep_alive)
+                    else:
+                        try:
+                            logits = await batcher.submit(*sequences)
+                            write_response(writer, 200, {'label': int(logits.argmax()), 'logits': logits.tolist()}, keep_alive)
+                        except Exception as error:
+                            write_response(writer, 500, {'error': f'ERROR: {error}'}, keep_alive)
+                elif (method == 'GET') and (path == '/metrics'):
+                    write_response(writer, 200, batcher.metrics(), keep_alive)
+                else:
+                    write_response(writer, 404, {'error': f'ERROR: {method} {path} is not served.'}, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def serve(cli, batcher, args, num_inputs):
+    worker = asyncio.create_task(batcher.run())
+    server = await asyncio.start_server(create_handler(batcher, args, num_inputs), cli.host, cli.port)
+    print(f'serving {cli.xformer} on {cli.dataset} at http://{cli.host}:{cli.port} '
+          f'(POST /predict, GET /metrics), batches of up to {batcher.max_batch} within {cli.max_wait_ms} ms')
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        worker.cancel()
+
+
+if __name__ == '__main__':
+    warnings.filterwarnings("ignore", category=UserWarning)
+
+    cli = get_parameters()
+    with open(cli.config) as f:
+        args = dict_to_namespace(yaml.safe_load(f)[cli.dataset])
+    namespace = SimpleNamespace(config=cli.config, dataset=cli.dataset, xformer=cli.xformer)
+    num_inputs = 2 if args.dataset == 'retrieval' else 1
+
+    if args.enable_cuda and torch.cuda.is_available():
+        device = torch.device('cuda')
+    else:
+        device = torch.device('cpu')
+
+    checkpoint = cli.checkpoint or (cli.xformer + "_" + args.dataset + ".pt")
+    model = build_model(namespace, args, checkpoint, device)
+    predictor = inference.Predictor(model, args.batch_size, device)
+    batcher = inference.MicroBatcher(predictor, num_inputs, args.max_seq_len, cli.pad_id,
+                                     max_batch=cli.max_batch or args.batch_size,
+                                     max_wait=cli.max_wait_ms / 1e3)
+    try:
+        asyncio.run(serve(cli, batcher, args, num_inputs))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        batcher.close()
@@ -0,0 +1,146 @@
+import os
+import argparse
+import importlib
+import yaml
+import warnings
+
+import torch
+import torch.multiprocessing as mp
+
+from pathlib import Path
+from types import SimpleNamespace
+from utils import dataloader, engine, entry, sweep
+
+
+ENTRY_POINTS = {'lra': 'lra_main', 'genome': 'genome_main', 'ld': 'ld_main'}
+# keys that change the loaded tensors, which all trials share
+DATA_KEYS = ('dataset', 'pooling_type', 'vocab_size', 'max_seq_len')
+
+
+def get_parameters():
+    parser = argparse.ArgumentParser(description='Hyperparameter sweep with successive halving')
+    parser.add_argument('--main', type=str, default='lra', choices=list(ENTRY_POINTS), help='Entry point whose task is swept')
+    parser.add_argument('--config', type=Path, default="lra_config.yaml", help='Path to the yaml configuration file')
+    parser.add_argument('--dataset', type=str, default="listops", help='Name of the task')
+    parser.add_argument('--xformer', type=str, default='converter', help='Type of transformer to use')
+    parser.add_argument('--space', type=Path, default="sweep_space.yaml", help='YAML mapping of dotted config keys to the values to search')
+    parser.add_argument('--search', type=str, default='grid', choices=['grid', 'random'], help='Expand every combination or sample --num_trials of them')
+    parser.add_argument('--num_trials', type=int, default=16, help='Number of configurations of a random search')
+    parser.add_argument('--workers', type=int, default=2, help='Number of trials trained at the same time')
+    parser.add_argument('--min_epochs', type=int, default=1, help='Epoch budget of the first successive halving rung')
+    parser.add_argument('--reduction', type=int, default=3, help='Keep 1/reduction of the trials per rung; budgets grow by the same factor')
+    parser.add_argument('--out', type=Path, default=Path('sweep'), help='Directory for the trial checkpoints and results.csv')
+    parser.add_argument('--seed', type=int, default=3407, help='Seed of the trials and of the random search')
+
+    return parser.parse_args()
+
+
+def load_datasets(main, section):
+    """Load the train/val/test datasets once; their tensors live in shared memory."""
+    loaders = main.prepare_data(entry.dict_to_namespace(section))
+
+    return [loader.dataset for loader in loaders]
+
+
+def run_trial(entry_point, namespace, section, datasets, epochs, first_epoch, trial_dir, threads, seed):
+    """Train one trial up to `epochs`, continuing from its last rung, in a pool process."""
+    main = importlib.import_module(entry_point)
+    warnings.filterwarnings("ignore", category=UserWarning)
+    torch.set_num_threads(threads)
+    # checkpoints, training state and telemetry land in the trial's own directory
+    os.makedirs(trial_dir, exist_ok=True)
+    os.chdir(trial_dir)
+    main.set_env(seed)
+
+    args = entry.dict_to_namespace(section)
+    args.epochs = epochs
+    # pool processes are daemonic and cannot start loader workers
+    args.num_workers = 0
+    if args.telemetry_path is None:
+        args.telemetry_path = 'telemetry.jsonl'
+    namespace = SimpleNamespace(**namespace, resume=True, seeds=None)
+    if args.enable_cuda and torch.cuda.is_available():
+        device = torch.device('cuda')
+    else:
+        device = torch.device('cpu')
+
+    model, loss_cel, loss_seq_kp, optimizer, scheduler, es, monitor, recorder = entry.prepare_model(namespace, args, device)
+    dataloader_train, dataloader_val = [dataloader.create_dataloader(dataset=dataset, batch_size=args.batch_size, shuffle=shuffle,
+                                                                     drop_last=True, num_workers=args.num_workers)
+                                        for dataset, shuffle in zip(datasets[:2], [True, False])]
+    trainer = engine.Trainer(namespace, args, model, optimizer, scheduler, es, monitor, recorder,
+                             loss_cel, loss_seq_kp, device)
+    acc_train, loss_train, acc_val, loss_val, peak_memory_train = trainer.fit(dataloader_train, dataloader_val)
+    recorder.close()
+
+    return {
+        'epochs': epochs,
+        'status': 'early stopped' if es.early_stop else 'completed',
+        'val_loss': es.val_loss_min,
+        'val_acc': trainer.acc_val_best,
+        'train_loss': loss_train,
+        'samples_per_sec': sweep.loop_throughput(args.telemetry_path, 'train', first_epoch),
+        'peak_memory': peak_memory_train
+    }
+
+
+if __name__ == '__main__':
+    cli = get_parameters()
+
+    with open(cli.config) as f:
+        section = yaml.safe_load(f)[cli.dataset]
+    with open(cli.space) as f:
+        space = yaml.safe_load(f)
+    for key in space:
+        if key.split('.')[0] in DATA_KEYS:
+            raise ValueError(f'ERROR: {key} changes the shared datasets and cannot be swept.')
+
+    if cli.search == 'grid':
+        trials = sweep.expand_grid(space)
+    else:
+        trials = sweep.sample_random(space, cli.num_trials, cli.seed)
+    sections = [sweep.apply_overrides(section, trial) for trial in trials]
+    budgets = sweep.rungs(cli.min_epochs, section['epochs'], cli.reduction)
+
+    main = importlib.import_module(ENTRY_POINTS[cli.main])
+    main.set_env(cli.seed)
+    datasets = load_datasets(main, section)
+
+    os.makedirs(cli.out, exist_ok=True)
+    results_path = cli.out / 'results.csv'
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    threads = max(1, cores // cli.workers)
+    namespace = {'config': str(cli.config), 'dataset': cli.dataset, 'xformer': cli.xformer}
+    print(f'{len(trials)} trials, rungs of {budgets} epochs, {cli.workers} workers x {threads} threads')
+
+    results = {}
+    alive = list(range(len(trials)))
+    previous = 0
+    # a fresh process per trial; the datasets are passed as shared-memory handles, not copied
+    with mp.get_context('spawn').Pool(processes=cli.workers, maxtasksperchild=1) as pool:
+        for rung, epochs in enumerate(budgets):
+            jobs = {trial_id: pool.apply_async(run_trial, (ENTRY_POINTS[cli.main], namespace, sections[trial_id], datasets,
+                                                           epochs, previous + 1,
+                                                           os.path.abspath(cli.out / f'trial_{trial_id:03d}'),
+                                                           threads, cli.seed))
+                    for trial_id in alive}
+            for trial_id, job in jobs.items():
+                results[trial_id] = job.get()
+                print(f'trial {trial_id} ({epochs} epochs): val loss {results[trial_id]["val_loss"]: .4f}, '
+                      f'{results[trial_id]["samples_per_sec"]:.1f} samples/s')
+
+            if rung < len(budgets) - 1:
+                # early-stopped trials would not train further, so they keep their status and leave the race
+                candidates = {trial_id: results[trial_id] for trial_id in alive if results[trial_id]['status'] != 'early stopped'}
+                kept = sweep.promote(candidates, cli.reduction)
+                for trial_id in candidates:
+                    results[trial_id]['status'] = 'promoted' if trial_id in kept else f'pruned after {epochs} epochs'
+                alive = kept
+            previous = epochs
+            sweep.write_results(results_path, trials, results)
+
+    best = min(results, key=lambda trial_id: results[trial_id]['val_loss'])
+    print(f'best trial {best}: {trials[best]}')
+    print(f'val loss: {results[best]["val_loss"]: .4f}')
+    print(f'val acc: {results[best]["val_acc"]: .2f}%')
+    print(f'results: {results_path}')
@@ -1,3 +1,8 @@
 __all__ = ['activation', 'dropout', 'functional', 
            'opt', 'los', 'metrices', 'pscan', 
-           'early_stopping', 'lra_dataloader']
\ No newline at end of file
+           'early_stopping', 'lra_dataloader', 'health', 
+           'telemetry', 'memory', 'module_profiler', 'engine', 
+           'microbatch', 'recompute', 'checkpoint', 
+           'weights', 'distributed', 'sequence_parallel', 
+           'ensemble', 'sweep', 'run_cache', 'inference', 'attention', 
+           'entry']
\ No newline at end of file
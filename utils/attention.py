@@ -0,0 +1,135 @@
+import math
+import torch
+import torch.nn.functional as F
+
+
+class BlockwiseAttention(torch.autograd.Function):
+    """Exact softmax attention over (..., N, D) tensors in blocks of queries and keys.
+
+    The forward keeps a running max and normalizer per query (online softmax),
+    so no more than a block x block tile of scores exists at a time, and saves
+    only the output and the log-sum-exp of every query row. The backward
+    recomputes the tiles from those instead of storing the N x M probabilities.
+    """
+
+    # forward and backward only use ops with batching rules, so torch.func.vmap
+    # (the seed ensemble) can derive the batched version
+    generate_vmap_rule = True
+
+    @staticmethod
+    def forward(query, key, value, scale, block_size):
+        outputs, lses = [], []
+        for q_start in range(0, query.size(-2), block_size):
+            q = query[..., q_start:q_start + block_size, :]
+            row_max = q.new_full(q.shape[:-1], -math.inf, dtype=torch.float32)
+            row_sum = q.new_zeros(q.shape[:-1], dtype=torch.float32)
+            acc = q.new_zeros(q.shape[:-1] + value.shape[-1:], dtype=torch.float32)
+            for k_start in range(0, key.size(-2), block_size):
+                k = key[..., k_start:k_start + block_size, :]
+                v = value[..., k_start:k_start + block_size, :]
+                score = torch.matmul(q, k.transpose(-2, -1)).float() * scale
+                new_max = torch.maximum(row_max, score.amax(dim=-1))
+                prob = torch.exp(score - new_max.unsqueeze(-1))
+                correction = torch.exp(row_max - new_max)
+                row_sum = row_sum * correction + prob.sum(dim=-1)
+                acc = acc * correction.unsqueeze(-1) + torch.matmul(prob.to(v.dtype), v).float()
+                row_max = new_max
+            outputs.append((acc / row_sum.unsqueeze(-1)).to(query.dtype))
+            lses.append(row_max + torch.log(row_sum))
+
+        return torch.cat(outputs, dim=-2), torch.cat(lses, dim=-1)
+
+    @staticmethod
+    def setup_context(ctx, inputs, output):
+        query, key, value, scale, block_size = inputs
+        out, lse = output
+        ctx.mark_non_differentiable(lse)
+        ctx.save_for_backward(query, key, value, out, lse)
+        ctx.scale = scale
+        ctx.block_size = block_size
+
+    @staticmethod
+    def backward(ctx, grad_out, grad_lse):
+        query, key, value, out, lse = ctx.saved_tensors
+        scale, block_size = ctx.scale, ctx.block_size
+        # D_i = sum_j P_ij dP_ij = dO_i . O_i, so dS = P * (dP - D) needs no full row of P
+        delta = (grad_out.float() * out.float()).sum(dim=-1)
+
+        grad_query = []
+        grad_key = [None] * len(range(0, key.size(-2), block_size))
+        grad_value = [None] * len(grad_key)
+        for q_start in range(0, query.size(-2), block_size):
+            rows = slice(q_start, q_start + block_size)
+            q, do = query[..., rows, :], grad_out[..., rows, :]
+            row_lse, row_delta = lse[..., rows].unsqueeze(-1), delta[..., rows].unsqueeze(-1)
+            dq = 0
+            for index, k_start in enumerate(range(0, key.size(-2), block_size)):
+                k = key[..., k_start:k_start + block_size, :]
+                v = value[..., k_start:k_start + block_size, :]
+                prob = torch.exp(torch.matmul(q, k.transpose(-2, -1)).float() * scale - row_lse)
+                dv = torch.matmul(prob.transpose(-2, -1), do.float())
+                dscore = prob * (torch.matmul(do, v.transpose(-2, -1)).float() - row_delta) * scale
+                dq = dq + torch.matmul(dscore, k.float())
+                dk = torch.matmul(dscore.transpose(-2, -1), q.float())
+                grad_key[index] = dk if grad_key[index] is None else grad_key[index] + dk
+                grad_value[index] = dv if grad_value[index] is None else grad_value[index] + dv
+            grad_query.append(dq)
+
+        return (torch.cat(grad_query, dim=-2).to(query.dtype),
+                torch.cat(grad_key, dim=-2).to(key.dtype),
+                torch.cat(grad_value, dim=-2).to(value.dtype),
+                None, None)
+
+
+def blockwise_attention(query, key, value, scale=None, block_size=512):
+    """softmax(query key^T * scale) value, exactly, in O(N * block_size) memory."""
+    if scale is None:
+        scale = 1.0 / math.sqrt(query.size(-1))
+    return BlockwiseAttention.apply(query, key, value, scale, block_size)[0]
+
+
+def sdpa_available() -> bool:
+    return hasattr(F, 'scaled_dot_product_attention')
+
+
+def sdpa_flash_cpu() -> bool:
+    """Whether torch has the CPU flash kernel (2.1 and newer), whose memory is linear in the sequence length."""
+    major, minor = (int(part) for part in torch.__version__.split('.')[:2])
+    return (major, minor) >= (2, 1)
+
+
+def use_sdpa(query, key, block_size) -> bool:
+    """Whether "auto" picks torch's fused kernel: always on GPU and, with the CPU
+    flash kernel, on CPU. Without it, SDPA on CPU materializes the scores, so
+    it is only picked for sequences of at most one block, where the blockwise
+    loop has nothing to save."""
+    if not sdpa_available():
+        return False
+    if query.is_cuda or sdpa_flash_cpu():
+        return True
+    return key.size(-2) <= block_size
+
+
+def attention(query, key, value, scale, impl='auto', block_size=512):
+    """Exact multi-head softmax attention over (batch, head, seq, head_dim) tensors.
+
+    impl is "einsum" (materialized scores), "sdpa" (torch's fused kernel),
+    "blockwise" (online softmax, see BlockwiseAttention), or "auto".
+    """
+    if impl == 'auto':
+        impl = 'sdpa' if use_sdpa(query, key, block_size) else 'blockwise'
+
+    if impl == 'einsum':
+        score = torch.einsum('bhnd,bhmd->bhnm', query, key) * scale
+        return torch.einsum('bhnm,bhmd->bhnd', torch.softmax(score, dim=-1), value)
+    elif impl == 'sdpa':
+        if not sdpa_available():
+            raise ValueError('ERROR: scaled_dot_product_attention needs torch 2.0 or newer.')
+        # older releases have no scale argument and always use 1/sqrt(head_dim)
+        if math.isclose(scale, 1.0 / math.sqrt(query.size(-1))):
+            return F.scaled_dot_product_attention(query, key, value)
+        return F.scaled_dot_product_attention(query * (scale * math.sqrt(query.size(-1))), key, value)
+    elif impl == 'blockwise':
+        return blockwise_attention(query, key, value, scale, block_size)
+    else:
+        raise ValueError(f'ERROR: The attention implementation {impl} is undefined.')
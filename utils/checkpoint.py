@@ -0,0 +1,133 @@
+import os
+import random
+import threading
+import torch
+
+
+def snapshot(state):
+    """Copy every tensor of a (nested) state dict to CPU memory owned by the copy.
+
+    The copy is taken on the training thread, so the background write sees
+    the weights of this step even if the optimizer updates them meanwhile.
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+def rng_state():
+    state = {'python': random.getstate(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state) -> None:
+    random.setstate(state['python'])
+    torch.set_rng_state(state['torch'])
+    if ('cuda' in state) and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def write_atomic(state, path: str, save=torch.save) -> None:
+    """Save to a temporary file next to `path`, fsync it, then rename it over `path`.
+
+    A reader (or a resumed run after a crash) sees either the previous file or
+    the complete new one, never a partially written checkpoint.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class CheckpointManager:
+    """Writes checkpoints in a background thread with temp-file + rename.
+
+    save() snapshots the state to CPU and returns immediately; a single writer
+    thread serializes the snapshots. If a newer snapshot for the same path
+    arrives before the previous one was written, only the newer one is
+    written. Errors of the writer are raised on the next save() or wait().
+    With write=False (the non-zero ranks of a distributed run) save() only
+    takes the snapshot and nothing is written.
+    """
+    def __init__(self, write: bool = True) -> None:
+        self.write = write
+        self.pending = {}
+        self.in_flight = 0
+        self.error = None
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def _raise_error(self) -> None:
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, state, path: str, save=torch.save):
+        """Queue a snapshot of `state` for writing to `path` with `save` and return the snapshot."""
+        state = snapshot(state)
+        if not self.write:
+            return state
+        with self.cond:
+            self._raise_error()
+            self.pending[path] = (state, save)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+
+        return state
+
+    def _run(self) -> None:
+        while True:
+            with self.cond:
+                while (len(self.pending) == 0) and (not self.closed):
+                    self.cond.wait()
+                if len(self.pending) == 0:
+                    return
+                path = next(iter(self.pending))
+                state, save = self.pending.pop(path)
+                self.in_flight += 1
+            try:
+                write_atomic(state, path, save)
+            except Exception as e:
+                self.error = e
+            finally:
+                with self.cond:
+                    self.in_flight -= 1
+                    self.cond.notify_all()
+
+    def wait(self) -> None:
+        """Block until every queued checkpoint is on disk."""
+        with self.cond:
+            while (len(self.pending) > 0) or (self.in_flight > 0):
+                self.cond.wait()
+            self._raise_error()
+
+    def close(self) -> None:
+        self.wait()
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -1,5 +1,7 @@
+import math
 import torch
-from torch.utils.data import Dataset
+import torch.distributed as dist
+from torch.utils.data import DataLoader, Dataset, Sampler
 
 
 class SingleDatasetCreator(Dataset):
@@ -37,4 +39,115 @@ class DualDatasetCreator(Dataset):
 def count_params(net):
     n_params = sum(p.numel() for p in net.parameters() if p.requires_grad)
 
-    return n_params
\ No newline at end of file
+    return n_params
+
+
+class BatchSingleDatasetCreator(Dataset):
+    """Batch-indexed counterpart of SingleDatasetCreator.
+
+    The dataset is indexed with a whole tensor of sample indices (as yielded by
+    BatchIndexSampler) and returns the batch with a single gather, so no
+    per-sample __getitem__ calls or collation are needed. Labels are converted
+    to long once at construction and both tensors are moved to shared memory
+    so that DataLoader workers read them without copying.
+    """
+    def __init__(self, data, labels):
+        self.data = data.share_memory_()
+        self.labels = labels.to(dtype=torch.long).share_memory_()
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, indices):
+        datum = torch.index_select(self.data, 0, indices)
+        label = torch.index_select(self.labels, 0, indices)
+
+        return (datum, label)
+
+
+class BatchDualDatasetCreator(Dataset):
+    """Batch-indexed counterpart of DualDatasetCreator."""
+    def __init__(self, data1, data2, labels):
+        self.data1 = data1.share_memory_()
+        self.data2 = data2.share_memory_()
+        self.labels = labels.to(dtype=torch.long).share_memory_()
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, indices):
+        datum1 = torch.index_select(self.data1, 0, indices)
+        datum2 = torch.index_select(self.data2, 0, indices)
+        label = torch.index_select(self.labels, 0, indices)
+
+        return (datum1, datum2, label)
+
+
+class BatchIndexSampler(Sampler):
+    """Yields one LongTensor of sample indices per batch.
+
+    With world_size > 1 every rank gets a disjoint, equally long share of the
+    samples. The shuffle then comes from a generator seeded with seed + epoch
+    (see set_epoch), so that all ranks agree on the permutation. With
+    shard=False every rank reads all the samples in that same order instead.
+    """
+    def __init__(self, num_samples: int, batch_size: int, shuffle: bool = False, drop_last: bool = True, 
+                 rank: int = 0, world_size: int = 1, seed: int = 0, shard: bool = True):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.shard = shard
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __len__(self):
+        num_samples = self.num_samples // self.world_size if self.shard else self.num_samples
+        if self.drop_last:
+            return num_samples // self.batch_size
+        return math.ceil(num_samples / self.batch_size)
+
+    def __iter__(self):
+        if self.world_size == 1:
+            if self.shuffle:
+                order = torch.randperm(self.num_samples)
+            else:
+                order = torch.arange(self.num_samples)
+        else:
+            if self.shuffle:
+                generator = torch.Generator()
+                generator.manual_seed(self.seed + self.epoch)
+                order = torch.randperm(self.num_samples, generator=generator)
+            else:
+                order = torch.arange(self.num_samples)
+            if self.shard:
+                order = order[:self.num_samples - self.num_samples % self.world_size][self.rank::self.world_size]
+
+        for start in range(0, len(self) * self.batch_size, self.batch_size):
+            yield order[start:start + self.batch_size]
+
+
+def create_dataloader(dataset, batch_size: int, shuffle: bool = False, drop_last: bool = True, num_workers: int = 0, 
+                      shard: bool = True) -> DataLoader:
+    # batch_size=None disables automatic batching: every index tensor from the
+    # sampler is handed to the dataset as is and the batch is returned uncollated.
+    # Under torch.distributed every rank reads its own share of the dataset, or
+    # with shard=False (sequence parallelism) the same batches as all other ranks.
+    if dist.is_available() and dist.is_initialized():
+        sampler = BatchIndexSampler(len(dataset), batch_size, shuffle, drop_last, 
+                                    rank=dist.get_rank(), world_size=dist.get_world_size(), shard=shard)
+    else:
+        sampler = BatchIndexSampler(len(dataset), batch_size, shuffle, drop_last)
+
+    return DataLoader(
+        dataset = dataset,
+        sampler = sampler,
+        batch_size = None,
+        num_workers = num_workers,
+        persistent_workers = num_workers > 0
+    )
@@ -0,0 +1,97 @@
+# Data-parallel training across local processes.
+#
+# Launch any entry point through torchrun, e.g. four processes on one box:
+#
+#     torchrun --standalone --nproc_per_node 4 lra_main.py --dataset text --xformer converter
+#
+# Every process runs the same script. setup() reads the rank from the
+# environment torchrun provides, joins the process group (gloo on CPU, nccl
+# on CUDA) and pins the process to its own contiguous range of the cores it
+# may run on, with as many intra-op threads as cores in the range. Without
+# torchrun, setup() does nothing and training runs in a single process.
+
+import os
+import torch
+import torch.distributed as dist
+
+
+def is_enabled() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def rank() -> int:
+    return dist.get_rank() if is_enabled() else 0
+
+
+def world_size() -> int:
+    return dist.get_world_size() if is_enabled() else 1
+
+
+def is_main() -> bool:
+    return rank() == 0
+
+
+def backend():
+    return dist.get_backend() if is_enabled() else None
+
+
+def pin_cores(local_rank: int, local_world_size: int):
+    """Restrict this process to the local_rank-th of local_world_size equal core ranges."""
+    if not hasattr(os, 'sched_setaffinity'):
+        return None
+    cores = sorted(os.sched_getaffinity(0))
+    per_rank = len(cores) // local_world_size
+    if per_rank == 0:
+        return None
+    cores = cores[local_rank * per_rank:(local_rank + 1) * per_rank]
+    os.sched_setaffinity(0, cores)
+    # torchrun sets OMP_NUM_THREADS=1; use the whole range instead
+    torch.set_num_threads(len(cores))
+
+    return cores
+
+
+def setup(device: torch.device, pin: bool = True) -> torch.device:
+    """Join the process group when launched by torchrun; returns the device of this rank."""
+    if ('RANK' not in os.environ) or ('WORLD_SIZE' not in os.environ) or (int(os.environ['WORLD_SIZE']) == 1):
+        return device
+
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', os.environ['WORLD_SIZE']))
+    if device.type == 'cuda':
+        device = torch.device('cuda', local_rank)
+        torch.cuda.set_device(device)
+        dist.init_process_group(backend='nccl')
+    else:
+        if pin is True:
+            cores = pin_cores(local_rank, local_world_size)
+            if cores is not None:
+                print(f'rank {os.environ["RANK"]}: cores {cores[0]}-{cores[-1]}')
+        dist.init_process_group(backend='gloo')
+
+    # same weights on every rank (DDP broadcasts them), but independent dropout masks
+    torch.manual_seed(torch.initial_seed() + rank())
+
+    return device
+
+
+def all_reduce_(tensor: torch.Tensor, op=None) -> torch.Tensor:
+    if is_enabled():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM if op is None else op)
+    return tensor
+
+
+def broadcast_(tensor: torch.Tensor, src: int = 0) -> torch.Tensor:
+    if is_enabled():
+        dist.broadcast(tensor, src=src)
+    return tensor
+
+
+def barrier() -> None:
+    if is_enabled():
+        dist.barrier()
+
+
+def cleanup() -> None:
+    if is_enabled():
+        dist.destroy_process_group()
@@ -1,10 +1,12 @@
 import math
 import torch
 
+from . import distributed
+
 
 class EarlyStopping:
     """Early stops the training if validation loss doesn't improve after a given patience."""
-    def __init__(self, delta: float = 0.0, patience: int = 7, verbose: bool = True, path: str = 'checkpoint.pt'):
+    def __init__(self, delta: float = 0.0, patience: int = 7, verbose: bool = True, path: str = 'checkpoint.pt', manager=None, save=torch.save):
         """
         Args:
             patience (int): How long to wait after last time validation loss improved.
@@ -15,6 +17,11 @@ class EarlyStopping:
                             Default: 0
             path (str): Path for the checkpoint to be saved to.
                             Default: 'checkpoint.pt'           
+            manager (CheckpointManager): If given, the checkpoint is written in the background
+                            and the best weights are also kept in memory (best_state).
+                            Default: None
+            save (callable): Serializer of the weights, e.g. torch.save or weights.save_flat.
+                            Default: torch.save
         """
         self.patience = patience
         self.verbose = verbose
@@ -24,6 +31,9 @@ class EarlyStopping:
         self.val_loss_min = math.inf
         self.delta = delta
         self.path = path
+        self.manager = manager
+        self.best_state = None
+        self.save = save
 
     def __call__(self, val_loss, model):
 
@@ -34,7 +44,8 @@ class EarlyStopping:
             self.save_checkpoint(val_loss, model)
         elif score <= self.best_score + self.delta:
             self.counter += 1
-            print(f'EarlyStopping counter: {self.counter} out of {self.patience}')
+            if distributed.is_main():
+                print(f'EarlyStopping counter: {self.counter} out of {self.patience}')
             if self.counter >= self.patience:
                 self.early_stop = True
         else:
@@ -43,7 +54,24 @@ class EarlyStopping:
             self.counter = 0
 
     def save_checkpoint(self, val_loss, model):
-        if self.verbose:
+        if self.verbose and distributed.is_main():
             print(f'Validation loss decreased ({self.val_loss_min:.4f} --> {val_loss:.4f}). Saving model...')
-        torch.save(model.state_dict(), self.path)
-        self.val_loss_min = val_loss
\ No newline at end of file
+        if self.manager is None:
+            self.save(model.state_dict(), self.path)
+        else:
+            self.best_state = self.manager.save(model.state_dict(), self.path, self.save)
+        self.val_loss_min = val_loss
+
+    def state_dict(self):
+        return {
+            'counter': self.counter,
+            'best_score': self.best_score,
+            'early_stop': self.early_stop,
+            'val_loss_min': self.val_loss_min
+        }
+
+    def load_state_dict(self, state_dict):
+        self.counter = state_dict['counter']
+        self.best_score = state_dict['best_score']
+        self.early_stop = state_dict['early_stop']
+        self.val_loss_min = state_dict['val_loss_min']
@@ -0,0 +1,481 @@
+import os
+import math
+import queue
+import threading
+import torch
+
+from contextlib import nullcontext
+from torch.nn.parallel import DistributedDataParallel
+from tqdm import tqdm
+from . import checkpoint, distributed, metrices, microbatch, recompute, sequence_parallel, weights
+
+
+class SingleTask:
+    """Task adapter for loaders yielding (samples, targets) and LRASingle."""
+    def split(self, batch):
+        samples, targets = batch
+        return (samples,), targets
+
+    def num_tokens(self, inputs) -> int:
+        return inputs[0].numel()
+
+
+class DualTask:
+    """Task adapter for loaders yielding (samples_1, samples_2, targets) and LRADual."""
+    def split(self, batch):
+        samples_1, samples_2, targets = batch
+        return (samples_1, samples_2), targets
+
+    def num_tokens(self, inputs) -> int:
+        return inputs[0].numel() + inputs[1].numel()
+
+
+def create_task(args):
+    if args.dataset == 'retrieval':
+        return DualTask()
+    return SingleTask()
+
+
+def uses_kp_loss(namespace, args) -> bool:
+    """The Kernel Polynomial loss on the Chebyshev coefficients is only mixed in
+    for the converter with KPM, KP loss and a 'none' or 'dirichlet' kernel."""
+    converter = args.xformer.converter
+    return (namespace.xformer == 'converter') and \
+        (converter.enable_kpm is True) and \
+        (converter.enable_kploss is True) and \
+        (converter.kernel_type == 'none' or converter.kernel_type == 'dirichlet')
+
+
+def create_criterion(namespace, args, model, loss_cel, loss_seq_kp):
+    """Compose the training loss once instead of re-checking the config on every step."""
+    if uses_kp_loss(namespace, args):
+        eta = args.xformer.converter.eta
+        seq_kernel_poly = model.xformer.kernelution.seq_kernel_poly
+
+        def criterion(preds, targets):
+            return (1 - eta) * loss_cel(preds.reshape(targets.size(0), -1), targets) + eta * loss_seq_kp(seq_kernel_poly.cheb_coef)
+    else:
+        def criterion(preds, targets):
+            return loss_cel(preds.reshape(targets.size(0), -1), targets)
+
+    return criterion
+
+
+class Prefetcher:
+    """Produces the batches of a loader in a background thread.
+
+    Assembling a batch (index_select on the in-RAM tensors, or waiting for
+    loader workers) overlaps with the forward and backward of the previous
+    one. On CUDA the batches are pinned so that the copy in transfer() is
+    asynchronous. With depth=0 the loader is iterated in the calling thread.
+    """
+    _end = object()
+
+    def __init__(self, loader, device, depth=2) -> None:
+        self.loader = loader
+        self.device = device
+        self.depth = depth
+        self.pin_memory = device.type == 'cuda'
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _prepare(self, batch):
+        if self.pin_memory:
+            return [tensor.pin_memory() for tensor in batch]
+        return batch
+
+    def _produce(self, buffer, stop_event):
+        try:
+            for batch in self.loader:
+                batch = self._prepare(batch)
+                while not stop_event.is_set():
+                    try:
+                        buffer.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop_event.is_set():
+                    return
+        except Exception as e:
+            buffer.put(e)
+            return
+        buffer.put(self._end)
+
+    def __iter__(self):
+        if self.depth == 0:
+            for batch in self.loader:
+                yield self._prepare(batch)
+            return
+
+        buffer = queue.Queue(maxsize=self.depth)
+        stop_event = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(buffer, stop_event), daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = buffer.get()
+                if batch is self._end:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop_event.set()
+            thread.join()
+
+    def transfer(self, batch):
+        return [tensor.to(self.device, non_blocking=self.pin_memory) for tensor in batch]
+
+
+class Trainer:
+    """Train/val/test loops shared by lra_main, genome_main and ld_main.
+
+    The task adapter decides how a batch is split into model inputs and
+    targets, so single and dual (retrieval) tasks run through the same loop.
+    The optional performance features are read from the task config:
+
+        effective_batch_size: samples per optimizer step; gradients of
+            effective_batch_size / batch_size loader batches are accumulated.
+        micro_batch_size: samples per forward/backward. Each loader batch is
+            split into micro-batches, and the batch-shaped parameters
+            (KernelPolynomial.cheb_coef, synthesizer random attention) are
+            sliced to the rows of the micro-batch.
+        memory_budget: MiB of saved activations per micro-batch; used to size
+            the micro-batches on the first batch when micro_batch_size is null.
+        precision: 'fp32', 'bf16' or 'fp16' autocast (fp16 uses a GradScaler).
+        compile: run the forward through torch.compile.
+        prefetch_depth: batches assembled ahead in a background thread.
+        topk: ks of the top-k accuracies logged after every loop, next to the
+            (top-1) accuracy the loops return.
+        activation_checkpointing / checkpoint_every_n_blocks: submodules
+            whose activations are recomputed in backward (see recompute).
+        ddp_bucket_cap_mb: gradient bucket size when launched by torchrun.
+        xformer.performer.feature_redraw_interval: optimizer steps between
+            redraws of the Performer's random features (see
+            step_feature_redraw).
+        sequence_parallel: under torchrun, every rank reads the same batches
+            and runs the Kernelutions on its shard of every sequence (see
+            sequence_parallel) instead of reading its own share of batches.
+
+    Under torchrun the forward model is wrapped in DistributedDataParallel.
+    Each rank reads its own share of every loader, the loop metrics are
+    all-reduced, gradients are only synchronized on the last backward of an
+    accumulation window, and only rank 0 prints and writes checkpoints.
+
+    The uncompiled model is kept for EarlyStopping and the KP loss, so
+    checkpoints keep their original state_dict keys.
+
+    Checkpoints are written in the background by a CheckpointManager: the
+    best weights by EarlyStopping (and kept in memory for test()), and after
+    every epoch the full training state (model, optimizer, scheduler, grad
+    scaler, early stopping and RNG) to `<xformer>_<dataset>_last.pt`, from
+    which fit() continues when the entry point runs with --resume.
+    """
+    def __init__(self, namespace, args, model, optimizer, scheduler, es, monitor, recorder, loss_cel, loss_seq_kp, device) -> None:
+        self.namespace = namespace
+        self.args = args
+        self.model = model
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        self.es = es
+        self.monitor = monitor
+        self.recorder = recorder
+        self.device = device
+        self.task = create_task(args)
+        self.criterion = create_criterion(namespace, args, model, loss_cel, loss_seq_kp)
+        self.checkpoint_path = namespace.xformer + "_" + args.dataset + ".pt"
+        self.state_path = namespace.xformer + "_" + args.dataset + "_last.pt"
+        if es.manager is None:
+            es.manager = checkpoint.CheckpointManager(write=distributed.is_main())
+        self.checkpoints = es.manager
+        self.epoch = 0
+        self.optimizer_steps = 0
+        # val accuracy of the epoch with the lowest val loss, i.e. of the weights EarlyStopping keeps
+        self.acc_val_best = 0.0
+        # modules with random features redrawn every feature_redraw_interval optimizer steps
+        self.redraw_modules = [module for module in model.modules() if getattr(module, 'feature_redraw_interval', None) is not None]
+        self.redraw_seed = None
+        if len(self.redraw_modules) > 0:
+            # from a generator of its own, so the dropout and shuffle streams are the same as with any
+            # other encoder; seeded with the run seed of rank 0 (distributed.setup offsets the other
+            # ranks) and broadcast, so all ranks redraw the same features
+            generator = torch.Generator()
+            generator.manual_seed(torch.initial_seed())
+            redraw_seed = torch.randint(2 ** 62, (), generator=generator).to(device)
+            self.redraw_seed = int(distributed.broadcast_(redraw_seed).item())
+
+        if args.effective_batch_size is None:
+            self.accumulation_steps = 1
+        elif args.effective_batch_size % args.batch_size != 0:
+            raise ValueError(f'ERROR: The effective batch size {args.effective_batch_size} is not a multiple of the batch size {args.batch_size}.')
+        else:
+            self.accumulation_steps = args.effective_batch_size // args.batch_size
+        self.micro_batch_size = args.micro_batch_size
+        self.topk = args.topk
+        self.memory_budget = args.memory_budget
+        self.prefetch_depth = args.prefetch_depth
+
+        if args.precision == 'fp32':
+            self.autocast_dtype = None
+        elif args.precision == 'bf16':
+            self.autocast_dtype = torch.bfloat16
+        elif args.precision == 'fp16':
+            self.autocast_dtype = torch.float16
+        else:
+            raise ValueError(f'ERROR: The {args.precision} precision is undefined.')
+        self.scaler = torch.amp.GradScaler(device.type, enabled=(args.precision == 'fp16'))
+
+        checkpointed = recompute.apply_policy(model, args.activation_checkpointing, args.checkpoint_every_n_blocks)
+        if len(checkpointed) > 0:
+            print(f'activation checkpointing: {", ".join(checkpointed)}')
+
+        if (args.sequence_parallel is True) and distributed.is_enabled():
+            switched = sequence_parallel.apply(model)
+            if len(switched) == 0:
+                raise ValueError(f'ERROR: The {namespace.xformer} encoder has no Kernelution to run sequence-parallel.')
+            self.log(f'sequence parallel over {distributed.world_size()} ranks: {", ".join(switched)}')
+
+        self.ddp = None
+        forward_model = model
+        if distributed.is_enabled():
+            # Without accumulation the set of parameters that get gradients is the
+            # same every step, so the graph can be treated as static (which also
+            # covers parameters a config leaves unused, e.g. cheb_coef without KPM).
+            # no_sync() during accumulation needs the dynamic unused-parameter search.
+            static_graph = (self.accumulation_steps == 1) and (self.micro_batch_size is None) and (self.memory_budget is None)
+            self.ddp = DistributedDataParallel(model, 
+                                               device_ids=[device] if device.type == 'cuda' else None, 
+                                               bucket_cap_mb=args.ddp_bucket_cap_mb, 
+                                               gradient_as_bucket_view=True, 
+                                               static_graph=static_graph, 
+                                               find_unused_parameters=not static_graph)
+            forward_model = self.ddp
+        if args.compile is True:
+            forward_model = torch.compile(forward_model)
+        self.forward_model = forward_model
+        self.batch_params = microbatch.batch_shaped_parameters(self.forward_model)
+
+    def autocast(self):
+        if self.autocast_dtype is None:
+            return nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=self.autocast_dtype)
+
+    def sync(self, enabled: bool):
+        """Skip the DDP gradient all-reduce unless `enabled` (the last backward before a step)."""
+        if (self.ddp is None) or enabled:
+            return nullcontext()
+        return self.ddp.no_sync()
+
+    def log(self, message: str) -> None:
+        if distributed.is_main():
+            print(message)
+
+    def fit(self, train_loader, val_loader):
+        start_epoch = 1
+        metrics = (0.0, math.inf, 0.0, math.inf, 0)
+        if self.namespace.resume is True:
+            start_epoch, metrics = self.resume()
+        acc_train, loss_train, acc_val, loss_val, peak_memory_train = metrics
+
+        for epoch in range(start_epoch, self.args.epochs + 1):
+            if self.es.early_stop:
+                break
+            self.epoch = epoch
+            acc_train, loss_train, peak_memory_train = self.train(train_loader)
+            acc_val, loss_val = self.evaluate(val_loader, loop='val')
+            self.log(f'train acc: {acc_train: .2f}%')
+            self.log(f'train loss: {loss_train: .4f}')
+            self.log(f'val acc: {acc_val: .2f}%')
+            self.log(f'val loss: {loss_val: .4f}')
+
+            self.es(loss_val, self.model)
+            if self.es.counter == 0:
+                self.acc_val_best = acc_val
+            self.save_state(epoch, (acc_train, loss_train, acc_val, loss_val, peak_memory_train))
+            if self.es.early_stop:
+                self.log("Early stopping")
+                break
+
+        self.checkpoints.wait()
+
+        return acc_train, loss_train, acc_val, loss_val, peak_memory_train
+
+    def save_state(self, epoch, metrics) -> None:
+        if not distributed.is_main():
+            return
+        self.checkpoints.save({
+            'epoch': epoch,
+            'metrics': metrics,
+            'model': self.model.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'scheduler': self.scheduler.state_dict(),
+            'scaler': self.scaler.state_dict(),
+            'early_stopping': self.es.state_dict(),
+            'optimizer_steps': self.optimizer_steps,
+            'acc_val_best': self.acc_val_best,
+            'redraw_seed': self.redraw_seed,
+            'rng': checkpoint.rng_state()
+        }, self.state_path)
+
+    def resume(self):
+        """Restore the state saved after the last finished epoch; returns the epoch to continue from."""
+        if not os.path.exists(self.state_path):
+            self.log(f'No training state at {self.state_path}, starting from scratch.')
+            return 1, (0.0, math.inf, 0.0, math.inf, 0)
+
+        state = torch.load(self.state_path, map_location='cpu', weights_only=False)
+        self.model.load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.scheduler.load_state_dict(state['scheduler'])
+        self.scaler.load_state_dict(state['scaler'])
+        self.es.load_state_dict(state['early_stopping'])
+        self.optimizer_steps = state['optimizer_steps']
+        self.acc_val_best = state['acc_val_best']
+        self.redraw_seed = state['redraw_seed']
+        checkpoint.set_rng_state(state['rng'])
+        if distributed.is_enabled():
+            # rank 0 saved the RNG; derive distinct dropout streams for the ranks again
+            torch.manual_seed(int(torch.randint(2 ** 62, ())) + distributed.rank())
+        if os.path.exists(self.checkpoint_path):
+            self.es.best_state = weights.load(self.checkpoint_path)
+        self.recorder.epoch = state['epoch']
+        self.log(f'Resumed from epoch {state["epoch"]} of {self.state_path}.')
+
+        return state['epoch'] + 1, state['metrics']
+
+    def train(self, dataloader):
+        self.model.train()
+
+        meter = metrices.DeviceMeter(self.device, self.topk)
+        if hasattr(dataloader.sampler, 'set_epoch'):
+            dataloader.sampler.set_epoch(self.epoch)
+        loader = Prefetcher(dataloader, self.device, self.prefetch_depth)
+        recorder = self.recorder
+
+        recorder.start_loop('train')
+        pbar = tqdm(enumerate(recorder.wrap(loader)), total=len(loader), desc="Training", disable=not distributed.is_main())
+
+        self.optimizer.zero_grad(set_to_none=True)
+        for step, batch in pbar:
+            with recorder.phase('transfer'):
+                inputs, targets = self.task.split(loader.transfer(batch))
+
+            if (self.micro_batch_size is None) and (self.memory_budget is not None):
+                with self.autocast():
+                    self.micro_batch_size = microbatch.plan_micro_batch_size(self.model, inputs, self.memory_budget)
+                self.log(f'micro-batch size: {self.micro_batch_size}')
+
+            boundary = ((step + 1) % self.accumulation_steps == 0) or (step + 1 == len(loader))
+
+            def step_fn():
+                batch_size = targets.size(0)
+                parts = microbatch.split_batch(batch_size, self.micro_batch_size or batch_size)
+                preds_parts = []
+                loss_sum = 0
+                for part_id, part in enumerate(parts):
+                    # Weighting every micro-batch by its share of the batch gives the
+                    # full-batch mean. The KP term is computed on all rows of cheb_coef
+                    # each time, so its weighted sum is the full-batch KP loss as well.
+                    weight = (part.stop - part.start) / batch_size
+                    with self.sync(boundary and (part_id == len(parts) - 1)):
+                        with recorder.phase('forward'), self.autocast():
+                            if len(parts) == 1:
+                                preds = self.forward_model(*inputs)
+                            else:
+                                preds = microbatch.batch_call(self.forward_model, self.batch_params, part, *[input[part] for input in inputs])
+                            loss = self.criterion(preds, targets[part])
+                        with recorder.phase('backward'):
+                            self.scaler.scale(loss * weight / self.accumulation_steps).backward()
+                    preds_parts.append(preds.detach())
+                    loss_sum = loss_sum + loss.detach() * weight
+
+                return torch.cat(preds_parts), loss_sum
+
+            self.monitor.begin_step()
+            preds, loss = step_fn()
+            # with fp16 the GradScaler handles (and skips) overflowing gradients itself
+            if not self.monitor.check(loss, grads=not self.scaler.is_enabled()):
+                self.monitor.diagnose(step_fn)
+                self.optimizer.zero_grad(set_to_none=True)
+            elif boundary:
+                with recorder.phase('optimizer'):
+                    self.scaler.step(self.optimizer)
+                    self.scaler.update()
+                    self.optimizer.zero_grad(set_to_none=True)
+                    self.step_feature_redraw()
+
+            meter.update(loss, preds.squeeze(), targets)
+            recorder.end_step(targets.size(0), self.task.num_tokens(inputs))
+
+            if (step + 1) % self.args.log_interval == 0:
+                pbar.set_postfix(loss=meter.compute()[1])
+
+        recorder.end_loop()
+
+        # self.scheduler.step()
+        peak_memory = recorder.peak_memory('train')
+
+        meter.all_reduce()
+        accs, loss = meter.compute()
+        if len(meter.topk) > 1:
+            self.log(metrices.format_topk('train', meter.topk, accs))
+
+        return accs[0], loss, peak_memory
+
+    def step_feature_redraw(self) -> None:
+        """Count an optimizer step and redraw the random features that are due.
+
+        The generator is seeded with the shared redraw seed and the step, so
+        every rank draws the same features, also after --resume.
+        """
+        self.optimizer_steps += 1
+        for module in self.redraw_modules:
+            if self.optimizer_steps % module.feature_redraw_interval == 0:
+                generator = torch.Generator()
+                generator.manual_seed(self.redraw_seed + self.optimizer_steps)
+                module.redraw_projection_matrices(self.device, generator=generator)
+
+    @torch.no_grad()
+    def evaluate(self, dataloader, loop='val'):
+        self.model.eval()
+
+        meter = metrices.DeviceMeter(self.device, self.topk)
+        loader = Prefetcher(dataloader, self.device, self.prefetch_depth)
+        recorder = self.recorder
+
+        recorder.start_loop(loop)
+        desc = "Validation" if loop == 'val' else "Testing"
+        pbar = tqdm(enumerate(recorder.wrap(loader)), total=len(loader), desc=desc, disable=not distributed.is_main())
+
+        for step, batch in pbar:
+            with recorder.phase('transfer'):
+                inputs, targets = self.task.split(loader.transfer(batch))
+
+            with recorder.phase('forward'), self.autocast():
+                preds = self.forward_model(*inputs)
+                loss = self.criterion(preds, targets)
+
+            meter.update(loss, preds.squeeze(), targets)
+            recorder.end_step(targets.size(0), self.task.num_tokens(inputs))
+
+            if (step + 1) % self.args.log_interval == 0:
+                pbar.set_postfix(loss=meter.compute()[1])
+
+        recorder.end_loop()
+
+        meter.all_reduce()
+        accs, loss = meter.compute()
+        if len(meter.topk) > 1:
+            self.log(metrices.format_topk(loop, meter.topk, accs))
+
+        return accs[0], loss
+
+    def test(self, dataloader):
+        # the best weights are still in memory unless nothing improved in this process
+        if self.es.best_state is not None:
+            self.model.load_state_dict(self.es.best_state)
+        else:
+            weights.load_into(self.model, self.checkpoint_path)
+
+        return self.evaluate(dataloader, loop='test')
@@ -0,0 +1,296 @@
+import math
+import torch
+import torch.nn as nn
+
+from contextlib import nullcontext
+from torch.func import functional_call, vmap
+from tqdm import tqdm
+from typing import List
+from . import checkpoint, distributed, metrices, weights
+from .engine import Prefetcher, create_task, uses_kp_loss
+
+
+def unroll_recurrences(model: nn.Module) -> List[str]:
+    """Switch the GRU position embeddings to their step-by-step form, which vmap can batch."""
+    selected = []
+    for name, module in model.named_modules():
+        if type(module).__name__ == 'RecurrentPositionEmbedding':
+            module.unrolled = True
+            selected.append(name)
+
+    return selected
+
+
+class SeededDropout(nn.Module):
+    """nn.Dropout that applies the keep masks set in `masks` instead of drawing them."""
+    def __init__(self, p: float = 0.5) -> None:
+        super(SeededDropout, self).__init__()
+        self.p = p
+        self.masks = []
+
+    def forward(self, input):
+        if (not self.training) or (self.p == 0):
+            return input
+        mask = self.masks.pop(0)
+
+        return input.masked_fill(~mask, 0) / (1 - self.p)
+
+    def extra_repr(self) -> str:
+        return f'p={self.p}'
+
+
+def seed_dropouts(model: nn.Module) -> List[str]:
+    """Replace every nn.Dropout of model by a SeededDropout with the same probability."""
+    selected = []
+    for name, module in list(model.named_modules()):
+        if type(module) is nn.Dropout:
+            parent, _, child = name.rpartition('.')
+            setattr(model.get_submodule(parent), child, SeededDropout(module.p))
+            selected.append(name)
+
+    return selected
+
+
+class EnsembleTrainer:
+    """Trains one model per seed in a single process on the same batches.
+
+    The parameters of the active copies are stacked along a new leading
+    dimension on every step and the first copy is run over them with
+    torch.func.functional_call under vmap, so every op processes all copies
+    at once. Gradients flow back through the stack to the parameters of each
+    copy, which keeps its own optimizer (and optimizer state) and its own
+    EarlyStopping; a copy that stops early is dropped from the stack.
+
+    Every copy draws its dropout masks from its own torch.Generator seeded
+    with its seed: the nn.Dropout modules are replaced by SeededDropout, and
+    the keep masks of a step are drawn outside vmap and passed in as a
+    vmapped input, so a copy sees the same masks whichever copies run next
+    to it. The mask shapes are probed once per input shape with an eval
+    forward. Functional dropouts (e.g. between GRU layers) still draw from
+    the process RNG, under randomness='different'. Micro-batching, gradient accumulation, activation
+    checkpointing, torch.compile, fp16, --resume and torchrun are not
+    supported in this mode.
+    """
+    def __init__(self, namespace, args, models, optimizers, stoppers, recorder, loss_cel, loss_seq_kp, device) -> None:
+        if distributed.is_enabled():
+            raise ValueError('ERROR: The seed ensemble runs in a single process; do not launch it with torchrun.')
+        if namespace.resume is True:
+            raise ValueError('ERROR: The seed ensemble cannot resume from a training state.')
+        for key in ['effective_batch_size', 'micro_batch_size', 'memory_budget', 'activation_checkpointing']:
+            if getattr(args, key) is not None:
+                raise ValueError(f'ERROR: {key} is not supported by the seed ensemble.')
+        if (args.compile is True) or (args.precision == 'fp16'):
+            raise ValueError('ERROR: The seed ensemble supports neither compile nor fp16.')
+
+        self.namespace = namespace
+        self.args = args
+        self.models = models
+        self.optimizers = optimizers
+        self.stoppers = stoppers
+        self.recorder = recorder
+        self.device = device
+        self.seeds = namespace.seeds
+        self.task = create_task(args)
+        self.prefetch_depth = args.prefetch_depth
+        self.topk = metrices.normalize_topk(args.topk)
+        self.autocast_dtype = torch.bfloat16 if args.precision == 'bf16' else None
+
+        manager = checkpoint.CheckpointManager()
+        for es in stoppers:
+            es.manager = manager
+        self.checkpoints = manager
+
+        for model in models:
+            unroll_recurrences(model)
+            seed_dropouts(model)
+        # the first copy runs the forward for all of them
+        self.template = models[0]
+        self.params = [dict(model.named_parameters()) for model in models]
+        self.buffers = [dict(model.named_buffers()) for model in models]
+        self.active = list(range(len(models)))
+        self.dropouts = {name: module for name, module in self.template.named_modules()
+                         if isinstance(module, SeededDropout) and module.p > 0}
+        self.generators = [torch.Generator(device=device).manual_seed(seed) for seed in self.seeds]
+        # input shapes -> (dropout name, mask shape) in call order
+        self.mask_shapes = {}
+
+        kp_key = None
+        if uses_kp_loss(namespace, args):
+            kp_key = 'xformer.kernelution.seq_kernel_poly.cheb_coef'
+        eta = args.xformer.converter.eta
+
+        def compute(params, buffers, masks, inputs, targets):
+            for name, module in self.dropouts.items():
+                module.masks = list(masks.get(name, ()))
+            preds = functional_call(self.template, (params, buffers), inputs)
+            loss = loss_cel(preds.reshape(targets.size(0), -1), targets)
+            if kp_key is not None:
+                loss = (1 - eta) * loss + eta * loss_seq_kp(params[kp_key])
+            return loss, preds
+
+        self.compute = vmap(compute, in_dims=(0, 0, 0, None, None), randomness='different')
+
+    def autocast(self):
+        if self.autocast_dtype is None:
+            return nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=self.autocast_dtype)
+
+    def stack(self, indices):
+        params = {name: torch.stack([self.params[i][name] for i in indices]) for name in self.params[0]}
+        buffers = {name: torch.stack([self.buffers[i][name] for i in indices]) for name in self.buffers[0]}
+
+        return params, buffers
+
+    @torch.no_grad()
+    def probe_mask_shapes(self, inputs):
+        key = tuple(input.shape for input in inputs)
+        if key not in self.mask_shapes:
+            shapes = []
+            hooks = [module.register_forward_pre_hook(
+                         lambda module, args, name=name: shapes.append((name, args[0].shape)))
+                     for name, module in self.dropouts.items()]
+            self.template.eval()
+            try:
+                self.template(*inputs)
+            finally:
+                self.template.train()
+                for hook in hooks:
+                    hook.remove()
+            self.mask_shapes[key] = shapes
+
+        return self.mask_shapes[key]
+
+    def draw_masks(self, indices, inputs):
+        """Keep masks of every dropout call, stacked over the copies in indices."""
+        masks = {}
+        for name, shape in self.probe_mask_shapes(inputs):
+            p = self.dropouts[name].p
+            mask = torch.stack([torch.rand(shape, generator=self.generators[i], device=self.device) >= p
+                                for i in indices])
+            masks.setdefault(name, []).append(mask)
+
+        return masks
+
+    def fit(self, train_loader, val_loader):
+        metrics = [(0.0, math.inf, 0.0, math.inf)] * len(self.models)
+        peak_memory_train = 0
+
+        for epoch in range(1, self.args.epochs + 1):
+            if len(self.active) == 0:
+                break
+            train_metrics, peak_memory_train = self.train(train_loader)
+            val_metrics = self.evaluate(val_loader, self.active, loop='val')
+
+            for i, (accs_train, loss_train), (accs_val, loss_val) in zip(list(self.active), train_metrics, val_metrics):
+                acc_train, acc_val = accs_train[0], accs_val[0]
+                metrics[i] = (acc_train, loss_train, acc_val, loss_val)
+                print(f'seed {self.seeds[i]}: train acc: {acc_train: .2f}%  train loss: {loss_train: .4f}  '
+                      f'val acc: {acc_val: .2f}%  val loss: {loss_val: .4f}')
+                if len(self.topk) > 1:
+                    print(f'seed {self.seeds[i]}: {metrices.format_topk("train", self.topk, accs_train)}  '
+                          f'{metrices.format_topk("val", self.topk, accs_val)}')
+                self.stoppers[i](loss_val, self.models[i])
+                if self.stoppers[i].early_stop:
+                    print(f'seed {self.seeds[i]}: early stopping')
+                    self.active.remove(i)
+
+        self.checkpoints.wait()
+
+        acc_train, loss_train, acc_val, loss_val = (sum(values) / len(values) for values in zip(*metrics))
+
+        return acc_train, loss_train, acc_val, loss_val, peak_memory_train
+
+    def train(self, dataloader):
+        indices = list(self.active)
+        for i in indices:
+            self.models[i].train()
+        self.template.train()
+
+        meters = [metrices.DeviceMeter(self.device, self.topk) for _ in indices]
+        loader = Prefetcher(dataloader, self.device, self.prefetch_depth)
+        recorder = self.recorder
+
+        recorder.start_loop('train')
+        pbar = tqdm(enumerate(recorder.wrap(loader)), total=len(loader), desc="Training")
+
+        for step, batch in pbar:
+            with recorder.phase('transfer'):
+                inputs, targets = self.task.split(loader.transfer(batch))
+
+            with recorder.phase('forward'), self.autocast():
+                params, buffers = self.stack(indices)
+                masks = self.draw_masks(indices, inputs)
+                losses, preds = self.compute(params, buffers, masks, inputs, targets)
+            with recorder.phase('backward'):
+                # the copies share no parameters, so the sum gives every copy its own gradient
+                losses.sum().backward()
+            with recorder.phase('optimizer'):
+                for i in indices:
+                    self.optimizers[i].step()
+                    self.optimizers[i].zero_grad(set_to_none=True)
+
+            for meter, loss, pred in zip(meters, losses.detach(), preds.detach()):
+                meter.update(loss, pred.squeeze(), targets)
+            recorder.end_step(targets.size(0) * len(indices), self.task.num_tokens(inputs) * len(indices))
+
+            if (step + 1) % self.args.log_interval == 0:
+                pbar.set_postfix(loss=sum(meter.compute()[1] for meter in meters) / len(meters))
+
+        recorder.end_loop()
+
+        return [meter.compute() for meter in meters], recorder.peak_memory('train')
+
+    @torch.no_grad()
+    def evaluate(self, dataloader, indices, loop='val'):
+        for i in indices:
+            self.models[i].eval()
+        self.template.eval()
+
+        meters = [metrices.DeviceMeter(self.device, self.topk) for _ in indices]
+        loader = Prefetcher(dataloader, self.device, self.prefetch_depth)
+        recorder = self.recorder
+
+        recorder.start_loop(loop)
+        desc = "Validation" if loop == 'val' else "Testing"
+        pbar = tqdm(enumerate(recorder.wrap(loader)), total=len(loader), desc=desc)
+
+        params, buffers = self.stack(indices)
+        for step, batch in pbar:
+            with recorder.phase('transfer'):
+                inputs, targets = self.task.split(loader.transfer(batch))
+
+            with recorder.phase('forward'), self.autocast():
+                losses, preds = self.compute(params, buffers, {}, inputs, targets)
+
+            for meter, loss, pred in zip(meters, losses, preds):
+                meter.update(loss, pred.squeeze(), targets)
+            recorder.end_step(targets.size(0) * len(indices), self.task.num_tokens(inputs) * len(indices))
+
+        recorder.end_loop()
+
+        return [meter.compute() for meter in meters]
+
+    def test(self, dataloader):
+        """Test the best weights of every seed; prints the per-seed results and returns their mean."""
+        for model, es in zip(self.models, self.stoppers):
+            if es.best_state is not None:
+                model.load_state_dict(es.best_state)
+            else:
+                weights.load_into(model, es.path)
+        # load_into may have replaced the parameter tensors
+        self.params = [dict(model.named_parameters()) for model in self.models]
+        self.buffers = [dict(model.named_buffers()) for model in self.models]
+
+        results = self.evaluate(dataloader, list(range(len(self.models))), loop='test')
+        for seed, (accs_test, loss_test) in zip(self.seeds, results):
+            print(f'seed {seed}: test acc: {accs_test[0]: .2f}%  test loss: {loss_test: .4f}')
+            if len(self.topk) > 1:
+                print(f'seed {seed}: {metrices.format_topk("test", self.topk, accs_test)}')
+        results = [(accs_test[0], loss_test) for accs_test, loss_test in results]
+        accs = torch.tensor([acc for acc, _ in results], dtype=torch.float64)
+        if len(results) > 1:
+            print(f'test acc over {len(results)} seeds: {accs.mean().item(): .2f}% +- {accs.std().item():.2f}')
+
+        acc_test, loss_test = (sum(values) / len(values) for values in zip(*results))
+
+        return acc_test, loss_test
@@ -0,0 +1,181 @@
+import gc
+import yaml
+import warnings
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from types import SimpleNamespace
+from torch.optim.lr_scheduler import CosineAnnealingLR
+from model import wrapper
+from utils import distributed, early_stopping, engine, ensemble, health, module_profiler, opt, los, run_cache, telemetry, weights
+
+SEED = 3407
+
+
+def dict_to_namespace(d):
+    if not isinstance(d, dict):
+        return d
+    namespace = SimpleNamespace()
+    for key, value in d.items():
+        setattr(namespace, key, dict_to_namespace(value))
+    return namespace
+
+
+def parse_parameters(parser):
+    """Add the options every entry point shares to parser, parse them and load the task section."""
+    parser.add_argument('--xformer', type=str, default='converter', help='Type of transformer to use')
+    parser.add_argument('--resume', action='store_true', help='Continue from the training state saved after the last finished epoch')
+    parser.add_argument('--seeds', type=int, nargs='+', default=None, help='Train one model per seed in a single process (vmap ensemble)')
+    namespace = parser.parse_args()
+
+    with open(namespace.config) as f:
+        config = yaml.safe_load(f)
+
+    args = dict_to_namespace(config[namespace.dataset])
+    print(args)
+
+    # Running in Nvidia GPU (CUDA) or CPU
+    if args.enable_cuda and torch.cuda.is_available():
+        # Set available CUDA devices
+        # This option is crucial for multiple GPUs
+        device = torch.device('cuda')
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+    else:
+        device = torch.device('cpu')
+        gc.collect()
+
+    return namespace, args, device
+
+
+def build_model(namespace, args, device):
+    if args.dataset == 'retrieval':
+        model = wrapper.LRADual(namespace, args).to(device)
+    else:
+        model = wrapper.LRASingle(namespace, args).to(device)
+
+    return model
+
+
+def create_optimizer(args, model):
+    if args.optimizer == 'adamw': # default
+        optimizer = optim.AdamW(params=model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
+    elif args.optimizer == 'nadamw':
+        optimizer = optim.NAdam(params=model.parameters(), lr=args.lr, weight_decay=args.weight_decay, decoupled_weight_decay=True)
+    elif args.optimizer == 'ademamix':
+        optimizer = opt.AdEMAMix(params=model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
+    else:
+        raise ValueError(f'ERROR: The {args.optimizer} optimizer is undefined.')
+
+    return optimizer
+
+
+def prepare_model(namespace, args, device):
+    model = build_model(namespace, args, device)
+
+    loss_cel = nn.CrossEntropyLoss()
+    loss_seq_kp = los.KernelPolynomialLoss(max_order=args.xformer.converter.max_order)
+
+    es = early_stopping.EarlyStopping(delta=0.0,
+                                      patience=args.patience,
+                                      verbose=True,
+                                      path=namespace.xformer + "_" + args.dataset + ".pt",
+                                      save=weights.saver(args.weights_format))
+
+    optimizer = create_optimizer(args, model)
+    scheduler = CosineAnnealingLR(optimizer=optimizer, T_max=3, eta_min=0.0005)
+
+    monitor = health.HealthMonitor(model, interval=args.health_check_interval)
+    modules = None
+    if args.module_profile_window is not None:
+        modules = module_profiler.ModuleProfiler(model,
+                                                 window=args.module_profile_window,
+                                                 path=namespace.xformer + "_" + args.dataset + "_modules.folded",
+                                                 device=device)
+    recorder = telemetry.Telemetry(path=args.telemetry_path,
+                                   device=device,
+                                   profile_window=args.profile_window,
+                                   trace_path=namespace.xformer + "_" + args.dataset + "_trace.json",
+                                   module_profiler=modules)
+
+    return model, loss_cel, loss_seq_kp, optimizer, scheduler, es, monitor, recorder
+
+
+def prepare_ensemble(namespace, args, device, set_env):
+    models, optimizers, stoppers = [], [], []
+    for seed in namespace.seeds:
+        # every copy starts from the weights a single run with this seed would use
+        set_env(seed)
+        model = build_model(namespace, args, device)
+
+        models.append(model)
+        optimizers.append(create_optimizer(args, model))
+        stoppers.append(early_stopping.EarlyStopping(delta=0.0,
+                                                     patience=args.patience,
+                                                     verbose=False,
+                                                     path=namespace.xformer + "_" + args.dataset + "_seed" + str(seed) + ".pt",
+                                                     save=weights.saver(args.weights_format)))
+
+    loss_cel = nn.CrossEntropyLoss()
+    loss_seq_kp = los.KernelPolynomialLoss(max_order=args.xformer.converter.max_order)
+    recorder = telemetry.Telemetry(path=args.telemetry_path, device=device)
+
+    return models, loss_cel, loss_seq_kp, optimizers, stoppers, recorder
+
+
+def run(namespace, args, device, prepare_data, set_env):
+    if namespace.seeds is None:
+        model, loss_cel, loss_seq_kp, optimizer, scheduler, es, monitor, recorder = prepare_model(namespace, args, device)
+    else:
+        models, loss_cel, loss_seq_kp, optimizers, stoppers, recorder = prepare_ensemble(namespace, args, device, set_env)
+    dataloader_train, dataloader_val, dataloader_test = prepare_data(args)
+    if namespace.seeds is None:
+        trainer = engine.Trainer(namespace, args, model, optimizer, scheduler, es, monitor, recorder,
+                                 loss_cel, loss_seq_kp, device)
+    else:
+        trainer = ensemble.EnsembleTrainer(namespace, args, models, optimizers, stoppers, recorder,
+                                           loss_cel, loss_seq_kp, device)
+    acc_train, loss_train, acc_val, loss_val, peak_memory_train = trainer.fit(dataloader_train, dataloader_val)
+    acc_test, loss_test = trainer.test(dataloader_test)
+
+    recorder.close()
+
+    return {'acc_train': acc_train, 'loss_train': loss_train, 'acc_val': acc_val, 'loss_val': loss_val,
+            'acc_test': acc_test, 'loss_test': loss_test,
+            'peak_memory_train': peak_memory_train, 'peak_memory_test': recorder.peak_memory('test')}
+
+
+def main(entry_point, set_env, get_parameters, prepare_data, data_files):
+    """Train and test the task of an entry point, or restore an identical run from the run cache."""
+    set_env(SEED)
+
+    warnings.filterwarnings("ignore", category=UserWarning)
+
+    namespace, args, device = get_parameters()
+    device = distributed.setup(device, pin=args.pin_cores)
+
+    results = None
+    hit = False
+    if args.run_cache_dir is not None:
+        if distributed.is_main():
+            cache = run_cache.RunCache(args.run_cache_dir, args.run_cache_size)
+            key = run_cache.run_key(namespace, args, SEED, run_cache.code_files(entry_point), data_files(args), device)
+            results = cache.lookup(key)
+        # the main process decides, so that either every rank trains or none does
+        hit = bool(distributed.broadcast_(torch.tensor([results is not None], dtype=torch.int32, device=device)).item())
+    if not hit:
+        results = run(namespace, args, device, prepare_data, set_env)
+        if (args.run_cache_dir is not None) and distributed.is_main():
+            cache.store(key, results, run_cache.checkpoint_paths(namespace, args))
+    elif distributed.is_main():
+        print(f'run cache hit {key[:12]}: restored the results and checkpoints of an identical run')
+
+    if distributed.is_main():
+        print(f'test acc: {results["acc_test"]: .2f}%')
+        print(f'test loss: {results["loss_test"]: .4f}')
+        print(f"Peak memory usage in training ({device.type}): {results['peak_memory_train'] / (1024 ** 3):.2f} GiB")
+        print(f"Peak memory usage in testing ({device.type}): {results['peak_memory_test'] / (1024 ** 3):.2f} GiB")
+
+    distributed.cleanup()
@@ -0,0 +1,98 @@
+import traceback
+import torch
+import torch.nn as nn
+from torch import Tensor
+from typing import Callable, List, Tuple
+from . import distributed
+
+
+class HealthMonitor:
+    """Periodic numerical-health checks that replace always-on anomaly detection.
+
+    Every `interval` steps the monitor is armed: forward hooks on the watched
+    submodules record `isfinite` flags of their outputs, and check() adds the
+    loss and the gradient norms before reducing all flags to host with a single
+    synchronization. Unarmed steps only pay for a boolean test in each hook.
+
+    When a check trips, diagnose() restores the RNG state saved at the start of
+    the step (so dropout masks match) and re-runs the step under
+    torch.autograd.detect_anomaly to report the offending module and the
+    forward stack trace of the op that produced the non-finite gradient.
+
+    Args:
+        model (nn.Module): Model to watch.
+        interval (int): Check every `interval` steps. 0 disables the monitor.
+        watch (tuple): Class names of the submodules whose outputs are checked.
+    """
+    def __init__(self, model: nn.Module, interval: int = 100,
+                 watch: Tuple[str, ...] = ('Sine', 'DHHPTransform', 'InverseDHHPTransform', 'KernelPolynomial')) -> None:
+        self.model = model
+        self.interval = interval
+        self.step = 0
+        self.armed = False
+        self.num_trips = 0
+        self.flags: List[Tuple[str, Tensor]] = []
+        self.rng_state = None
+        self.cuda_rng_state = None
+        self.handles = []
+
+        if interval > 0:
+            for name, module in model.named_modules():
+                if type(module).__name__ in watch:
+                    self.handles.append(module.register_forward_hook(self._make_hook(name)))
+
+    def _make_hook(self, name: str):
+        def hook(module, input, output):
+            if self.armed and isinstance(output, Tensor):
+                self.flags.append((name, torch.isfinite(output.detach()).all()))
+        return hook
+
+    def begin_step(self) -> None:
+        self.step += 1
+        self.armed = (self.interval > 0) and (self.step % self.interval == 0)
+        self.flags = []
+        if self.armed:
+            self.rng_state = torch.get_rng_state()
+            if torch.cuda.is_available():
+                self.cuda_rng_state = torch.cuda.get_rng_state_all()
+
+    @torch.no_grad()
+    def check(self, loss: Tensor, grads: bool = True) -> bool:
+        if not self.armed:
+            return True
+
+        self.flags.append(('loss', torch.isfinite(loss.detach()).all()))
+        grads = [p.grad for p in self.model.parameters() if p.grad is not None] if grads else []
+        if len(grads) > 0:
+            grad_norms = torch.stack(torch._foreach_norm(grads))
+            self.flags.append(('gradients', torch.isfinite(grad_norms).all()))
+
+        healthy = torch.stack([flag for _, flag in self.flags]).all().to(torch.int32).view(1)
+        # every rank has to take the diagnose/skip path together, otherwise the
+        # next gradient all-reduce of the healthy ranks waits forever
+        healthy = bool(distributed.all_reduce_(healthy, op=torch.distributed.ReduceOp.MIN).item())
+        if not healthy:
+            self.num_trips += 1
+            failed = [name for name, flag in self.flags if not bool(flag.item())]
+            print(f'HealthMonitor: non-finite values at step {self.step} in {failed}')
+
+        return healthy
+
+    def diagnose(self, step_fn: Callable) -> None:
+        """Re-run the tripped step alone with anomaly detection on."""
+        self.armed = False
+        torch.set_rng_state(self.rng_state)
+        if self.cuda_rng_state is not None:
+            torch.cuda.set_rng_state_all(self.cuda_rng_state)
+
+        with torch.autograd.detect_anomaly(check_nan=True):
+            try:
+                step_fn()
+            except RuntimeError:
+                print(f'HealthMonitor: anomaly report for step {self.step}')
+                traceback.print_exc()
+
+    def remove(self) -> None:
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
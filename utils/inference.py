@@ -0,0 +1,319 @@
+import math
+import time
+import hashlib
+import asyncio
+import torch
+import torch.nn as nn
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from torch import Tensor
+from typing import Dict, Iterable, Iterator, List, Sequence
+from . import microbatch
+
+
+def read_sequences(path: str) -> Iterator[Tensor]:
+    """Token sequences of a file, one at a time.
+
+    A .pt file holds a 2-D tensor (one row per sequence, e.g. a dataset
+    split) or a list of 1-D tensors; it is memory-mapped, so only the rows
+    being batched are paged in. Any other file is read as text with one
+    sequence of whitespace-separated token ids per line.
+    """
+    if str(path).endswith('.pt'):
+        sequences = torch.load(path, map_location='cpu', mmap=True)
+        for sequence in sequences:
+            yield sequence.reshape(-1)
+    else:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield torch.tensor([int(token) for token in line.split()], dtype=torch.int32)
+
+
+def pad(sequences: Sequence[Tensor], length: int, pad_id: int) -> Tensor:
+    """Right-pad (rows, length) int32 tokens; the encoders only take max_seq_len tokens."""
+    batch = torch.full((len(sequences), length), pad_id, dtype=torch.int32)
+    for row, sequence in enumerate(sequences):
+        if sequence.numel() > length:
+            raise ValueError(f'ERROR: A sequence of {sequence.numel()} tokens is longer than max_seq_len {length}.')
+        batch[row, :sequence.numel()] = sequence.to(torch.int32)
+
+    return batch
+
+
+def batch_rows(args, token_budget=None) -> int:
+    """Rows of a dynamic batch: as many padded sequences as the token budget holds,
+    at most batch_size (the batch-shaped parameters have batch_size rows)."""
+    if token_budget is None:
+        return args.batch_size
+
+    return max(1, min(args.batch_size, token_budget // args.max_seq_len))
+
+
+def dynamic_batches(streams: Sequence[Iterable[Tensor]], rows: int) -> Iterator[List[tuple]]:
+    """Group zipped samples of the input streams into batches of up to `rows`;
+    the last batch is kept even when it is partial."""
+    batch = []
+    for sample in zip(*streams):
+        batch.append(sample)
+        if len(batch) == rows:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+class Predictor:
+    """Logits of a trained model for batches of any size.
+
+    A batch of n <= batch_size samples runs with the first n rows of the
+    batch-shaped parameters (KernelPolynomial.cheb_coef, the synthesizer
+    random attention), which those modules slice themselves, as the last
+    partial batch of an epoch would; larger batches are split into chunks
+    of batch_size.
+
+    The forward is reentrant: no module writes to itself during a forward,
+    so any number of threads can share one Predictor (and one copy of the
+    weights). The only randomness at inference, the random rotations of the
+    reformer's LSH, comes from a generator seeded per call with `seed`.
+    """
+    def __init__(self, model: nn.Module, batch_size: int, device) -> None:
+        self.model = model
+        self.batch_size = batch_size
+        self.device = device
+        self.stochastic = any(type(module).__name__ == 'LocalitySensitiveHash' for module in model.modules())
+
+    @torch.inference_mode()
+    def __call__(self, *inputs: Tensor, seed: int = 0) -> Tensor:
+        inputs = [input.to(self.device, non_blocking=True) for input in inputs]
+        kwargs = {}
+        if self.stochastic:
+            kwargs['generator'] = torch.Generator(device=self.device)
+            kwargs['generator'].manual_seed(seed)
+        logits = []
+        for part in microbatch.split_batch(inputs[0].size(0), self.batch_size):
+            logits.append(self.model(*[input[part] for input in inputs], **kwargs))
+        logits = torch.cat(logits, dim=0)
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+        return logits.float().cpu()
+
+
+class PairwiseScorer:
+    """Scores (i, j) document pairs with an LRADual, encoding every document once.
+
+    The documents of the requested pairs are encoded in batches of
+    batch_size (only those not already cached) and their pooled encodings
+    are kept in an LRU cache of at most cache_size documents, keyed by
+    `keys` or by a hash of the tokens. All pairs then go through
+    DualClassifier.head as batched matmuls over gathered encodings, so
+    scoring all N^2 pairs costs N encoder passes.
+
+    The encoding of a document depends on the row of the batch it is encoded
+    at, through the batch-shaped parameters, so every document is always
+    encoded at the same row: slot() derives it from the cache key, and every
+    encoder pass is a full batch with one document per row (padding rows
+    where a slot has no document left). A cached encoding is thus the same
+    whatever the document was batched with.
+    """
+    def __init__(self, model: nn.Module, batch_size: int, length: int, device,
+                 cache_size: int = 4096, pad_id: int = 0, pair_chunk: int = 65536) -> None:
+        self.model = model
+        self.predictor = Predictor(model, batch_size, device)
+        self.batch_size = batch_size
+        self.device = device
+        self.cache_size = cache_size
+        self.pair_chunk = pair_chunk
+        self.pad_id = pad_id
+        self.length = length
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def content_key(document: Tensor) -> str:
+        return hashlib.sha1(document.to(torch.int32).cpu().contiguous().numpy().tobytes()).hexdigest()
+
+    def slot(self, key) -> int:
+        """Row of the encoding batch the document with this cache key is always encoded at."""
+        return int(hashlib.sha1(str(key).encode('utf-8')).hexdigest()[:8], 16) % self.batch_size
+
+    @torch.inference_mode()
+    def encode(self, documents: Sequence[Tensor], slots: Sequence[int], seed: int = 0) -> Tensor:
+        """Pooled encodings of documents padded to `length`, each encoded at the batch row of its slot."""
+        kwargs = {}
+        if self.predictor.stochastic:
+            kwargs['generator'] = torch.Generator(device=self.device)
+            kwargs['generator'].manual_seed(seed)
+        queues = [[] for _ in range(self.batch_size)]
+        for i, slot in enumerate(slots):
+            queues[slot].append(i)
+        blank = torch.zeros(0, dtype=torch.int32)
+        pooled = [None] * len(documents)
+        while any(len(queue) > 0 for queue in queues):
+            rows = [queue.pop() if len(queue) > 0 else None for queue in queues]
+            batch = pad([documents[i] if i is not None else blank for i in rows], self.length, self.pad_id)
+            encoded = self.model.encode(batch.to(self.device), **kwargs)
+            for row, i in enumerate(rows):
+                if i is not None:
+                    pooled[i] = encoded[row]
+
+        return torch.stack(pooled)
+
+    def lookup(self, documents: Sequence[Tensor], ids: List[int], keys) -> Dict[int, Tensor]:
+        """Pooled encoding of every document in ids, encoding the cache misses together."""
+        pooled = {}
+        missing = []
+        for i in ids:
+            key = keys[i] if keys is not None else self.content_key(documents[i])
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                pooled[i] = self.cache[key]
+                self.hits += 1
+            else:
+                missing.append((i, key))
+        self.misses += len(missing)
+
+        if len(missing) > 0:
+            encoded = self.encode([documents[i] for i, _ in missing], [self.slot(key) for _, key in missing])
+            for (i, key), encoding in zip(missing, encoded):
+                pooled[i] = encoding
+                self.cache[key] = encoding
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+        return pooled
+
+    @torch.inference_mode()
+    def score(self, documents: Sequence[Tensor], pairs: Sequence[tuple], keys=None) -> Tensor:
+        """Logits (len(pairs), num_class) of the pairs (i, j) of documents[i] and documents[j]."""
+        ids = sorted(set(i for pair in pairs for i in pair))
+        pooled = self.lookup(documents, ids, keys)
+        position = {i: row for row, i in enumerate(ids)}
+        table = torch.stack([pooled[i] for i in ids])
+        index = torch.tensor([[position[i], position[j]] for i, j in pairs], dtype=torch.long, device=table.device)
+
+        logits = []
+        for start in range(0, index.size(0), self.pair_chunk):
+            part = index[start:start + self.pair_chunk]
+            logits.append(self.model.classifier.head(table[part[:, 0]], table[part[:, 1]]))
+
+        return torch.cat(logits, dim=0).float().cpu()
+
+
+def version_counters(model: nn.Module) -> Dict[str, tuple]:
+    """Identity and in-place version of every parameter, buffer and tensor attribute.
+
+    Two snapshots around a forward differ exactly when the forward replaced
+    or modified module state in place.
+    """
+    counters = {}
+    for module_name, module in model.named_modules():
+        for name, value in vars(module).items():
+            tensors = {}
+            if name in ('_parameters', '_buffers'):
+                tensors = {key: tensor for key, tensor in value.items() if tensor is not None}
+            elif isinstance(value, Tensor):
+                tensors = {name: value}
+            for key, tensor in tensors.items():
+                counters[module_name + '.' + key] = (id(tensor), tensor._version)
+
+    return counters
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """Nearest-rank percentile, q in [0, 100]."""
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+
+    return ordered[rank - 1]
+
+
+class MicroBatcher:
+    """Collects concurrent requests into micro-batches for a shared Predictor.
+
+    Requests wait in an asyncio queue. A batch starts with the oldest request
+    and takes whatever arrives within max_wait seconds of it, up to max_batch
+    requests; it is padded and run on a single worker thread (under
+    torch.inference_mode), so the event loop keeps accepting requests while
+    the model computes. Every request gets its own row of logits back.
+    """
+    def __init__(self, predictor: Predictor, num_inputs: int, length: int, pad_id: int = 0,
+                 max_batch: int = 32, max_wait: float = 0.005, window: int = 10000) -> None:
+        self.predictor = predictor
+        self.num_inputs = num_inputs
+        self.length = length
+        self.pad_id = pad_id
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='predictor')
+        # latencies (queueing + compute) and batch sizes of the most recent requests
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.num_requests = 0
+        self.num_batches = 0
+
+    async def submit(self, *sequences: Tensor) -> Tensor:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((sequences, future, time.perf_counter()))
+
+        return await future
+
+    async def collect(self) -> List[tuple]:
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.collect()
+            inputs = [pad([sequences[i] for sequences, _, _ in batch], self.length, self.pad_id) for i in range(self.num_inputs)]
+            try:
+                logits = await loop.run_in_executor(self.executor, self.predictor, *inputs)
+            except Exception as error:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+
+            logits = logits.reshape(len(batch), -1)
+            now = time.perf_counter()
+            for row, (_, future, arrival) in enumerate(batch):
+                # the client may have gone away in the meantime
+                if not future.done():
+                    future.set_result(logits[row])
+                self.latencies.append(now - arrival)
+            self.batch_sizes.append(len(batch))
+            self.num_requests += len(batch)
+            self.num_batches += 1
+
+    def metrics(self) -> dict:
+        latencies = list(self.latencies)
+        batch_sizes = list(self.batch_sizes)
+        return {
+            'queue_depth': self.queue.qsize(),
+            'requests': self.num_requests,
+            'batches': self.num_batches,
+            'mean_batch_size': sum(batch_sizes) / len(batch_sizes) if len(batch_sizes) > 0 else 0.0,
+            'latency_p50_ms': percentile(latencies, 50) * 1e3,
+            'latency_p99_ms': percentile(latencies, 99) * 1e3
+        }
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,172 @@
+import os
+import sys
+import threading
+import torch
+import torch.nn as nn
+
+from contextlib import contextmanager
+from typing import Callable, Dict
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def process_rss() -> int:
+    """Current resident set size of this process in bytes (0 if unavailable)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process in bytes (0 if unavailable)."""
+    if resource is None:
+        return 0
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class RSSSampler:
+    """Samples the process RSS in a background thread and keeps the maximum.
+
+    getrusage only reports the peak over the whole process lifetime, so a
+    sampler is needed to get the peak of an individual phase on CPU.
+    """
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self.peak = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, process_rss())
+
+    def start(self) -> None:
+        self.peak = process_rss()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> int:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.peak = max(self.peak, process_rss())
+
+        return self.peak
+
+
+class MemoryTracker:
+    """Peak memory per named phase on CPU and CUDA.
+
+    On CUDA the peak is torch.cuda.max_memory_allocated() after resetting the
+    peak statistics at the start of the phase. On CPU the caching allocator
+    keeps no such statistics, so the process RSS is sampled in a background
+    thread for the duration of the phase. Phases must not be nested.
+
+    Args:
+        device (torch.device): Device the model runs on.
+        interval (float): RSS sampling interval in seconds (CPU only).
+    """
+    def __init__(self, device: torch.device = torch.device('cpu'), interval: float = 0.005) -> None:
+        self.device = device
+        self.peaks: Dict[str, int] = {}
+        self.sampler = RSSSampler(interval) if device.type != 'cuda' else None
+        self.active = None
+
+    def start(self, name: str) -> None:
+        self.active = name
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            self.sampler.start()
+
+    def stop(self, name: str) -> int:
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            peak = torch.cuda.max_memory_allocated(self.device)
+        else:
+            peak = self.sampler.stop()
+        self.peaks[name] = max(self.peaks.get(name, 0), peak)
+        self.active = None
+
+        return peak
+
+    def current_peak(self) -> int:
+        """Peak of the running phase so far, without stopping it."""
+        if self.device.type == 'cuda':
+            return torch.cuda.max_memory_allocated(self.device)
+        if self.active is not None:
+            return max(self.sampler.peak, process_rss())
+        return process_rss()
+
+    @contextmanager
+    def phase(self, name: str):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def peak(self, name: str) -> int:
+        return self.peaks.get(name, 0)
+
+
+def module_memory(model: nn.Module, step_fn: Callable, device: torch.device = torch.device('cpu')) -> Dict[str, int]:
+    """Net bytes allocated by the forward of every submodule during one call of step_fn.
+
+    Every submodule forward is wrapped in a profiler range through forward
+    hooks and step_fn is run once under torch.profiler with memory profiling,
+    which reads allocations from the CPU (or CUDA) allocator directly. The net
+    allocation of a range is what the module leaves alive after its forward,
+    i.e. mostly the activations kept for backward.
+    """
+    ranges = []
+    handles = []
+
+    def make_pre_hook(name):
+        def hook(module, input):
+            record = torch.profiler.record_function('module::' + name)
+            record.__enter__()
+            ranges.append(record)
+        return hook
+
+    def post_hook(module, input, output):
+        ranges.pop().__exit__(None, None, None)
+
+    for name, module in model.named_modules():
+        if name:
+            handles.append(module.register_forward_pre_hook(make_pre_hook(name)))
+            handles.append(module.register_forward_hook(post_hook))
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if device.type == 'cuda':
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    try:
+        with torch.profiler.profile(activities=activities, profile_memory=True) as prof:
+            step_fn()
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    usage = {}
+    for event in prof.key_averages():
+        if event.key.startswith('module::'):
+            if device.type == 'cuda':
+                memory_usage = getattr(event, 'device_memory_usage', None)
+                if memory_usage is None:
+                    memory_usage = event.cuda_memory_usage
+            else:
+                memory_usage = event.cpu_memory_usage
+            usage[event.key[len('module::'):]] = memory_usage
+
+    return usage
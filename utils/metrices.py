@@ -1,26 +1,69 @@
-class AverageMeter:
-    def __init__(self):
+import torch
+import torch.distributed as dist
+
+
+class DeviceMeter:
+    """Running loss and top-k accuracies that stay on the device.
+
+    update() only issues asynchronous tensor ops, so it never forces a host
+    synchronization; the sums are read back by compute(), which the loops call
+    once every log_interval steps and at the end of the epoch. The correct
+    predictions are counted per k of topk, which always includes 1, so the
+    first accuracy compute() returns is the plain (top-1) accuracy.
+    """
+    def __init__(self, device, topk=(1,)):
+        self.device = device
+        self.topk = normalize_topk(topk)
         self.reset()
 
     def reset(self):
-        self.val = 0
-        self.avg = 0
-        self.sum = 0
+        self.loss_sum = torch.zeros((), dtype=torch.float64, device=self.device)
+        self.correct = torch.zeros(len(self.topk), dtype=torch.float64, device=self.device)
         self.count = 0
 
-    def update(self, val, n=1):
-        self.val = val
-        self.sum += val * n
+    @torch.no_grad()
+    def update(self, loss, output, target):
+        n = target.size(0)
+        self.loss_sum += loss.detach() * n
+        self.correct += correct_topk(output, target, self.topk)
         self.count += n
-        self.avg = self.sum / self.count
+
+    def all_reduce(self):
+        """Sum the statistics of all ranks (no-op outside torch.distributed)."""
+        if not (dist.is_available() and dist.is_initialized()):
+            return
+        stats = torch.cat([self.loss_sum.view(1), self.correct,
+                           torch.tensor([float(self.count)], dtype=torch.float64, device=self.device)])
+        dist.all_reduce(stats)
+        self.loss_sum = stats[0]
+        self.correct = stats[1:-1]
+        self.count = int(stats[-1].item())
+
+    def compute(self):
+        """The accuracies in percent, one per k of topk, and the mean loss."""
+        if self.count == 0:
+            return [0.0] * len(self.topk), 0.0
+        loss_avg = (self.loss_sum / self.count).item()
+        accs = (self.correct * 100. / self.count).tolist()
+
+        return accs, loss_avg
 
 
-def accuracy(output, target, topk=(1,)):
+def normalize_topk(topk):
+    """The sorted ks of topk with 1 first, so that the first accuracy is the top-1 accuracy."""
+    return tuple(sorted(set(topk) | {1}))
+
+
+def correct_topk(output, target, topk=(1,)):
+    """Number of samples whose target is among the k largest outputs, for every k of topk."""
     maxk = min(max(topk), output.size()[1])
-    batch_size = target.size(0)
     _, pred = output.topk(maxk, 1, True, True)
     pred = pred.t()
     correct = pred.eq(target.reshape(1, -1).expand_as(pred))
-    accuracies = [correct[:min(k, maxk)].reshape(-1).float().sum(0) * 100. / batch_size for k in topk]
-    
-    return accuracies
\ No newline at end of file
+
+    return torch.stack([correct[:min(k, maxk)].reshape(-1).sum(0, dtype=torch.float64) for k in topk])
+
+
+def format_topk(loop, topk, accs) -> str:
+    """The accuracies of every k > 1, e.g. "val top-5 acc:  91.20%"."""
+    return '  '.join(f'{loop} top-{k} acc: {acc: .2f}%' for k, acc in zip(topk, accs) if k > 1)
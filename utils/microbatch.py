@@ -0,0 +1,78 @@
+import torch
+import torch.nn as nn
+from torch import Tensor
+from torch.func import functional_call
+from typing import Callable, Dict, Sequence
+
+
+def batch_shaped_parameters(model: nn.Module) -> Dict[str, Tensor]:
+    """Parameters with one row per sample, as declared by `_batch_shaped_parameters`.
+
+    KernelPolynomial.cheb_coef and the synthesizer random attention weights are
+    allocated with batch_size rows. A forward on part of a batch has to use the
+    matching rows; by themselves the modules would use the leading rows.
+    """
+    params = {}
+    for module_name, module in model.named_modules():
+        for name in getattr(module, '_batch_shaped_parameters', ()):
+            params[module_name + '.' + name if module_name else name] = getattr(module, name)
+
+    return params
+
+
+def batch_call(model: nn.Module, params: Dict[str, Tensor], index, *inputs, **kwargs):
+    """Run the model on a part of a batch with the batch-shaped parameters indexed by `index`.
+
+    `index` is a slice or an index tensor into the rows of the full batch. The
+    indexed parameters are views (or gathers) of the real ones, so gradients
+    flow back into the rows the part of the batch used.
+    """
+    if len(params) == 0:
+        return model(*inputs, **kwargs)
+    if isinstance(index, Tensor):
+        overrides = {name: param.index_select(0, index) for name, param in params.items()}
+    else:
+        overrides = {name: param[index] for name, param in params.items()}
+
+    return functional_call(model, overrides, inputs, kwargs)
+
+
+def split_batch(batch_size: int, micro_batch_size: int):
+    """Slices of consecutive micro-batches covering a batch."""
+    return [slice(start, min(start + micro_batch_size, batch_size)) for start in range(0, batch_size, micro_batch_size)]
+
+
+def saved_activation_bytes(fn: Callable[[], Tensor]) -> int:
+    """Bytes of the distinct tensors autograd saves for backward while running fn.
+
+    This is the activation memory a forward keeps alive until its backward,
+    measured the same way on CPU and CUDA without touching the allocator.
+    """
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        output = fn()
+    del output
+
+    return sum(storages.values())
+
+
+def plan_micro_batch_size(model: nn.Module, inputs: Sequence[Tensor], memory_budget: float) -> int:
+    """Largest micro-batch whose saved activations fit in `memory_budget` MiB.
+
+    The activations of a single sample are measured with a probing forward;
+    they scale linearly with the number of samples for every encoder here.
+    """
+    params = batch_shaped_parameters(model)
+    batch_size = inputs[0].size(0)
+    sample = [input[:1] for input in inputs]
+    per_sample = saved_activation_bytes(lambda: batch_call(model, params, slice(0, 1), *sample))
+    if per_sample == 0:
+        return batch_size
+
+    return max(1, min(batch_size, int(memory_budget * 1024 ** 2 // per_sample)))
@@ -0,0 +1,221 @@
+import time
+import torch
+import torch.nn as nn
+from torch import Tensor
+from typing import Dict, List, Tuple
+
+
+def _tensor_bytes(value) -> int:
+    if isinstance(value, Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        return sum(_tensor_bytes(v) for v in value)
+    return 0
+
+
+class ModuleProfiler:
+    """Forward and backward time per submodule, aggregated into a call tree.
+
+    For a window of training steps, hooks on every submodule of the model
+    record the wall time between entering and leaving its forward and its
+    backward. Nested calls form a tree keyed by the path of `named_modules()`
+    names, e.g. `forward;LRASingle;xformer;xformer.kernelution;xformer.kernelution.dhhp_transform`,
+    and every node aggregates the call count, inclusive time, exclusive time
+    (inclusive time minus that of the children), the bytes of the tensors it
+    produced and the net bytes allocated inside it. On CUDA the allocation is
+    read from the caching allocator; the CPU allocator keeps no statistics, so
+    on CPU every call is wrapped in a record_function range and the window runs
+    under torch.profiler with memory profiling, as in memory.module_memory,
+    which adds the profiler overhead to the CPU times.
+
+    When the window closes the hooks are removed, a report sorted by inclusive
+    time is printed and the exclusive times are written in folded-stack format
+    (one `frame;frame;frame microseconds` line per path), which flamegraph.pl,
+    speedscope and inferno read directly. With window=None no hook is ever
+    registered, so a disabled profiler costs nothing.
+
+    Backward times come from full backward hooks and cover the gradients with
+    respect to the module inputs; for modules whose inputs do not require
+    gradients (e.g. the token embedding) only the part up to the first
+    parameter gradient is seen.
+
+    Args:
+        model (nn.Module): Model to profile.
+        window (list): [skip, active] training steps. None disables the profiler.
+        path (str): Folded-stack file written at the end of the window.
+        device (torch.device): Device the model runs on.
+    """
+    def __init__(self, model: nn.Module, window=None, path: str = 'modules.folded',
+                 device: torch.device = torch.device('cpu')) -> None:
+        self.model = model
+        self.path = path
+        self.device = device
+        self.root = type(model).__name__
+        self.enabled = window is not None
+        self.skip, self.active_steps = window if window is not None else (0, 0)
+        self.step_count = 0
+        self.attached = False
+        self.handles = []
+        # path -> [calls, inclusive, exclusive, output_bytes, allocated_bytes]
+        self.stats: Dict[Tuple[str, ...], List[float]] = {}
+        # per pass: [name, start, start_allocated, children_time, record]
+        self.stacks: Dict[str, List[list]] = {'forward': [], 'backward': []}
+        self.memory_profile = None
+        self.alloc_measured = device.type == 'cuda'
+
+        if self.enabled and self.skip == 0:
+            self._attach()
+
+    def _now(self) -> float:
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def _allocated(self) -> int:
+        if self.device.type == 'cuda':
+            return torch.cuda.memory_allocated(self.device)
+        return 0
+
+    def _enter(self, kind: str, name: str) -> None:
+        stack = self.stacks[kind]
+        record = None
+        if self.memory_profile is not None:
+            path = (kind, self.root) + tuple(frame[0] for frame in stack) + (name,)
+            record = torch.profiler.record_function('module::' + ';'.join(path))
+            record.__enter__()
+        stack.append([name, self._now(), self._allocated(), 0.0, record])
+
+    def _exit(self, kind: str, name: str, produced) -> None:
+        stack = self.stacks[kind]
+        # Backward hooks of modules without grad-requiring inputs can fire out
+        # of order, so unwind to the matching frame instead of trusting the top.
+        index = len(stack) - 1
+        while index >= 0 and stack[index][0] != name:
+            index -= 1
+        if index < 0:
+            return
+        end = self._now()
+        _, start, start_allocated, children_time, _ = stack[index]
+        path = (kind, self.root) + tuple(frame[0] for frame in stack[:index + 1])
+        for frame in reversed(stack[index:]):
+            if frame[4] is not None:
+                frame[4].__exit__(None, None, None)
+        del stack[index:]
+
+        inclusive = end - start
+        if len(stack) > 0:
+            stack[-1][3] += inclusive
+        node = self.stats.setdefault(path, [0, 0.0, 0.0, 0, 0])
+        node[0] += 1
+        node[1] += inclusive
+        node[2] += inclusive - children_time
+        node[3] += _tensor_bytes(produced)
+        node[4] += self._allocated() - start_allocated
+
+    def _attach(self) -> None:
+        for name, module in self.model.named_modules():
+            if not name:
+                continue
+
+            def forward_pre_hook(module, input, name=name):
+                if torch.is_grad_enabled():
+                    self._enter('forward', name)
+
+            def forward_hook(module, input, output, name=name):
+                if torch.is_grad_enabled():
+                    self._exit('forward', name, output)
+
+            def backward_pre_hook(module, grad_output, name=name):
+                self._enter('backward', name)
+
+            def backward_hook(module, grad_input, grad_output, name=name):
+                self._exit('backward', name, grad_input)
+
+            self.handles.append(module.register_forward_pre_hook(forward_pre_hook))
+            self.handles.append(module.register_forward_hook(forward_hook))
+            self.handles.append(module.register_full_backward_pre_hook(backward_pre_hook))
+            self.handles.append(module.register_full_backward_hook(backward_hook))
+        self.attached = True
+        if self.device.type != 'cuda':
+            self._start_memory_profile()
+
+    def _start_memory_profile(self) -> None:
+        self.memory_profile = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU],
+                                                     profile_memory=True)
+        try:
+            self.memory_profile.start()
+        except RuntimeError:
+            # only one torch.profiler can run at a time, e.g. not inside the telemetry window
+            print('Module profiler: torch.profiler is already running, CPU allocations are not measured')
+            self.memory_profile = None
+            return
+        self.alloc_measured = True
+
+    def _stop_memory_profile(self) -> None:
+        if self.memory_profile is None:
+            return
+        self.memory_profile.stop()
+        for event in self.memory_profile.key_averages():
+            if event.key.startswith('module::'):
+                node = self.stats.get(tuple(event.key[len('module::'):].split(';')))
+                if node is not None:
+                    node[4] = event.cpu_memory_usage
+        self.memory_profile = None
+
+    def _detach(self) -> None:
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        self.attached = False
+
+    def step(self) -> None:
+        """Advance the window by one training step; call after the optimizer step."""
+        if not self.enabled:
+            return
+        self.step_count += 1
+        if self.step_count == self.skip and not self.attached:
+            self._attach()
+        elif self.step_count == self.skip + self.active_steps and self.attached:
+            self._finish()
+
+    def _finish(self) -> None:
+        self._detach()
+        self._stop_memory_profile()
+        self.enabled = False
+        self.write_folded(self.path)
+        print(self.report())
+
+    def write_folded(self, path: str) -> None:
+        with open(path, 'w') as f:
+            for frames, node in sorted(self.stats.items()):
+                f.write(f'{";".join(frames)} {max(int(node[2] * 1e6), 0)}\n')
+
+    def report(self, max_depth: int = 6) -> str:
+        """Call tree with the children of every node sorted by inclusive time."""
+        children = {}
+        for frames in self.stats:
+            children.setdefault(frames[:-1], []).append(frames)
+
+        alloc = self.alloc_measured
+        lines = [f'Module profile over {self.active_steps} training steps ({self.device.type})',
+                 f'{"inclusive ms":>13} {"exclusive ms":>13} {"calls":>7} {"output MiB":>11} '
+                 + (f'{"alloc MiB":>10} ' if alloc else '') + ' module']
+
+        def visit(parent, depth):
+            if depth >= max_depth:
+                return
+            for frames in sorted(children.get(parent, []), key=lambda frames: -self.stats[frames][1]):
+                node = self.stats[frames]
+                lines.append(f'{node[1] * 1e3:13.2f} {node[2] * 1e3:13.2f} {node[0]:7d} {node[3] / 2 ** 20:11.2f} '
+                             + (f'{node[4] / 2 ** 20:10.2f} ' if alloc else '') + f' {"  " * depth}{frames[-1]}')
+                visit(frames, depth + 1)
+
+        for kind in ['forward', 'backward']:
+            lines.append(f'{kind}:')
+            visit((kind, self.root), 0)
+
+        return '\n'.join(lines)
+
+    def close(self) -> None:
+        if self.attached:
+            self._finish()
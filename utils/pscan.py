@@ -42,29 +42,43 @@ class PScan(torch.autograd.Function):
             X[:, 0].add_(A[:, 1].conj() * X[:, 1])
 
 
+    # forward and backward only use ops with batching rules, so torch.func.vmap
+    # (the seed ensemble) can derive the batched version of the scan
+    generate_vmap_rule = True
+
+    @staticmethod
+    def forward(A, X, Y_init):
+        A_star = A[:, :, None].clone()
+        X_star = X.clone()
+        PScan.expand_(A_star, X_star)
+        return A_star * Y_init[:, None, :] + X_star, A_star, X_star
+
+
     @staticmethod
-    def forward(ctx, A, X, Y_init):
-        ctx.A = A[:, :, None].clone()
-        ctx.Y_init = Y_init[:, None, :].clone()
-        ctx.A_star = ctx.A.clone()
-        ctx.X_star = X.clone()
-        PScan.expand_(ctx.A_star, ctx.X_star)
-        return ctx.A_star * ctx.Y_init + ctx.X_star
+    def setup_context(ctx, inputs, output):
+        A, X, Y_init = inputs
+        _, A_star, X_star = output
+        ctx.mark_non_differentiable(A_star, X_star)
+        # save_for_backward (instead of ctx attributes) lets saved-tensor hooks,
+        # e.g. activation checkpointing, see and release these tensors
+        ctx.save_for_backward(A, Y_init, A_star, X_star)
 
 
     @staticmethod
-    def backward(ctx, grad_output):
-        U = grad_output * ctx.A_star.conj()
-        A = ctx.A.clone()
+    def backward(ctx, grad_output, grad_A_star, grad_X_star):
+        A, Y_init, A_star, X_star = ctx.saved_tensors
+        U = grad_output * A_star.conj()
+        A = A[:, :, None].clone()
         R = grad_output.clone()
         PScan.acc_rev_(A, R)
-        Q = ctx.Y_init.expand_as(ctx.X_star).clone()
-        Q[:, 1:].mul_(ctx.A_star[:, :-1].conj()).add_(ctx.X_star[:, :-1])
+        Q = Y_init[:, None, :].expand_as(X_star).clone()
+        Q[:, 1:].mul_(A_star[:, :-1].conj()).add_(X_star[:, :-1])
         grad_A = (Q.conj() * R).sum(-1)
         return grad_A, R, U.sum(dim=1)
 
 
-pscan = PScan.apply
+def pscan(A, X, Y_init):
+    return PScan.apply(A, X, Y_init)[0]
 
 
 def set_env(seed=42) -> None:
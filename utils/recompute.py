@@ -0,0 +1,77 @@
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+from typing import List, Optional, Sequence, Union
+
+
+# Class names of the submodules each module-level target applies to.
+MODULE_TARGETS = {
+    'embedding': ('Embedding',),
+    'kernelution': ('Kernelution',),
+    'gffn': ('GatedFeedForward',),
+}
+# Position of the sublayer inside the [attention, feed-forward] encoder blocks.
+BLOCK_TARGETS = {
+    'attention': (0,),
+    'ffn': (1,),
+    'block': (0, 1),
+}
+
+
+def _checkpointed(forward):
+    def checkpointed_forward(*args, **kwargs):
+        if not torch.is_grad_enabled():
+            return forward(*args, **kwargs)
+        # preserve_rng_state restores the CPU and CUDA RNG before recomputing,
+        # so the dropout masks of the recomputation match the original forward
+        return checkpoint(forward, *args, use_reentrant=False, preserve_rng_state=True, **kwargs)
+    return checkpointed_forward
+
+
+def apply_policy(model: nn.Module, policy: Union[str, Sequence[str], None], every: int = 1) -> List[str]:
+    """Recompute the activations of the selected submodules in backward instead of storing them.
+
+    `policy` names one or more targets: 'embedding' (token/position embedding,
+    including the RPE GRU), 'kernelution' and 'gffn' for the converter, and
+    'attention', 'ffn' or 'block' for every `every`-th block of the other
+    encoders. The forward of each selected submodule is replaced on the
+    instance, so the module tree and the state_dict keys stay unchanged.
+    Returns the names of the checkpointed submodules.
+    """
+    if policy is None:
+        return []
+    if isinstance(policy, str):
+        policy = [policy]
+    for target in policy:
+        if (target not in MODULE_TARGETS) and (target not in BLOCK_TARGETS):
+            raise ValueError(f'ERROR: The activation checkpointing target {target} is undefined.')
+    if every < 1:
+        raise ValueError(f'ERROR: checkpoint_every_n_blocks must be positive, got {every}.')
+
+    classes = set(name for target in policy for name in MODULE_TARGETS.get(target, ()))
+    sublayers = set(index for target in policy for index in BLOCK_TARGETS.get(target, ()))
+
+    selected = []
+    for name, module in model.named_modules():
+        # a submodule of an already checkpointed module is recomputed with it
+        # (this also keeps the inner nn.Embedding out of the 'embedding' target)
+        if any(name.startswith(prefix + '.') for prefix, _ in selected):
+            continue
+        if type(module).__name__ in classes:
+            selected.append((name, module))
+        elif (len(sublayers) > 0) and name.endswith('_encoder_block') and isinstance(module, nn.ModuleList):
+            for block_id in range(0, len(module), every):
+                for index in sorted(sublayers):
+                    selected.append((f'{name}.{block_id}.{index}', module[block_id][index]))
+
+    for _, module in selected:
+        module.forward = _checkpointed(module.forward)
+
+    return [name for name, _ in selected]
+
+
+def parse_policy(value: Optional[str]) -> Optional[List[str]]:
+    """Comma-separated policy from the command line, e.g. 'embedding,kernelution'."""
+    if (value is None) or (value == 'none'):
+        return None
+    return value.split(',')
@@ -0,0 +1,162 @@
+import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+import torch
+
+from utils import distributed
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+# config keys that only change logging or input pipelining, not the results
+EXCLUDED_KEYS = ('log_interval', 'telemetry_path', 'profile_window',
+                 'module_profile_window', 'prefetch_depth', 'num_workers', 'run_cache_dir', 'run_cache_size')
+# bytes hashed from the start and from the end of every dataset file
+FINGERPRINT_BYTES = 1 << 20
+
+
+def namespace_to_dict(namespace):
+    if isinstance(namespace, SimpleNamespace):
+        return {key: namespace_to_dict(value) for key, value in vars(namespace).items()}
+    return namespace
+
+
+def code_files(entry_point: str) -> List[str]:
+    """The entry point and every module of model/ and utils/ it may run."""
+    root = os.path.dirname(os.path.abspath(entry_point))
+    files = [os.path.abspath(entry_point)]
+    for package in ['model', 'utils']:
+        files += glob.glob(os.path.join(root, package, '**', '*.py'), recursive=True)
+
+    return sorted(set(files))
+
+
+def fingerprint(path: str) -> Dict:
+    """Size, modification time and a hash of the first and last MiB of a file."""
+    stat = os.stat(path)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        digest.update(f.read(FINGERPRINT_BYTES))
+        if stat.st_size > FINGERPRINT_BYTES:
+            f.seek(max(FINGERPRINT_BYTES, stat.st_size - FINGERPRINT_BYTES))
+            digest.update(f.read())
+
+    return {'path': os.path.normpath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest.hexdigest()}
+
+
+def run_key(namespace, args, seed: int, code_paths: List[str], data_paths: List[str],
+            device: torch.device = torch.device('cpu')) -> str:
+    """Content address of a run: resolved config, xformer and seeds, process layout, code and dataset files."""
+    config = {key: value for key, value in namespace_to_dict(args).items() if key not in EXCLUDED_KEYS}
+    code = hashlib.sha256()
+    for path in code_paths:
+        with open(path, 'rb') as f:
+            code.update(os.path.basename(path).encode('utf-8'))
+            code.update(f.read())
+    description = {
+        'config': config,
+        'xformer': namespace.xformer,
+        'seed': seed,
+        'seeds': getattr(namespace, 'seeds', None),
+        'world_size': distributed.world_size(),
+        'backend': distributed.backend(),
+        'device': device.type,
+        'code': code.hexdigest(),
+        'torch': torch.__version__,
+        'data': [fingerprint(path) for path in sorted(data_paths)]
+    }
+    encoded = json.dumps(description, sort_keys=True, default=str).encode('utf-8')
+
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def checkpoint_paths(namespace, args) -> List[str]:
+    """Best-weight checkpoints a run of the entry points leaves behind."""
+    prefix = namespace.xformer + "_" + args.dataset
+    if getattr(namespace, 'seeds', None) is not None:
+        return [prefix + "_seed" + str(seed) + ".pt" for seed in namespace.seeds]
+    return [prefix + ".pt"]
+
+
+class RunCache:
+    """Results and checkpoints of finished runs, addressed by run_key().
+
+    Every entry is a directory `<root>/<key>` holding result.json and the
+    checkpoint files. Entries are published with an atomic rename, so
+    concurrent runs never see a partial entry. A hit refreshes the access
+    time of the entry; when the entries exceed max_mib in total, the least
+    recently used ones are evicted.
+    """
+    def __init__(self, root: str, max_mib: float = 10240) -> None:
+        self.root = root
+        self.max_bytes = int(max_mib * 1024 ** 2)
+        os.makedirs(root, exist_ok=True)
+
+    def _entry(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def lookup(self, key: str, restore_to: Optional[str] = '.') -> Optional[Dict]:
+        """Stored metrics of `key`, with its checkpoints copied to restore_to (unless None); None on a miss."""
+        entry = self._entry(key)
+        try:
+            with open(os.path.join(entry, 'result.json')) as f:
+                record = json.load(f)
+            for name in record['files'] if restore_to is not None else []:
+                shutil.copy2(os.path.join(entry, name), os.path.join(restore_to, name))
+            os.utime(os.path.join(entry, 'result.json'))
+        except (OSError, ValueError, KeyError):
+            # missing, or evicted by another process while reading
+            return None
+
+        return record['result']
+
+    def store(self, key: str, result: Dict, files: List[str]) -> None:
+        entry = self._entry(key)
+        if os.path.exists(entry):
+            return
+        tmp = f'{entry}.tmp-{os.getpid()}'
+        os.makedirs(tmp, exist_ok=True)
+        names = []
+        for path in files:
+            if os.path.exists(path):
+                shutil.copy2(path, os.path.join(tmp, os.path.basename(path)))
+                names.append(os.path.basename(path))
+        with open(os.path.join(tmp, 'result.json'), 'w') as f:
+            json.dump({'result': result, 'files': names, 'stored_at': time.time()}, f, indent=2)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # another process published the same run first
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def entries(self) -> List[Dict]:
+        entries = []
+        for key in os.listdir(self.root):
+            entry = self._entry(key)
+            result_path = os.path.join(entry, 'result.json')
+            if ('.tmp-' in key) or (not os.path.exists(result_path)):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+                entries.append({'key': key, 'size': size, 'accessed': os.path.getmtime(result_path)})
+            except OSError:
+                continue
+
+        return entries
+
+    def evict(self) -> List[str]:
+        """Remove least recently used entries until the cache fits max_bytes; returns their keys."""
+        entries = sorted(self.entries(), key=lambda entry: entry['accessed'])
+        total = sum(entry['size'] for entry in entries)
+        evicted = []
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self._entry(entry['key']), ignore_errors=True)
+            total -= entry['size']
+            evicted.append(entry['key'])
+
+        return evicted
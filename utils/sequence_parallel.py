@@ -0,0 +1,216 @@
+# Sequence parallelism for Kernelution.
+#
+# The sequence dimension of a Kernelution input is split into equal contiguous
+# shards, one per rank of a process group. Everything per token (the value
+# projections, the eigenvalues and the SIREN of the Givens parameters) runs on
+# the local shard only. What couples positions is exchanged explicitly:
+#
+#   - the pooled Givens parameters (7 numbers per token) are gathered, because
+#     GenerateParameters lays them out over the whole sequence,
+#   - the two DHHP scans run locally from a zero carry; the last state and the
+#     product of the coefficients of every shard are gathered, every rank scans
+#     the carries of the shards before it and fixes up its local result,
+#   - the one-token halos the DHHP reads from the neighbouring positions.
+#
+# All exchanges are differentiable. Each rank backpropagates the loss of its
+# own shard; the parameter gradients are then summed over the group with
+# all_reduce_gradients().
+#
+# The entry points turn it on with `sequence_parallel: true` in the task
+# config, under torchrun:
+#
+#     torchrun --standalone --nproc_per_node 4 genome_main.py --dataset mm --xformer converter
+#
+# Every rank then reads the same batches and ConverterEncoder embeds only the
+# positions of its shard, with the position encodings offset by the start of
+# the shard (the recurrent rpe also runs over the positions before it). The
+# blocks run on the local shard, and the classifier pools it locally and
+# all-reduces the pooled (B, D) result; only FLATTEN pooling gathers the whole
+# sequence. Since every rank computes the loss of the whole batch, the
+# exchanges sum world_size copies of every gradient, and the averaging
+# all-reduce of DistributedDataParallel yields the gradient of the
+# single-process model.
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+from torch import Tensor
+from typing import List, Tuple
+from .pscan import pscan
+
+
+def _real(tensor: Tensor) -> Tensor:
+    # complex tensors are exchanged through their real view, which gloo supports
+    return torch.view_as_real(tensor) if tensor.is_complex() else tensor
+
+
+def _all_reduce(tensor: Tensor, group=None) -> Tensor:
+    dist.all_reduce(_real(tensor), group=group)
+    return tensor
+
+
+class _AllReduce(torch.autograd.Function):
+    """Sum a tensor over all ranks; every rank's tensor gets the sum of all gradients."""
+    @staticmethod
+    def forward(ctx, input, group):
+        ctx.group = group
+        return _all_reduce(input.clone(), group)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return _all_reduce(grad_output.contiguous().clone(), ctx.group), None
+
+
+class _Gather(torch.autograd.Function):
+    """Stack the tensors of all ranks along a new leading dimension.
+
+    The forward is an all_gather straight into the rows of the output. The
+    gradient of a rank's tensor is the sum of the gradients all ranks computed
+    for it: a reduce_scatter on NCCL, and on gloo, which has none, an
+    all_reduce of the stacked gradients.
+    """
+    @staticmethod
+    def forward(ctx, input, group):
+        ctx.group = group
+        ctx.rank = dist.get_rank(group)
+        output = input.new_empty((dist.get_world_size(group),) + tuple(input.shape))
+        dist.all_gather([_real(row) for row in output.unbind(0)], _real(input.contiguous()), group=group)
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_output = grad_output.contiguous()
+        if dist.get_backend(ctx.group) == 'nccl':
+            grad_input = torch.empty_like(grad_output[0])
+            dist.reduce_scatter(_real(grad_input), [_real(row) for row in grad_output.unbind(0)], group=ctx.group)
+            return grad_input, None
+        return _all_reduce(grad_output.clone(), ctx.group)[ctx.rank], None
+
+
+def all_reduce(tensor: Tensor, group=None) -> Tensor:
+    return _AllReduce.apply(tensor, group)
+
+
+def gather(tensor: Tensor, group=None) -> Tensor:
+    return _Gather.apply(tensor, group)
+
+
+def bounds(local_len: int, group=None) -> Tuple[int, int]:
+    """First and one-past-last global position of the local shard."""
+    rank = dist.get_rank(group)
+    return rank * local_len, (rank + 1) * local_len
+
+
+def shard_bounds(seq_len: int, group=None) -> Tuple[int, int]:
+    """bounds() of the local shard of a sequence of seq_len positions."""
+    world_size = dist.get_world_size(group)
+    if seq_len % world_size != 0:
+        raise ValueError(f'ERROR: The sequence length {seq_len} is not divisible by the {world_size} sequence-parallel ranks.')
+    return bounds(seq_len // world_size, group)
+
+
+def shard(tensor: Tensor, group=None, dim: int = 1) -> Tensor:
+    """The local shard of a full-length tensor."""
+    start, stop = shard_bounds(tensor.size(dim), group)
+    return tensor.narrow(dim, start, stop - start)
+
+
+def unshard(tensor: Tensor, group=None, dim: int = 1) -> Tensor:
+    """The full-length tensor from the shards of all ranks (differentiable)."""
+    return torch.cat(gather(tensor, group).unbind(0), dim=dim)
+
+
+def pool(tensor: Tensor, mode: str, group=None) -> Tensor:
+    """Classifier pooling of a sequence sharded along dim 1, as in the single-process model."""
+    if mode == 'CLS':
+        # the first position lives on rank 0
+        pooled = tensor[:, 0, :] if dist.get_rank(group) == 0 else torch.zeros_like(tensor[:, 0, :])
+        return all_reduce(pooled, group)
+    elif mode == 'MEAN':
+        return all_reduce(tensor.sum(dim=1), group) / (tensor.size(1) * dist.get_world_size(group))
+    elif mode == 'SUM':
+        return all_reduce(tensor.sum(dim=1), group)
+    elif mode == 'FLATTEN':
+        full = unshard(tensor, group)
+        return full.contiguous().view(full.shape[0], -1)
+    else:
+        raise NotImplementedError('Pooling type is not supported.')
+
+
+def halo(boundary: Tensor, offset: int, group=None) -> Tensor:
+    """`boundary` of the rank `offset` positions away, zeros past either end of the sequence."""
+    rank, world_size = dist.get_rank(group), dist.get_world_size(group)
+    boundaries = gather(boundary, group)
+    if 0 <= rank + offset < world_size:
+        return boundaries[rank + offset]
+    return torch.zeros_like(boundary)
+
+
+def scan(A: Tensor, X: Tensor, group=None, reverse: bool = False) -> Tensor:
+    """H[j] = A[j] * H[j - 1] + X[j] over a sequence sharded along dim 1.
+
+    A is (B, n) and X is (B, n, D) for the n local positions. The state before
+    the first position of the sequence is zero; with reverse=True the
+    recurrence runs from the end, H[j] = A[j] * H[j + 1] + X[j].
+    """
+    rank, world_size = dist.get_rank(group), dist.get_world_size(group)
+    if reverse:
+        A, X = A.flip(1), X.flip(1)
+
+    # local scan from a zero carry; A_star[j] is the factor of the carry at j
+    H = pscan(A, X, torch.zeros_like(X[:, 0]))
+    A_star = torch.cumprod(A, dim=1)
+
+    lasts = gather(H[:, -1], group)
+    totals = gather(A_star[:, -1], group)
+    preceding = range(world_size - 1, rank, -1) if reverse else range(0, rank)
+    carry = torch.zeros_like(X[:, 0])
+    for r in preceding:
+        carry = totals[r].unsqueeze(-1) * carry + lasts[r]
+    H = H + A_star.unsqueeze(-1) * carry.unsqueeze(1)
+
+    if reverse:
+        H = H.flip(1)
+
+    return H
+
+
+def apply(model: nn.Module, group=None) -> List[str]:
+    """Switch every Kernelution of `model` to sequence-parallel mode over `group`.
+
+    Inputs of the switched modules must then be the local shards (see shard());
+    a ConverterEncoder embeds only its shard itself. The classifiers of a model
+    with a switched Kernelution are switched to pool the shards (see pool()).
+    Returns the names of the switched Kernelution modules.
+    """
+    if not (dist.is_available() and dist.is_initialized()):
+        raise ValueError('ERROR: Sequence parallelism requires an initialized process group.')
+
+    selected = []
+    for name, module in model.named_modules():
+        if type(module).__name__ == 'Kernelution':
+            if module.dhhp_transform.M is not None:
+                raise ValueError('ERROR: Sequence parallelism does not support permutation_dim; the permutation mixes all shards.')
+            module.sequence_parallel = True
+            module.sequence_group = group
+            selected.append(name)
+    if len(selected) > 0:
+        for module in model.modules():
+            if type(module).__name__ in ['SingleClassifier', 'DualClassifier']:
+                module.sequence_parallel = True
+                module.sequence_group = group
+
+    return selected
+
+
+def all_reduce_gradients(model: nn.Module, group=None) -> None:
+    """Sum the parameter gradients of the shards after every rank ran its backward."""
+    grads = [p.grad for p in model.parameters() if p.grad is not None]
+    if len(grads) == 0:
+        return
+    flat = torch.cat([grad.reshape(-1) for grad in grads])
+    dist.all_reduce(flat, group=group)
+    offset = 0
+    for grad in grads:
+        grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+        offset += grad.numel()
@@ -0,0 +1,114 @@
+import copy
+import csv
+import itertools
+import json
+import math
+import os
+import random
+from typing import Dict, List
+
+
+def expand_grid(space: Dict[str, list]) -> List[Dict]:
+    """Every combination of the listed values, e.g. {'lr': [1e-3, 1e-4], 'xformer.converter.max_order': [2, 4]}."""
+    for key, values in space.items():
+        if not isinstance(values, list):
+            raise ValueError(f'ERROR: A grid search needs a list of values for {key}.')
+    keys = list(space)
+
+    return [dict(zip(keys, values)) for values in itertools.product(*(space[key] for key in keys))]
+
+
+def sample_random(space: Dict, num_trials: int, seed: int = 0) -> List[Dict]:
+    """num_trials random configurations.
+
+    A list is sampled uniformly; {min: a, max: b} uniformly from the interval
+    (integers if both bounds are), with log: true on a log scale.
+    """
+    rng = random.Random(seed)
+    trials = []
+    for _ in range(num_trials):
+        trial = {}
+        for key, values in space.items():
+            if isinstance(values, list):
+                trial[key] = rng.choice(values)
+            elif isinstance(values, dict) and ('min' in values) and ('max' in values):
+                low, high = values['min'], values['max']
+                if values.get('log', False) is True:
+                    value = math.exp(rng.uniform(math.log(low), math.log(high)))
+                else:
+                    value = rng.uniform(low, high)
+                if isinstance(low, int) and isinstance(high, int):
+                    value = int(round(value))
+                trial[key] = value
+            else:
+                raise ValueError(f'ERROR: The search space of {key} must be a list or a {{min, max}} range.')
+        trials.append(trial)
+
+    return trials
+
+
+def apply_overrides(section: Dict, overrides: Dict) -> Dict:
+    """Copy of a config section with dotted keys (e.g. 'xformer.converter.eta') replaced."""
+    section = copy.deepcopy(section)
+    for key, value in overrides.items():
+        node = section
+        parts = key.split('.')
+        for part in parts[:-1]:
+            if not isinstance(node.get(part), dict):
+                raise ValueError(f'ERROR: {key} is not a key of the config section.')
+            node = node[part]
+        if parts[-1] not in node:
+            raise ValueError(f'ERROR: {key} is not a key of the config section.')
+        node[parts[-1]] = value
+
+    return section
+
+
+def rungs(min_epochs: int, max_epochs: int, reduction: int) -> List[int]:
+    """Epoch budgets of successive halving: min_epochs * reduction ** k, ending at max_epochs."""
+    if (min_epochs < 1) or (reduction < 2):
+        raise ValueError('ERROR: Successive halving needs min_epochs >= 1 and reduction >= 2.')
+    budgets = []
+    epochs = min_epochs
+    while epochs < max_epochs:
+        budgets.append(epochs)
+        epochs *= reduction
+    budgets.append(max_epochs)
+
+    return budgets
+
+
+def promote(results: Dict[int, Dict], reduction: int) -> List[int]:
+    """Trials with the lowest best validation loss, keeping 1 / reduction of them (at least one)."""
+    ranked = sorted(results, key=lambda trial: results[trial]['val_loss'])
+
+    return ranked[:max(1, len(ranked) // reduction)]
+
+
+def loop_throughput(telemetry_path: str, loop: str = 'train', first_epoch: int = 1) -> float:
+    """Mean samples/sec of the loop summaries from first_epoch on in a telemetry JSONL file."""
+    if not os.path.exists(telemetry_path):
+        return 0.0
+    rates = []
+    with open(telemetry_path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get('summary') and (record['loop'] == loop) and (record['epoch'] >= first_epoch):
+                rates.append(record['samples_per_sec'])
+
+    return sum(rates) / len(rates) if len(rates) > 0 else 0.0
+
+
+def write_results(path: str, trials: List[Dict], results: Dict[int, Dict]) -> None:
+    """CSV with one row per trial: its overrides, the last rung it ran and its metrics."""
+    keys = sorted(set(key for trial in trials for key in trial))
+    columns = ['trial'] + keys + ['epochs', 'status', 'val_loss', 'val_acc', 'train_loss', 'samples_per_sec', 'peak_memory_mib']
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for trial_id in sorted(results, key=lambda trial: results[trial]['val_loss']):
+            result = results[trial_id]
+            writer.writerow([trial_id] + [trials[trial_id].get(key) for key in keys] + \
+                            [result['epochs'], result['status'], f'{result["val_loss"]:.4f}', f'{result["val_acc"]:.2f}',
+                             f'{result["train_loss"]:.4f}', f'{result["samples_per_sec"]:.1f}',
+                             f'{result["peak_memory"] / (1024 ** 2):.1f}'])
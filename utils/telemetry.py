@@ -0,0 +1,176 @@
+import json
+import time
+import torch
+
+from contextlib import contextmanager
+from . import distributed
+from .memory import MemoryTracker, process_rss
+
+
+class Telemetry:
+    """Per-step phase timing and throughput records for the train/val/test loops.
+
+    Each loop step is split into the phases `data` (waiting for the loader),
+    `transfer` (host to device copy), `forward`, `backward` and `optimizer`.
+    Every step appends one JSON line with the phase wall times, samples/sec,
+    tokens/sec, the process RSS and the peak memory; end_loop() appends a
+    summary line for the whole loop. On CUDA the device is synchronized at
+    phase boundaries so that the times are attributed correctly, which is why
+    the timing is a no-op when neither a JSONL path nor a profiler window is
+    configured. The peak memory of every loop is always tracked through a
+    MemoryTracker and is available from peak_memory().
+
+    Args:
+        path (str): JSONL file the records are appended to. None disables it.
+        device (torch.device): Device the model runs on.
+        profile_window (list): [skip, warmup, active] training steps for an
+            optional torch.profiler window. None disables profiling.
+        trace_path (str): Chrome trace exported after the profiler window.
+        module_profiler (ModuleProfiler): Optional per-submodule profiler that
+            is advanced on every training step.
+
+    In a distributed run rank r > 0 writes to `<path>.rank<r>` and
+    `<trace_path>.rank<r>`, so the ranks never share a file.
+    """
+    def __init__(self, path=None, device=torch.device('cpu'), profile_window=None, trace_path='trace.json', module_profiler=None):
+        self.device = device
+        self.module_profiler = module_profiler
+        if distributed.rank() > 0:
+            path = f'{path}.rank{distributed.rank()}' if path is not None else None
+            trace_path = f'{trace_path}.rank{distributed.rank()}'
+        self.memory = MemoryTracker(device)
+        self.file = open(path, 'a') if path is not None else None
+        self.profiler = None
+        if profile_window is not None:
+            skip, warmup, active = profile_window
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if device.type == 'cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(
+                activities = activities,
+                schedule = torch.profiler.schedule(skip_first=skip, wait=0, warmup=warmup, active=active, repeat=1),
+                on_trace_ready = lambda prof: prof.export_chrome_trace(trace_path),
+                record_shapes = True,
+                profile_memory = True
+            )
+            self.profiler.start()
+        self.enabled = (self.file is not None) or (self.profiler is not None)
+
+        self.loop = None
+        self.epoch = 0
+        self.step = 0
+        self.phases = {}
+        self.totals = {}
+        self.step_start = 0.0
+        self.loop_start = 0.0
+        self.loop_samples = 0
+        self.loop_tokens = 0
+
+    def _sync(self) -> None:
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def _write(self, record) -> None:
+        if self.file is not None:
+            self.file.write(json.dumps(record) + '\n')
+
+    def start_loop(self, loop: str) -> None:
+        self.loop = loop
+        if loop == 'train':
+            self.epoch += 1
+        self.step = 0
+        self.totals = {}
+        self.loop_samples = 0
+        self.loop_tokens = 0
+        self.loop_start = time.perf_counter()
+        self.memory.start(loop)
+
+    def wrap(self, iterable):
+        """Iterate over a data loader while timing the `data` phase."""
+        if not self.enabled:
+            return iterable
+        return self._timed_iter(iterable)
+
+    def _timed_iter(self, iterable):
+        iterator = iter(iterable)
+        while True:
+            self.step_start = time.perf_counter()
+            self.phases = {}
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.phases['data'] = time.perf_counter() - self.step_start
+            yield batch
+
+    @contextmanager
+    def phase(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        self._sync()
+        start = time.perf_counter()
+        with torch.profiler.record_function(name):
+            yield
+        self._sync()
+        self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def end_step(self, samples: int, tokens: int) -> None:
+        if (self.module_profiler is not None) and (self.loop == 'train'):
+            self.module_profiler.step()
+        if not self.enabled:
+            return
+        step_time = time.perf_counter() - self.step_start
+        self.step += 1
+        self.loop_samples += samples
+        self.loop_tokens += tokens
+        for name, elapsed in self.phases.items():
+            self.totals[name] = self.totals.get(name, 0.0) + elapsed
+
+        self._write({
+            'loop': self.loop,
+            'epoch': self.epoch,
+            'step': self.step,
+            'step_time': step_time,
+            'phases': self.phases,
+            'samples_per_sec': samples / step_time,
+            'tokens_per_sec': tokens / step_time,
+            'rss_bytes': process_rss(),
+            'peak_memory_bytes': self.memory.current_peak()
+        })
+
+        if (self.profiler is not None) and (self.loop == 'train'):
+            self.profiler.step()
+
+    def end_loop(self) -> None:
+        loop_peak = self.memory.stop(self.loop)
+        if not self.enabled:
+            return
+        loop_time = time.perf_counter() - self.loop_start
+        self._write({
+            'loop': self.loop,
+            'epoch': self.epoch,
+            'summary': True,
+            'steps': self.step,
+            'loop_time': loop_time,
+            'phases': self.totals,
+            'samples_per_sec': self.loop_samples / loop_time,
+            'tokens_per_sec': self.loop_tokens / loop_time,
+            'rss_bytes': process_rss(),
+            'peak_memory_bytes': loop_peak
+        })
+        if self.file is not None:
+            self.file.flush()
+
+    def peak_memory(self, loop: str) -> int:
+        return self.memory.peak(loop)
+
+    def close(self) -> None:
+        if self.module_profiler is not None:
+            self.module_profiler.close()
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,126 @@
+import json
+import mmap
+import struct
+import torch
+import torch.nn as nn
+from typing import Dict
+
+# File layout:
+#   magic (8 bytes) | header length (little-endian u64) | JSON header | padding | tensor data
+# The header maps every state_dict key to its dtype, shape and byte offset
+# relative to the start of the data section. The data section and every
+# tensor in it start on an ALIGNMENT boundary, so each tensor can be viewed
+# directly from a memory map of the file.
+MAGIC = b'CVTFLAT1'
+ALIGNMENT = 64
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_flat(state_dict: Dict[str, torch.Tensor], f) -> None:
+    """Write a state dict in the flat format to a path or a binary file object."""
+    if not hasattr(f, 'write'):
+        with open(f, 'wb') as file:
+            return save_flat(state_dict, file)
+
+    tensors = {}
+    entries = {}
+    offset = 0
+    for key, tensor in state_dict.items():
+        tensor = tensor.detach().to('cpu').contiguous()
+        offset = _align(offset)
+        entries[key] = {
+            'dtype': str(tensor.dtype).replace('torch.', ''),
+            'shape': list(tensor.shape),
+            'offset': offset
+        }
+        tensors[key] = tensor
+        offset += tensor.numel() * tensor.element_size()
+
+    header = json.dumps(entries).encode('utf-8')
+    data_start = _align(len(MAGIC) + 8 + len(header))
+    f.write(MAGIC)
+    f.write(struct.pack('<Q', len(header)))
+    f.write(header)
+    position = len(MAGIC) + 8 + len(header)
+    for key, tensor in tensors.items():
+        start = data_start + entries[key]['offset']
+        f.write(b'\0' * (start - position))
+        if tensor.numel() > 0:
+            # written as raw bytes, which also covers dtypes numpy lacks such as bfloat16
+            f.write(memoryview(tensor.view(-1).view(torch.uint8).numpy()))
+        position = start + tensor.numel() * tensor.element_size()
+
+
+def is_flat(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load_flat(path: str) -> Dict[str, torch.Tensor]:
+    """Memory-map a flat file and return its tensors as zero-copy views of the map.
+
+    The map is private (copy-on-write), so the views are writable, but nothing
+    is read from disk until a page is touched and nothing is written back.
+    """
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise ValueError(f'ERROR: {path} is not a flat weight file.')
+    header_len, = struct.unpack('<Q', buffer[len(MAGIC):len(MAGIC) + 8])
+    entries = json.loads(buffer[len(MAGIC) + 8:len(MAGIC) + 8 + header_len].decode('utf-8'))
+    data_start = _align(len(MAGIC) + 8 + header_len)
+
+    state_dict = {}
+    for key, entry in entries.items():
+        dtype = getattr(torch, entry['dtype'])
+        count = 1
+        for size in entry['shape']:
+            count *= size
+        if count == 0:
+            state_dict[key] = torch.empty(entry['shape'], dtype=dtype)
+        else:
+            state_dict[key] = torch.frombuffer(buffer, dtype=dtype, count=count,
+                                               offset=data_start + entry['offset']).view(entry['shape'])
+
+    return state_dict
+
+
+def load(path: str, map_location='cpu') -> Dict[str, torch.Tensor]:
+    """State dict from a flat file (memory-mapped) or a torch.save pickle."""
+    if is_flat(path):
+        return load_flat(path)
+    return torch.load(path, map_location=map_location)
+
+
+def load_into(model: nn.Module, path: str) -> nn.Module:
+    """Load weights into a model, as zero-copy views of the file where possible.
+
+    For a flat file and a model on CPU the parameters are replaced by views of
+    the memory map (load_state_dict with assign=True); on other devices the
+    map is copied to the existing parameters. Pickle checkpoints go through
+    torch.load as before.
+    """
+    if not is_flat(path):
+        model.load_state_dict(torch.load(path, map_location='cpu'))
+        return model
+
+    state_dict = load_flat(path)
+    if all(tensor.device.type == 'cpu' for tensor in model.state_dict().values()):
+        model.load_state_dict(state_dict, assign=True)
+    else:
+        model.load_state_dict(state_dict)
+
+    return model
+
+
+def saver(weights_format: str):
+    """Serializer for the weights_format config key."""
+    if weights_format == 'torch':
+        return torch.save
+    elif weights_format == 'flat':
+        return save_flat
+    else:
+        raise ValueError(f'ERROR: The {weights_format} weight format is undefined.')